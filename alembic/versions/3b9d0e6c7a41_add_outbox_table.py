@@ -0,0 +1,31 @@
+"""add outbox table
+
+Revision ID: 3b9d0e6c7a41
+Revises: 1f83569b16df
+Create Date: 2026-10-19 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d0e6c7a41'
+down_revision = '1f83569b16df'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('type', sa.String(100), nullable=False),
+        sa.Column('data', sa.Text, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False,
+                  server_default=sa.func.now()),
+    )
+
+
+def downgrade():
+    op.drop_table('outbox')
@@ -0,0 +1,32 @@
+"""add channels.subs_count
+
+Revision ID: 5c7a2e9f0d13
+Revises: 8e2f4c1d9b57
+Create Date: 2026-10-19 13:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c7a2e9f0d13'
+down_revision = '8e2f4c1d9b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('channels', sa.Column('subs_count', sa.Integer(),
+                                        nullable=False, server_default='0'))
+    op.execute(
+        "UPDATE channels SET subs_count = ("
+        "SELECT COUNT(*) FROM subs WHERE subs.channel_id = channels.id"
+        ")"
+    )
+    op.create_index('ix_channels_subs_count', 'channels', ['subs_count'])
+
+
+def downgrade():
+    op.drop_index('ix_channels_subs_count', 'channels')
+    op.drop_column('channels', 'subs_count')
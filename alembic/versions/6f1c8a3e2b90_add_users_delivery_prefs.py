@@ -0,0 +1,31 @@
+"""add users delivery prefs
+
+Revision ID: 6f1c8a3e2b90
+Revises: d9b3e5a71c24
+Create Date: 2026-10-19 19:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1c8a3e2b90'
+down_revision = 'd9b3e5a71c24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('quiet_from', sa.Integer, nullable=True))
+    op.add_column('users', sa.Column('quiet_to', sa.Integer, nullable=True))
+    op.add_column('users', sa.Column('utc_offset', sa.Integer, nullable=False,
+                                     server_default='0'))
+    op.add_column('users', sa.Column('digest', sa.String(10), nullable=True))
+
+
+def downgrade():
+    op.drop_column('users', 'digest')
+    op.drop_column('users', 'utc_offset')
+    op.drop_column('users', 'quiet_to')
+    op.drop_column('users', 'quiet_from')
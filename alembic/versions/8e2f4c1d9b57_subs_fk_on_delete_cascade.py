@@ -0,0 +1,39 @@
+"""subs foreign keys on delete cascade
+
+Revision ID: 8e2f4c1d9b57
+Revises: 3b9d0e6c7a41
+Create Date: 2026-10-19 12:40:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2f4c1d9b57'
+down_revision = '3b9d0e6c7a41'
+branch_labels = None
+depends_on = None
+
+
+def _recreate_fks(ondelete):
+    op.drop_constraint('subs_user_id_fkey', 'subs', type_='foreignkey')
+    op.drop_constraint('subs_channel_id_fkey', 'subs', type_='foreignkey')
+    op.create_foreign_key('subs_user_id_fkey', 'subs', 'users',
+                          ['user_id'], ['id'], ondelete=ondelete)
+    op.create_foreign_key('subs_channel_id_fkey', 'subs', 'channels',
+                          ['channel_id'], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    # В модели dal.Subscription ключи объявлены с ON DELETE CASCADE, но
+    # исходная миграция создала их без него - выравниваем схему, чтобы
+    # массовое удаление пользователей удаляло подписки на стороне БД.
+    _recreate_fks('CASCADE')
+    op.create_index('ix_subs_user_id', 'subs', ['user_id'])
+    op.create_index('ix_subs_channel_id', 'subs', ['channel_id'])
+
+
+def downgrade():
+    op.drop_index('ix_subs_channel_id', 'subs')
+    op.drop_index('ix_subs_user_id', 'subs')
+    _recreate_fks(None)
@@ -0,0 +1,24 @@
+"""add subs.filters
+
+Revision ID: a4d1f7b2c806
+Revises: 5c7a2e9f0d13
+Create Date: 2026-10-19 14:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d1f7b2c806'
+down_revision = '5c7a2e9f0d13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('subs', sa.Column('filters', sa.String(1000), nullable=True))
+
+
+def downgrade():
+    op.drop_column('subs', 'filters')
@@ -0,0 +1,24 @@
+"""add users bot_id
+
+Revision ID: b7e4d2a9c153
+Revises: 6f1c8a3e2b90
+Create Date: 2026-10-19 21:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4d2a9c153'
+down_revision = '6f1c8a3e2b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('bot_id', sa.String(20), nullable=True))
+
+
+def downgrade():
+    op.drop_column('users', 'bot_id')
@@ -0,0 +1,28 @@
+"""add bot_state table
+
+Revision ID: d9b3e5a71c24
+Revises: a4d1f7b2c806
+Create Date: 2026-10-19 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9b3e5a71c24'
+down_revision = 'a4d1f7b2c806'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'bot_state',
+        sa.Column('key', sa.String(100), primary_key=True),
+        sa.Column('value', sa.Text, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('bot_state')
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+import time
+import heapq
+import queue
+import threading
+
+from itertools import count
+from typing import Any, Callable, Dict, Hashable, List, Tuple, Union
+
+# Приоритеты работы, от самого важного. CONTROL - служебные элементы
+# очереди (например, ошибки опроса), которые никогда не отбрасываются.
+CONTROL = -1
+INTERACTIVE = 0
+BULK = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk",
+                  BACKGROUND: "background"}
+
+# Решения контроля допуска.
+ADMIT = "admitted"
+DEFER = "deferred"
+SHED = "shed"
+COALESCED = "coalesced"
+
+_REPLACED = object()
+
+
+class AdmissionController:
+    """
+    Политика допуска работы при перегрузке.
+
+    Нагрузка (pressure) - наибольшее из отношений глубины очередей к их
+    емкости и средней задержки запросов к БД к целевой db_latency_target.
+    По ней решается, что делать с новой работой:
+    - интерактивные команды принимаются, пока нагрузка меньше 1 (очередь не
+      заполнена);
+    - массовая доставка постов откладывается (копится и отправляется
+      пачкой) при нагрузке от defer_at и отбрасывается от shed_at;
+    - фоновая работа отбрасывается уже от defer_at.
+
+    Все решения учитываются в счетчиках (stats()).
+    """
+
+    def __init__(self,
+                 db_latency_target: float = 0.2,
+                 defer_at: float = 0.5,
+                 shed_at: float = 0.9,
+                 alpha: float = 0.2,
+                 db_window: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param alpha: вес нового замера в средней задержке БД.
+        :param db_window: через сколько секунд без запросов средняя
+        задержка БД перестает учитываться - иначе после перегрузки, когда
+        запросов нет, она не опустилась бы никогда.
+        """
+        self.db_latency_target = db_latency_target
+        self.defer_at = defer_at
+        self.shed_at = shed_at
+        self.alpha = alpha
+        self.db_window = db_window
+        self._clock = clock
+
+        self._queues = {}  # type: Dict[str, Tuple[Callable[[], int], int]]
+        self._db_latency = 0.0
+        self._db_observed_at = None
+        self._counts = {
+            priority: {ADMIT: 0, DEFER: 0, SHED: 0, COALESCED: 0}
+            for priority in PRIORITY_NAMES
+        }  # type: Dict[int, Dict[str, int]]
+        self._lock = threading.Lock()
+
+    def add_queue(self, name: str, depth: Callable[[], int], capacity: int):
+        """
+        Учитывает в нагрузке очередь: depth() возвращает ее текущую длину.
+        """
+        self._queues[name] = (depth, capacity)
+
+    def observe_db(self, seconds: float):
+        """
+        Учитывает время выполнения запроса к БД (см. dal.track_query_time()).
+        """
+        with self._lock:
+            if self._db_observed_at is None:
+                self._db_latency = seconds
+            else:
+                self._db_latency = self.alpha * seconds + \
+                    (1 - self.alpha) * self._db_latency
+            self._db_observed_at = self._clock()
+
+    @property
+    def db_latency(self) -> float:
+        with self._lock:
+            if self._db_observed_at is None or \
+                    self._clock() - self._db_observed_at > self.db_window:
+                return 0.0
+            return self._db_latency
+
+    def pressure(self) -> float:
+        pressure = self.db_latency / self.db_latency_target
+        for depth, capacity in self._queues.values():
+            pressure = max(pressure, depth() / capacity)
+        return pressure
+
+    def decide(self, priority: int, pressure: float = None) -> str:
+        if priority == CONTROL:
+            return ADMIT
+        pressure = self.pressure() if pressure is None else pressure
+        if priority == INTERACTIVE:
+            return SHED if pressure >= 1.0 else ADMIT
+        if priority == BULK:
+            if pressure >= self.shed_at:
+                return SHED
+            return DEFER if pressure >= self.defer_at else ADMIT
+        return SHED if pressure >= self.defer_at else ADMIT
+
+    def admit(self, priority: int) -> str:
+        """
+        Решает судьбу новой работы и учитывает решение в счетчиках.
+        """
+        decision = self.decide(priority)
+        self.count(priority, decision)
+        return decision
+
+    def count(self, priority: int, outcome: str, n: int = 1):
+        if priority == CONTROL:
+            return
+        with self._lock:
+            self._counts[priority][outcome] += n
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {PRIORITY_NAMES[priority]: dict(outcomes)
+                      for priority, outcomes in self._counts.items()}
+        counts["pressure"] = self.pressure()
+        counts["db_latency"] = self.db_latency
+        return counts
+
+
+def classify_update(update) -> int:
+    """
+    Приоритет обновления Bot API: команды и нажатия кнопок пользователей
+    важнее постов каналов.
+    """
+    if getattr(update, "update_id", None) is None:
+        # Ошибки опроса и прочие служебные элементы очереди ptb.
+        return CONTROL
+    if getattr(update, "message", None) is not None or \
+            getattr(update, "callback_query", None) is not None:
+        return INTERACTIVE
+    return BULK
+
+
+def coalesce_key(update) -> Union[Hashable, None]:
+    """
+    Ключ, по которому новое обновление заменяет еще не обработанное:
+    из нескольких правок одного поста имеет смысл только последняя.
+    """
+    for field in ("edited_channel_post", "edited_message"):
+        message = getattr(update, field, None)
+        if message is not None:
+            return field, message.chat_id, message.message_id
+    return None
+
+
+class AdmissionQueue(queue.Queue):
+    """
+    Очередь обновлений для диспетчера ptb вместо неограниченной Queue:
+    обновления выдаются по приоритету (classify), а внутри приоритета - в
+    порядке поступления. Новое обновление, которое контроллер решил
+    отбросить, в очередь не попадает и передается в on_shed; обновление с
+    тем же coalesce_key, что и ожидающее, заменяет его. Длина очереди не
+    превышает capacity: при заполненной очереди нагрузка равна 1 и новые
+    обновления отбрасываются, а не блокируют поток опроса.
+    """
+
+    def __init__(self,
+                 controller: AdmissionController,
+                 capacity: int = 10000,
+                 classify: Callable[[Any], int] = classify_update,
+                 key: Callable[[Any], Union[Hashable, None]] = coalesce_key,
+                 on_shed: Callable[[Any], None] = None,
+                 name: str = "updates"):
+        """
+        :param name: имя очереди в контроллере (у каждого бота процесса
+        своя очередь).
+        """
+        super().__init__()
+        self.controller = controller
+        self.capacity = capacity
+        self.classify = classify
+        self.key = key
+        self.on_shed = on_shed
+        controller.add_queue(name, self.qsize, capacity)
+
+    def _init(self, maxsize: int):
+        self._heap = []  # type: List[list]
+        self._order = count()
+        self._by_key = {}  # type: Dict[Hashable, list]
+        self._live = 0
+
+    def _qsize(self) -> int:
+        return self._live
+
+    def _put(self, entry: list):
+        heapq.heappush(self._heap, entry)
+        self._live += 1
+
+    def _get(self):
+        while True:
+            _, _, item, key = heapq.heappop(self._heap)
+            if item is _REPLACED:
+                continue
+            if key is not None:
+                self._by_key.pop(key, None)
+            self._live -= 1
+            return item
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        priority = self.classify(item)
+        decision = self.controller.decide(priority)
+        if decision != SHED:
+            inserted = self._insert(priority, item)
+            # Отложенное обновление просто ждет в очереди за более
+            # приоритетными.
+            decision = decision if inserted == ADMIT else inserted
+        self.controller.count(priority, decision)
+        if decision == SHED and self.on_shed is not None:
+            self.on_shed(item)
+
+    def _insert(self, priority: int, item) -> str:
+        key = self.key(item) if priority != CONTROL else None
+        with self.mutex:
+            previous = self._by_key.get(key) if key is not None else None
+            if previous is not None:
+                # Новое обновление занимает место ожидающего (и его задачу
+                # в unfinished_tasks), но встает в конец своего приоритета.
+                previous[2] = _REPLACED
+                self._by_key[key] = entry = [priority, next(self._order),
+                                             item, key]
+                heapq.heappush(self._heap, entry)
+                return COALESCED
+            if priority != CONTROL and self._live >= self.capacity:
+                return SHED
+            entry = [priority, next(self._order), item, key]
+            if key is not None:
+                self._by_key[key] = entry
+            self._put(entry)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return ADMIT
+
+    def install(self, updater):
+        """
+        Подменяет очередь обновлений Updater (до start_polling()).
+        """
+        updater.update_queue = self
+        updater.dispatcher.update_queue = self
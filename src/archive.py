@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+import traceback
+
+from bisect import bisect_right
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple
+
+# Заголовок записи: ID сообщения, время публикации, длина тела.
+RECORD_HEADER = struct.Struct("<QdI")
+# Запись разреженного индекса: ID сообщения и смещение записи в сегменте.
+INDEX_ENTRY = struct.Struct("<QQ")
+
+SEGMENT_EXT = ".seg"
+INDEX_EXT = ".idx"
+
+
+class Post(NamedTuple):
+    channel_id: int
+    msg_id: int
+    date: float
+    data: Dict[str, Any]
+
+
+class _Segment:
+    def __init__(self, path: str, base_msg_id: int):
+        self.path = path
+        self.base_msg_id = base_msg_id
+        self.index_msg_ids = []  # type: List[int]
+        self.index_offsets = []  # type: List[int]
+        self.size = 0
+        self.last_indexed_at = None
+
+    @property
+    def index_path(self) -> str:
+        return self.path[:-len(SEGMENT_EXT)] + INDEX_EXT
+
+    def add_index_entry(self, msg_id: int, offset: int):
+        self.index_msg_ids.append(msg_id)
+        self.index_offsets.append(offset)
+        self.last_indexed_at = offset
+
+    def offset_for(self, after_msg_id: int) -> int:
+        """
+        Смещение, с которого нужно читать сегмент, чтобы не пропустить
+        сообщения с ID больше after_msg_id.
+        """
+        i = bisect_right(self.index_msg_ids, after_msg_id) - 1
+        return self.index_offsets[i] if i >= 0 else 0
+
+
+class _Channel:
+    def __init__(self, path: str):
+        self.path = path
+        self.segments = []  # type: List[_Segment]
+        self.last_msg_id = 0
+        self.writer = None
+
+    def close_writer(self):
+        if self.writer is not None:
+            for f in self.writer:
+                f.close()
+            self.writer = None
+
+
+class PostArchive:
+    """
+    Локальный архив постов каналов.
+
+    Посты каждого канала дописываются в конец файлов-сегментов в каталоге
+    канала. Когда сегмент превышает segment_bytes, начинается новый, названный
+    по ID первого сообщения в нем. Для каждого сегмента ведется разреженный
+    индекс (ID сообщения -> смещение) с записью примерно на каждые
+    index_interval байт, поэтому чтение "все посты после сообщения N"
+    сводится к поиску по индексу и одному последовательному чтению
+    отображенных в память (mmap) сегментов.
+
+    Устаревшие данные удаляются целыми сегментами (см. compact()); для
+    каждого удаляемого поста вызывается on_drop(post), если он задан.
+    """
+
+    def __init__(self,
+                 root: str,
+                 segment_bytes: int = 64 * 1024 * 1024,
+                 index_interval: int = 4096,
+                 retention_seconds: float = None,
+                 max_channel_bytes: int = None,
+                 fsync: bool = False,
+                 on_drop: Callable[[Post], None] = None):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.retention_seconds = retention_seconds
+        self.max_channel_bytes = max_channel_bytes
+        self.fsync = fsync
+        self.on_drop = on_drop
+
+        self._channels = {}  # type: Dict[int, _Channel]
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        os.makedirs(root, exist_ok=True)
+
+    def channel_ids(self) -> List[int]:
+        return sorted(int(name) for name in os.listdir(self.root)
+                      if name.isdigit())
+
+    def _channel(self, channel_id: int) -> _Channel:
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._open_channel(channel_id)
+            self._channels[channel_id] = channel
+        return channel
+
+    def _open_channel(self, channel_id: int) -> _Channel:
+        channel = _Channel(os.path.join(self.root, str(channel_id)))
+        os.makedirs(channel.path, exist_ok=True)
+
+        names = sorted(name for name in os.listdir(channel.path)
+                       if name.endswith(SEGMENT_EXT))
+        for name in names:
+            segment = _Segment(os.path.join(channel.path, name),
+                               int(name[:-len(SEGMENT_EXT)]))
+            segment.size = os.path.getsize(segment.path)
+            if os.path.exists(segment.index_path):
+                with open(segment.index_path, "rb") as f:
+                    raw = f.read()
+                usable = len(raw) - len(raw) % INDEX_ENTRY.size
+                for msg_id, offset in INDEX_ENTRY.iter_unpack(raw[:usable]):
+                    if offset < segment.size:
+                        segment.add_index_entry(msg_id, offset)
+            channel.segments.append(segment)
+
+        while channel.segments:
+            segment = channel.segments[-1]
+            self._recover_tail(channel, segment)
+            if segment.size:
+                break
+            # Сегмент создается до первой записи в него: если процесс упал
+            # раньше, чем она была дописана, последнее сообщение канала
+            # лежит в предыдущем сегменте.
+            channel.segments.pop()
+            os.remove(segment.path)
+            if os.path.exists(segment.index_path):
+                os.remove(segment.index_path)
+        return channel
+
+    def _recover_tail(self, channel: _Channel, segment: _Segment):
+        """
+        Находит последнее сообщение в сегменте и отрезает недописанную
+        запись, если процесс упал посреди записи.
+        """
+        offset = segment.last_indexed_at or 0
+        with open(segment.path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            msg_id, _, length = RECORD_HEADER.unpack_from(data, pos)
+            if pos + RECORD_HEADER.size + length > len(data):
+                break
+            channel.last_msg_id = msg_id
+            pos += RECORD_HEADER.size + length
+        if offset + pos < segment.size:
+            with open(segment.path, "r+b") as f:
+                f.truncate(offset + pos)
+            segment.size = offset + pos
+
+    def _writer_for(self, channel: _Channel, msg_id: int):
+        segment = channel.segments[-1] if channel.segments else None
+        if segment is None or segment.size >= self.segment_bytes:
+            channel.close_writer()
+            path = os.path.join(channel.path,
+                                "{:020d}{}".format(msg_id, SEGMENT_EXT))
+            segment = _Segment(path, msg_id)
+            channel.segments.append(segment)
+        if channel.writer is None:
+            channel.writer = (open(segment.path, "ab"),
+                              open(segment.index_path, "ab"))
+        return segment, channel.writer
+
+    def append(self,
+               channel_id: int,
+               msg_id: int,
+               data: Dict[str, Any],
+               date: float = None) -> bool:
+        """
+        Дописывает пост в архив канала.
+        :param channel_id: ID канала.
+        :param msg_id: ID сообщения в канале; должен возрастать.
+        :param data: данные поста (сериализуются в JSON).
+        :param date: время публикации (unix time), по умолчанию - текущее.
+        :return: False, если пост с таким или большим ID уже есть в архиве.
+        """
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        date = time.time() if date is None else date
+        with self._lock:
+            channel = self._channel(channel_id)
+            if msg_id <= channel.last_msg_id:
+                return False
+
+            segment, (seg_file, idx_file) = self._writer_for(channel, msg_id)
+            offset = segment.size
+            if segment.last_indexed_at is None or \
+                    offset - segment.last_indexed_at >= self.index_interval:
+                segment.add_index_entry(msg_id, offset)
+                idx_file.write(INDEX_ENTRY.pack(msg_id, offset))
+                idx_file.flush()
+
+            seg_file.write(RECORD_HEADER.pack(msg_id, date, len(body)) + body)
+            seg_file.flush()
+            if self.fsync:
+                os.fsync(seg_file.fileno())
+
+            segment.size += RECORD_HEADER.size + len(body)
+            channel.last_msg_id = msg_id
+            return True
+
+    def last_msg_id(self, channel_id: int) -> int:
+        with self._lock:
+            return self._channel(channel_id).last_msg_id
+
+    def read_after(self,
+                   channel_id: int,
+                   after_msg_id: int = 0,
+                   limit: int = None) -> Iterator[Post]:
+        """
+        Возвращает посты канала с ID больше after_msg_id в порядке их ID.
+        :param channel_id: ID канала.
+        :param after_msg_id: ID последнего уже полученного сообщения.
+        :param limit: максимальное количество постов.
+        """
+        with self._lock:
+            segments = [
+                (s.path, s.size, s.offset_for(after_msg_id))
+                for s in self._channel(channel_id).segments
+            ]
+            bases = [s.base_msg_id for s in self._channel(channel_id).segments]
+        start = max(bisect_right(bases, after_msg_id) - 1, 0)
+
+        count = 0
+        for path, size, offset in segments[start:]:
+            for post in self._read_segment(channel_id, path, size, offset,
+                                           after_msg_id):
+                yield post
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    @staticmethod
+    def _read_segment(channel_id: int,
+                      path: str,
+                      size: int,
+                      offset: int,
+                      after_msg_id: int) -> Iterator[Post]:
+        if size == 0:
+            return
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # Сегмент удален компактором после того, как мы взяли список.
+            return
+        with f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            pos = offset
+            while pos + RECORD_HEADER.size <= size:
+                msg_id, date, length = RECORD_HEADER.unpack_from(mm, pos)
+                pos += RECORD_HEADER.size
+                if msg_id > after_msg_id:
+                    data = json.loads(mm[pos:pos + length].decode("utf-8"))
+                    yield Post(channel_id, msg_id, date, data)
+                pos += length
+
+    def compact(self, now: float = None) -> int:
+        """
+        Применяет политику хранения: удаляет сегменты, в которые давно не
+        писали (retention_seconds), и самые старые сегменты канала сверх
+        max_channel_bytes. Текущий (последний) сегмент канала не удаляется.
+        :return: количество удаленных сегментов.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        for channel_id in self.channel_ids():
+            with self._lock:
+                channel = self._channel(channel_id)
+                total = sum(s.size for s in channel.segments)
+                while len(channel.segments) > 1:
+                    oldest = channel.segments[0]
+                    expired = self.retention_seconds is not None and \
+                        now - os.path.getmtime(oldest.path) > self.retention_seconds
+                    oversized = self.max_channel_bytes is not None and \
+                        total > self.max_channel_bytes
+                    if not expired and not oversized:
+                        break
+                    if self.on_drop is not None:
+                        for post in self._read_segment(channel_id, oldest.path,
+                                                       oldest.size, 0, 0):
+                            self.on_drop(post)
+                    channel.segments.pop(0)
+                    total -= oldest.size
+                    os.remove(oldest.path)
+                    if os.path.exists(oldest.index_path):
+                        os.remove(oldest.index_path)
+                    removed += 1
+        return removed
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.compact()
+            except Exception as e:
+                print("Error in PostArchive.compact(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start_compactor(self, interval: float = 600.0):
+        """
+        Запускает фоновый поток, который раз в interval секунд применяет
+        политику хранения.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(interval,), name="archive-compactor",
+            daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for channel in self._channels.values():
+                channel.close_writer()
@@ -1,20 +1,107 @@
 # -*- coding: utf-8 -*-
 
 import traceback
+import json
 import os
+
+from collections import OrderedDict
+from functools import partial
 #from telethon import TelegramClient, events, sync
 
-from dal import User, Channel, Subscription, Store
+from typing import Dict, List, Tuple, Union
+from dal import User, Channel, Subscription, Store, preconnect, \
+    track_query_time
 from const import get_constants
+from listcache import SubscriptionListCache
+from chanindex import ChannelIndex
+from kwfilter import FilterIndex, parse_filters, format_filters
+from search import SearchIndex
+from archive import PostArchive
+from throttle import Throttler, LocalBuckets, SharedBuckets, OutboundLimiter, \
+    parse_address
+from updates import UpdateTracker, LAST_UPDATE_ID_KEY
+from hosting import LimitedRequest, parse_bot_tokens, bot_id
+from events import EventBus
+from profiler import Profiler, ControlServer, parse_seconds, \
+    MAX_PROFILE_SECONDS
+from startup import Readiness, warm_up
+from admission import AdmissionController, AdmissionQueue
+from reaper import BlockedUsersReaper
+from render import Renderer, Sender, post_link, open_post_link, \
+    parse_open_post
+from deliverylog import DeliveryLog, LogRetention, OPENED
+from sharding import Delivery, ShardedDelivery
+import tracing
+from deferred import DeliveryScheduler, DIGEST_MODES, parse_quiet_hours, \
+    format_time, format_offset
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import CallbackQueryHandler
 from telegram import ReplyKeyboardMarkup, Bot
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 START_CMD = "start"
 HELP_CMD = "help"
 ADD_CMD = "add"
 DEL_CMD = "del"
-
-consts = get_constants(os.getenv("BOT_LANG", "ru").lower())
+LIST_CMD = "list"
+TOP_CMD = "top"
+FILTER_CMD = "filter"
+SEARCH_CMD = "search"
+QUIET_CMD = "quiet"
+DIGEST_CMD = "digest"
+PROFILE_CMD = "profile"
+OFF_ARG = "off"
+
+TOP_CHANNELS_LIMIT = 10
+SEARCH_RESULTS_LIMIT = 10
+# Ограничение на количество каналов пользователя, по которым идет поиск.
+SEARCH_CHANNELS_LIMIT = 1000
+
+LIST_CALLBACK_PREFIX = "list:"
+
+# Сколько неподтвержденных добавлений новых каналов помнит бот.
+MAX_PENDING_CHANNELS = 10000
+
+DEFAULT_LANG = os.getenv("BOT_LANG", "ru").lower()
+
+# Сколько команд в секунду в среднем и подряд может отправить один чат.
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+# Сколько сообщений в секунду отправляет каждый бот процесса.
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "30"))
+
+# Прогрев при старте: сколько соединений пула открыть заранее, сколько
+# недавно активных пользователей (сохраняются в bot_state при остановке)
+# загрузить в кэш списков и сколько секунд ждать прогрева перед опросом.
+POOL_WARM_CONNECTIONS = int(os.getenv("POOL_WARM_CONNECTIONS", "5"))
+HOT_USERS_KEY = "hot_users"
+HOT_USERS_LIMIT = 1000
+WARMUP_WAIT = float(os.getenv("WARMUP_WAIT", "30"))
+
+# Контроль допуска при перегрузке (см. admission.AdmissionController):
+# сколько обновлений может ждать обработки у каждого бота и какая средняя
+# задержка запросов к БД считается предельной.
+UPDATE_QUEUE_CAPACITY = int(os.getenv("UPDATE_QUEUE_CAPACITY", "10000"))
+DB_LATENCY_TARGET = float(os.getenv("DB_LATENCY_TARGET", "0.2"))
+
+# Рассылка постов подписчикам (см. sharding.ShardedDelivery): сколько
+# процессов-шардов ее выполняют и где лежат их журналы доставок.
+DELIVERY_SHARDS = int(os.getenv("DELIVERY_SHARDS", "2"))
+DELIVERY_DIR = os.getenv("DELIVERY_DIR", "delivery")
+# Журнал событий доставки (см. deliverylog.DeliveryLog; запросы к нему -
+# python deliverylog.py): каталог и сколько дней хранятся события. Пустой
+# DELIVERY_EVENTS_DIR отключает журнал. С TRACK_OPENS=1 кнопка поста ведет
+# через бота, и переходы тоже попадают в журнал.
+DELIVERY_EVENTS_DIR = os.getenv("DELIVERY_EVENTS_DIR",
+                                os.path.join(DELIVERY_DIR, "events"))
+DELIVERY_EVENTS_DAYS = float(os.getenv("DELIVERY_EVENTS_DAYS", "30"))
+TRACK_OPENS = os.getenv("TRACK_OPENS", "") == "1"
+
+# ID чатов операторов, которым доступна команда /profile.
+ADMIN_IDS = {
+    int(chat_id) for chat_id in os.getenv("ADMIN_IDS", "").split(",")
+    if chat_id.strip()
+}
 
 
 def quiet_exec(f):
@@ -32,18 +119,51 @@ def quiet_exec(f):
 
 class FeedBot:
 
-    def __init__(self, store):
+    def __init__(self,
+                 store,
+                 list_cache: SubscriptionListCache = None,
+                 channel_index: ChannelIndex = None,
+                 search_index: SearchIndex = None,
+                 profiler: Profiler = None,
+                 lang: str = DEFAULT_LANG,
+                 bot_id: str = None,
+                 events: DeliveryLog = None):
+        """
+        :param lang: язык сообщений бота (ключ в const.py). Несколько ботов в
+        одном процессе могут работать на разных языках.
+        :param bot_id: ID бота (см. hosting.bot_id()); запоминается у новых
+        пользователей, чтобы рассылать им посты от имени этого бота.
+        :param events: журнал доставок, в который записываются переходы по
+        постам (см. render.open_post_link()).
+        """
         self.store = store
-
-    def start(self, bot, update):
+        self.lang = lang
+        self.bot_id = bot_id
+        self.events = events
+        self.consts = get_constants(lang)
+        self.profiler = profiler
+        self.list_cache = list_cache or SubscriptionListCache(store)
+        self.channel_index = channel_index or ChannelIndex()
+        self.search_index = search_index or SearchIndex()
+        # Каналы, вместо которых пользователю были предложены похожие:
+        # повторная команда /add с тем же названием подтверждает создание.
+        self._pending_channels = OrderedDict()
+
+    def start(self, bot, update, args=None):
         """
         Хэндлер команды /start, которая отправляется от пользователя боту
-        автоматически при отправке.
+        автоматически при отправке. С параметром из кнопки поста (см.
+        render.open_post_link()) записывает переход и отвечает ссылкой на пост.
         """
         # При начале работы с ботом автоматически вызывается команда /start
         # и пользователю присвается user_id, под которым он заносится в БД.
         user_id = update.message.chat.id
 
+        opened = parse_open_post(args[0]) if args else None
+        if opened is not None:
+            update.message.reply_text(self._handle_open_post(user_id, *opened))
+            return
+
         # Имя или юзернейм пользователя для приветствия.
         fname = update.message.from_user.first_name
         username = update.message.from_user.username
@@ -52,19 +172,33 @@ class FeedBot:
 
         channel_name = "@{}{}".format(user_id, fname)
 
-        msg = consts["start_msg_text"].format(fname, channel_name, HELP_CMD)
+        msg = self.consts["start_msg_text"].format(fname, channel_name, HELP_CMD)
 
         update.message.reply_text(msg)
         # При старте работы с ботом заносим id юзера и название канала в БД.
         # Если пользователь повторно воспользовался командой /start,
         # и его данные уже есть в таблице - не меняем их.
-        self.store.create_user(fname)
+        if not self.store.user_exists(tg_id=user_id):
+            self.store.create_user(tg_id=user_id, nickname=username,
+                                   bot_id=self.bot_id)
+
+    def _handle_open_post(self, user_id: int, channel_id: int,
+                          msg_id: int) -> str:
+        channel = self.store.get_channel(channel_id)
+        if channel is None:
+            return self.consts["post_not_found"]
+        if self.events is not None:
+            self.events.append(channel_id, user_id, OPENED)
+        return self.consts["post_link"].format(post_link(channel.title, msg_id))
 
     def help(self, bot, update):
         """
         Хэндлер команды /help, которая дает справку о командах бота
         """
-        msg = consts["help_msg_text"].format(HELP_CMD, ADD_CMD, DEL_CMD)
+        msg = self.consts["help_msg_text"].format(
+            HELP_CMD, ADD_CMD, DEL_CMD, LIST_CMD, TOP_CMD, FILTER_CMD,
+            SEARCH_CMD, QUIET_CMD, DIGEST_CMD
+        )
         update.message.reply_text(msg)
 
     def delete_channel(self, bot, update, args):
@@ -80,21 +214,32 @@ class FeedBot:
 
     def _handle_delete_channel(self, user_id: int, channel_name: str) -> str:
         if not channel_name:
-            return consts["channel_name_is_empty"]
+            return self.consts["channel_name_is_empty"]
 
         if not channel_name.startswith('@'):
-            return consts["channel_name_should_starts_with"]
+            return self.consts["channel_name_should_starts_with"]
 
-        user = self.store.get_user(tg_id=[user_id])
-        channel = self.store.get_channel(title=[channel_name])
+        channel_name = self._known_channel_name(channel_name)
+        user = self.store.get_user(tg_id=user_id)
+        channel = self.store.get_channel(title=channel_name)
 
-        if not self.store.subscription_exists(user.id, channel.id):
-            return consts["no_such_channel_in_subs"]
+        if channel is None or \
+                not self.store.subscription_exists(user.id, channel.id):
+            return self.consts["no_such_channel_in_subs"].format(channel_name)
 
         # Удаляем запись о подписке юзера на канал.
         self.store.delete_subscription(user.id, channel.id)
+        self.list_cache.invalidate(user_id)
 
-        return consts["channel_deleted"].format(channel_name)
+        return self.consts["channel_deleted"].format(channel_name)
+
+    def _known_channel_name(self, channel_name: str) -> str:
+        """
+        Название уже известного канала, которое отличается от channel_name
+        только регистром (@Channel и @channel - один канал), иначе само
+        channel_name.
+        """
+        return self.channel_index.find(channel_name) or channel_name
 
     def add_channel(self, bot, update, args):
         """
@@ -109,24 +254,259 @@ class FeedBot:
 
     def _handle_add_channel(self, user_id: int, channel_name: str) -> str:
         if not channel_name:
-            return consts["channel_name_is_empty"]
+            return self.consts["channel_name_is_empty"]
 
         if not channel_name.startswith('@'):
-            return consts["channel_name_should_starts_with"]
-
-        user = self.store.get_user(tg_id=[user_id])
-        channel = self.store.get_channel(title=[channel_name])
-        # Если этого канала еще нет в БД - добавляем.
+            return self.consts["channel_name_should_starts_with"]
+
+        channel_name = self._known_channel_name(channel_name)
+        user = self.store.get_user(tg_id=user_id)
+        channel = self.store.get_channel(title=channel_name)
+        confirmed = self._pending_channels.pop(user_id, None) == channel_name
+        # Если этого канала еще нет в БД - добавляем, но сначала предлагаем
+        # похожие известные каналы на случай опечатки.
         if channel is None:
+            suggestions = [] if confirmed else \
+                self.channel_index.suggest(channel_name)
+            if suggestions:
+                self._pending_channels[user_id] = channel_name
+                if len(self._pending_channels) > MAX_PENDING_CHANNELS:
+                    self._pending_channels.popitem(last=False)
+                return self.consts["did_you_mean"].format(
+                    ", ".join(suggestions), ADD_CMD, channel_name
+                )
             channel = self.store.create_channel(channel_name)
+            self.channel_index.add(channel.id, channel.title)
 
         if self.store.subscription_exists(user.id, channel.id):
-            return consts["you_already_add_this_channel"]
+            return self.consts["you_already_add_this_channel"]
 
         # Создаем запись о подписке юзера на канал.
         self.store.create_subscription(user.id, channel.id)
+        self.list_cache.invalidate(user_id)
+
+        return self.consts["channel_have_added"].format(channel_name)
+
+    def filter_channel(self, bot, update, args):
+        """
+        Хэндлер команды /filter, которая задает для подписки на канал слова,
+        которые должны (+слово) или не должны (-слово) встречаться в постах.
+        Команда без слов сбрасывает фильтры.
+        """
+        user_id = update.message.chat.id
+        update.message.reply_text(
+            self._handle_filter(user_id, list(args or []))
+        )
 
-        return consts["channel_have_added"].format(channel_name)
+    def _handle_filter(self, user_id: int, args: List[str]) -> str:
+        if not args:
+            return self.consts["channel_name_is_empty"]
+
+        channel_name, words = args[0], args[1:]
+        if not channel_name.startswith('@'):
+            return self.consts["channel_name_should_starts_with"]
+        channel_name = self._known_channel_name(channel_name)
+
+        try:
+            include, exclude = parse_filters(" ".join(words))
+        except ValueError:
+            return self.consts["filter_usage"].format(FILTER_CMD)
+        filters = format_filters(include, exclude)
+
+        user = self.store.get_user(tg_id=user_id)
+        if user is None:
+            return self.consts["start_required"].format(START_CMD)
+        channel = self.store.get_channel(title=channel_name)
+        if channel is None or not self.store.set_subscription_filters(
+                user.id, channel.id, filters):
+            return self.consts["no_such_channel_in_subs"].format(channel_name)
+
+        if not filters:
+            return self.consts["filters_cleared"].format(channel_name)
+        return self.consts["filters_set"].format(channel_name, filters)
+
+    def quiet_hours(self, bot, update, args):
+        """
+        Хэндлер команды /quiet, которая задает тихие часы - время, когда
+        посты не присылаются, а копятся до их окончания.
+        """
+        user_id = update.message.chat.id
+        update.message.reply_text(
+            self._handle_quiet(user_id, list(args or []))
+        )
+
+    def _handle_quiet(self, user_id: int, args: List[str]) -> str:
+        user = self.store.get_user(tg_id=user_id)
+        if user is None:
+            return self.consts["start_required"].format(START_CMD)
+
+        if args == [OFF_ARG]:
+            self.store.update_delivery_prefs(user.id, quiet_from=None,
+                                             quiet_to=None)
+            return self.consts["quiet_cleared"]
+
+        try:
+            quiet_from, quiet_to, offset = parse_quiet_hours(args)
+        except ValueError:
+            return self.consts["quiet_usage"].format(QUIET_CMD, QUIET_CMD)
+
+        self.store.update_delivery_prefs(user.id, quiet_from=quiet_from,
+                                         quiet_to=quiet_to, utc_offset=offset)
+        return self.consts["quiet_set"].format(
+            format_time(quiet_from), format_time(quiet_to),
+            format_offset(offset)
+        )
+
+    def digest(self, bot, update, args):
+        """
+        Хэндлер команды /digest, которая включает доставку постов пачкой
+        раз в час или раз в день.
+        """
+        user_id = update.message.chat.id
+        update.message.reply_text(
+            self._handle_digest(user_id, list(args or []))
+        )
+
+    def _handle_digest(self, user_id: int, args: List[str]) -> str:
+        user = self.store.get_user(tg_id=user_id)
+        if user is None:
+            return self.consts["start_required"].format(START_CMD)
+
+        if args == [OFF_ARG]:
+            self.store.update_delivery_prefs(user.id, digest=None)
+            return self.consts["digest_cleared"]
+
+        if len(args) != 1 or args[0].lower() not in DIGEST_MODES:
+            return self.consts["digest_usage"].format(DIGEST_CMD)
+
+        self.store.update_delivery_prefs(user.id, digest=args[0].lower())
+        return self.consts["digest_set"].format(args[0].lower())
+
+    def search_posts(self, bot, update, args):
+        """
+        Хэндлер команды /search, которая ищет посты по словам среди
+        каналов, на которые подписан пользователь.
+        """
+        user_id = update.message.chat.id
+        query = ' '.join(args) if args is not None else ''
+        update.message.reply_text(
+            self._handle_search(user_id, query), disable_web_page_preview=True
+        )
+
+    def _handle_search(self, user_id: int, query: str) -> str:
+        if not query.strip():
+            return self.consts["search_query_is_empty"].format(SEARCH_CMD)
+
+        user = self.store.get_user(tg_id=user_id)
+        if user is None:
+            return self.consts["start_required"].format(START_CMD)
+
+        channels = {
+            chan.id: chan.title for chan in
+            self.store.get_user_channels(user.id, limit=SEARCH_CHANNELS_LIMIT)
+        }
+        found = self.search_index.search(query, channels.keys(),
+                                         SEARCH_RESULTS_LIMIT)
+        if not found:
+            return self.consts["search_nothing_found"]
+
+        links = [
+            "https://t.me/{}/{}".format(channels[chan_id].lstrip('@'), msg_id)
+            for chan_id, msg_id in found
+        ]
+        return self.consts["search_results"].format("\n".join(links))
+
+    def list_channels(self, bot, update):
+        """
+        Хэндлер команды /list, которая показывает первую страницу списка
+        каналов пользователя.
+        """
+        user_id = update.message.chat.id
+        text, markup = self._handle_list(user_id, 0)
+        update.message.reply_text(text, reply_markup=markup)
+
+    def list_page(self, bot, update):
+        """
+        Хэндлер нажатия на кнопки листания под списком каналов.
+        """
+        query = update.callback_query
+        number = int(query.data[len(LIST_CALLBACK_PREFIX):])
+        text, markup = self._handle_list(query.message.chat.id, number)
+        query.answer()
+        query.edit_message_text(text, reply_markup=markup)
+
+    def _handle_list(self,
+                     user_id: int,
+                     number: int
+                     ) -> Tuple[str, Union[InlineKeyboardMarkup, None]]:
+        page = self.list_cache.get_page(user_id, number)
+        if page is None:
+            return self.consts["start_required"].format(START_CMD), None
+        if not page.titles:
+            return self.consts["no_subscriptions"], None
+
+        buttons = []
+        if page.has_prev:
+            buttons.append(InlineKeyboardButton(
+                self.consts["prev_page"],
+                callback_data=LIST_CALLBACK_PREFIX + str(page.number - 1)
+            ))
+        if page.has_next:
+            buttons.append(InlineKeyboardButton(
+                self.consts["next_page"],
+                callback_data=LIST_CALLBACK_PREFIX + str(page.number + 1)
+            ))
+        markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+        text = self.consts["subscriptions_page"].format(
+            page.number + 1, "\n".join(page.titles)
+        )
+        return text, markup
+
+    def profile(self, bot, update, args):
+        """
+        Хэндлер служебной команды /profile, которая запускает профилирование
+        бота на заданное число секунд и присылает пути к файлам с отчетом.
+        Доступна только чатам из ADMIN_IDS.
+        """
+        chat_id = update.message.chat.id
+        if chat_id not in ADMIN_IDS or self.profiler is None:
+            return
+        update.message.reply_text(self._handle_profile(
+            list(args or []),
+            lambda files: bot.send_message(
+                chat_id=chat_id,
+                text=self.consts["profiling_done"].format("\n".join(files))
+            )
+        ))
+
+    def _handle_profile(self, args: List[str], on_done) -> str:
+        usage = self.consts["profile_usage"].format(PROFILE_CMD, MAX_PROFILE_SECONDS)
+        if len(args) != 1:
+            return usage
+        seconds, error = parse_seconds(args[0])
+        if error:
+            return usage
+        if not self.profiler.trigger(seconds, on_done):
+            return self.consts["profiling_busy"]
+        return self.consts["profiling_started"].format(seconds)
+
+    def top_channels(self, bot, update):
+        """
+        Хэндлер команды /top, которая показывает самые популярные каналы.
+        """
+        update.message.reply_text(self._handle_top())
+
+    def _handle_top(self) -> str:
+        channels = self.store.get_top_channels(TOP_CHANNELS_LIMIT)
+        if not channels:
+            return self.consts["no_top_channels"]
+
+        lines = [
+            self.consts["top_channel_line"].format(i, chan.title, chan.subs_count)
+            for i, chan in enumerate(channels, start=1)
+        ]
+        return self.consts["top_channels"].format("\n".join(lines))
 
     def add_channel_old(self, bot, update, args):
         """
@@ -137,40 +517,269 @@ class FeedBot:
         channel_name = ''.join(args) if args is not None else ''
 
         if not channel_name:
-            update.message.reply_text(consts["channel_name_is_empty"])
+            update.message.reply_text(self.consts["channel_name_is_empty"])
             return
 
         if not channel_name.startswith('@'):
-            update.message.reply_text(consts["channel_name_should_starts_with"])
+            update.message.reply_text(self.consts["channel_name_should_starts_with"])
             return
 
-        user = self.store.get_user(tg_id=[user_id])
-        channel = self.store.get_channel(title=[channel_name])
+        user = self.store.get_user(tg_id=user_id)
+        channel = self.store.get_channel(title=channel_name)
         # Если этого канала еще нет в БД - добавляем.
         if channel is None:
             channel = self.store.create_channel(channel_name)
 
         if self.store.subscription_exists(user.id, channel.id):
-            update.message.reply_text(consts["you_already_add_this_channel"])
+            update.message.reply_text(self.consts["you_already_add_this_channel"])
             return
 
         # Создаем запись о подписке юзера на канал.
         self.store.create_subscription(user.id, channel.id)
+        self.list_cache.invalidate(user_id)
 
         update.message.reply_text(
-            consts["channel_have_added"].format(channel_name)
+            self.consts["channel_have_added"].format(channel_name)
         )
 
 
-if __name__ == "__main__":
-    token = os.getenv('BOT_TOKEN', None)
-    feedbot = FeedBot(store=Store())
-    updater = Updater(bot=Bot(token))
+def load_hot_users(store, key: str) -> List[int]:
+    value = store.get_state(key)
+    return json.loads(value) if value else []
+
+
+def save_hot_users(store, key: str, list_cache: SubscriptionListCache):
+    with store.transaction():
+        store.set_state(key, json.dumps(list_cache.hot_users(HOT_USERS_LIMIT)))
+
+
+def post_sender(bots: List[Tuple[str, str]], rate: float, shard: int,
+                track_opens: bool = False):
+    """
+    Создает в процессе шарда рассылки функцию send(tg_id, payload, bot).
+    payload - данные поста из архива с добавленными "channel_id" и
+    "msg_id", bot - ID бота, через которого пользователь начал работу:
+    пост отправляется от имени этого бота и на его языке. Без bot (у
+    пользователей, начавших работу до появления нескольких ботов)
+    используется первый бот.
+    :param bots: список пар (токен, язык), см. hosting.parse_bot_tokens().
+    :param rate: сколько сообщений в секунду шард может отправлять от
+    имени каждого бота.
+    :param track_opens: кнопка поста ведет на deep link бота, чтобы
+    FeedBot.start() записал переход.
+    """
+    renderer = Renderer()
+    renderers = {}  # type: Dict[str, Renderer]
+    # Клиент со своим ограничителем на процесс шарда (см. LimitedRequest).
+    request = LimitedRequest(OutboundLimiter(rate),
+                             con_pool_size=len(bots) + 1)
+    tokens = {bot_id(token): (token, lang) for token, lang in bots}
+    default = bot_id(bots[0][0])
+    senders = {}  # type: Dict[str, Sender]
+
+    def send(tg_id: int, payload: dict, bot: str = None):
+        bot = bot or default
+        if bot not in tokens:
+            raise ValueError("Unknown bot: {}".format(bot))
+        token, lang = tokens[bot]
+        sender = senders.get(bot)
+        if sender is None:
+            sender = Sender(
+                Bot(token, base_url=os.getenv('BOT_API_URL') or None,
+                    request=request)
+            )
+            # Имя бота для deep link узнается запросом getMe.
+            renderers[bot] = Renderer(
+                open_link=open_post_link(sender.bot.username)
+            ) if track_opens else renderer
+            senders[bot] = sender
+        rendered = renderers[bot].render(payload["channel_id"],
+                                         payload["msg_id"], payload, lang)
+        tracing.mark(payload, tracing.RENDER)
+        sender.send(tg_id, rendered)
+
+    return send
+
+
+def main(readiness: Readiness = None):
+    """
+    Запускает ботов процесса. Опрос Bot API начинается после прогрева пула
+    соединений и кэшей, но не позже, чем через WARMUP_WAIT секунд - дальше
+    прогрев продолжается параллельно с обработкой команд. Ход старта
+    отмечается в readiness (см. модуль startup).
+    """
+    readiness = readiness or Readiness()
+    # Один процесс может обслуживать несколько ботов (BOT_TOKENS, см.
+    # hosting.parse_bot_tokens()) - у каждого свой язык и набор хэндлеров,
+    # а пул соединений с БД, кэши, шина событий и лимиты на отправку общие.
+    bots = parse_bot_tokens(
+        os.getenv("BOT_TOKENS") or os.getenv("BOT_TOKEN", ""), DEFAULT_LANG
+    )
+    bus = EventBus()
+    # Глубина очередей обновлений и задержка БД определяют, какие
+    # обновления принимаются в обработку; счетчики решений видны в /healthz.
+    admission = AdmissionController(db_latency_target=DB_LATENCY_TARGET)
+    track_query_time(admission.observe_db)
+    readiness.report("admission", admission.stats)
+    channel_index = ChannelIndex()
+    channel_index.attach(bus)
+    # Пользователи, заблокировавшие бота, узнаются по ошибкам рассылки и
+    # удаляются пачками в фоне. Посты рассылаются от имени того бота, через
+    # которого пользователь начал работу; лимит OUTBOUND_RATE делится между
+    # шардами.
+    reaper = BlockedUsersReaper(Store(bus=bus))
+    filter_index = FilterIndex()
+    filter_index.attach(bus)
+    # Доставки в тихие часы, с дайджестом или при перегрузке копятся в
+    # планировщике и уходят в шарды пачкой, когда откроется окно доставки.
+    # Между запусками отложенные доставки хранятся рядом с журналами шардов.
+    scheduler = DeliveryScheduler(
+        lambda tg_id, items: delivery.route_batch(tg_id, items),
+        admission=admission,
+        path=os.path.join(DELIVERY_DIR, "deferred.json"),
+        decode=lambda item: Delivery(*item)
+    )
+    scheduler.attach(bus)
+    # Шарды пишут результаты отправок, а основной процесс - переходы по
+    # постам; он же раз в час удаляет события старше DELIVERY_EVENTS_DAYS.
+    events = retention = None
+    if DELIVERY_EVENTS_DIR:
+        events = DeliveryLog(DELIVERY_EVENTS_DIR)
+        retention = LogRetention(events, DELIVERY_EVENTS_DAYS * 24 * 3600)
+    delivery = ShardedDelivery(DELIVERY_SHARDS, DELIVERY_DIR,
+                               partial(post_sender, bots,
+                                       OUTBOUND_RATE / DELIVERY_SHARDS,
+                                       track_opens=TRACK_OPENS),
+                               on_blocked=reaper.report_blocked,
+                               events_dir=DELIVERY_EVENTS_DIR or None,
+                               filters=filter_index,
+                               scheduler=scheduler)
+    search_index = SearchIndex()
+    # Шаги прогрева идут в отдельных сессиях БД: хэндлеры могут начать
+    # работать раньше, чем прогрев закончится.
+    steps = [
+        ("pool", lambda: preconnect(POOL_WARM_CONNECTIONS)),
+        ("channels", lambda: channel_index.load(Store().get_channels())),
+        ("top_channels", lambda: Store().get_top_channels(TOP_CHANNELS_LIMIT)),
+        ("filters", lambda: filter_index.load(
+            Store().get_subscription_filters()
+        )),
+        ("delivery_prefs", lambda: scheduler.load(
+            Store().get_users_with_delivery_prefs()
+        )),
+    ]
+    if os.getenv("ARCHIVE_DIR"):
+        archive = PostArchive(os.getenv("ARCHIVE_DIR"))
+        steps.append(("search", lambda: search_index.build_from_archive(archive)))
+    profiler = Profiler(os.getenv("PROFILE_DIR", "profiles"))
+    # Профилирование можно запустить и через локальный сокет, если задан
+    # CONTROL_SOCKET: echo "profile 30" | nc -U $CONTROL_SOCKET
+    if os.getenv("CONTROL_SOCKET"):
+        ControlServer(profiler, os.getenv("CONTROL_SOCKET")).start()
+
+    # Общее состояние ограничителя для нескольких процессов бота задается
+    # адресом сервера ведер (python throttle.py) в THROTTLE_ADDRESS - путь к
+    # UNIX-сокету или host:port, - и обязательным THROTTLE_AUTHKEY.
+    throttle_address = os.getenv("THROTTLE_ADDRESS")
+    if throttle_address:
+        buckets = SharedBuckets(
+            parse_address(throttle_address),
+            os.getenv("THROTTLE_AUTHKEY", "").encode()
+        )
+    else:
+        buckets = LocalBuckets(THROTTLE_RATE, THROTTLE_BURST)
+
+    request = LimitedRequest(OutboundLimiter(OUTBOUND_RATE),
+                             con_pool_size=8 * len(bots))
+    updaters = []
+    list_caches = []
+    for token, lang in bots:
+        # У каждого бота своя сессия БД (хэндлеры разных ботов работают в
+        # разных потоках), но движок и пул соединений общие.
+        store = Store(bus=bus)
+        list_cache = SubscriptionListCache(store)
+        list_cache.attach(bus)
+        hot_users_key = "{}:{}".format(HOT_USERS_KEY, bot_id(token))
+        list_caches.append((store, hot_users_key, list_cache))
+
+        def warm_list_cache(key=hot_users_key, list_cache=list_cache):
+            warm_store = Store()
+            list_cache.warm(load_hot_users(warm_store, key), warm_store)
+
+        steps.append(("hot_users:{}".format(bot_id(token)), warm_list_cache))
+        feedbot = FeedBot(store=store,
+                          list_cache=list_cache,
+                          channel_index=channel_index,
+                          search_index=search_index,
+                          profiler=profiler,
+                          lang=lang,
+                          bot_id=bot_id(token),
+                          events=events)
+        # BOT_API_URL позволяет направить бота на fakeapi.FakeTelegramServer.
+        updater = Updater(bot=Bot(token, base_url=os.getenv('BOT_API_URL') or None,
+                                  request=request))
+        throttle = Throttler(buckets, feedbot.consts["slow_down"])
+
+        # Повторно полученные обновления отбрасываются до хранилища, а опрос
+        # продолжается после последнего обработанного. Его ID читается на
+        # прогреве; до этого хэндлеры бота ждут.
+        tracker = UpdateTracker(
+            store, key="{}:{}".format(LAST_UPDATE_ID_KEY, bot_id(token))
+        )
 
-    updater.dispatcher.add_handler(CommandHandler(START_CMD, feedbot.start))
-    updater.dispatcher.add_handler(CommandHandler(HELP_CMD, feedbot.help))
-    updater.dispatcher.add_handler(CommandHandler(ADD_CMD, feedbot.add_channel, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler(DEL_CMD, feedbot.delete_channel, pass_args=True))
+        def load_tracker(tracker=tracker, updater=updater):
+            tracker.load(Store())
+            tracker.resume(updater)
+
+        steps.append(("updates:{}".format(bot_id(token)), load_tracker))
+        AdmissionQueue(admission, UPDATE_QUEUE_CAPACITY,
+                       name="updates:{}".format(bot_id(token))).install(updater)
+
+        # Ограничитель стоит первым: отклоненное обновление не доходит до
+        # хранилища, в том числе до записи своего update_id.
+        def handler(callback, tracker=tracker, throttle=throttle):
+            return throttle(tracker(profiler.track(callback)))
+
+        updater.dispatcher.add_handler(CommandHandler(START_CMD, handler(feedbot.start), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(HELP_CMD, handler(feedbot.help)))
+        updater.dispatcher.add_handler(CommandHandler(ADD_CMD, handler(feedbot.add_channel), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(DEL_CMD, handler(feedbot.delete_channel), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(LIST_CMD, handler(feedbot.list_channels)))
+        updater.dispatcher.add_handler(CommandHandler(TOP_CMD, handler(feedbot.top_channels)))
+        updater.dispatcher.add_handler(CommandHandler(FILTER_CMD, handler(feedbot.filter_channel), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(SEARCH_CMD, handler(feedbot.search_posts), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(QUIET_CMD, handler(feedbot.quiet_hours), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(DIGEST_CMD, handler(feedbot.digest), pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler(PROFILE_CMD, tracker(feedbot.profile), pass_args=True))
+        updater.dispatcher.add_handler(CallbackQueryHandler(handler(feedbot.list_page), pattern="^" + LIST_CALLBACK_PREFIX))
+
+        updaters.append(updater)
+
+    warm_up(readiness, steps).join(WARMUP_WAIT)
+    reaper.start()
+    delivery.start()
+    scheduler.start()
+    if retention is not None:
+        retention.run_once()
+        retention.start()
+    readiness.add("polling")
+    for updater in updaters:
+        updater.start_polling()
+    readiness.done("polling")
+
+    # idle() первого бота ждет сигнала остановки, после чего
+    # останавливаются и остальные.
+    updaters[0].idle()
+    for updater in updaters[1:]:
+        updater.stop()
+    scheduler.stop()
+    delivery.close()
+    if retention is not None:
+        retention.stop()
+    reaper.stop()
+    for store, key, list_cache in list_caches:
+        save_hot_users(store, key, list_cache)
 
-    updater.start_polling()
-    updater.idle()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import math
+import threading
+
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Union
+
+import events
+from events import Event, EventBus
+
+
+def normalize(title: str) -> str:
+    return title.lower().lstrip('@')
+
+
+def trigrams(title: str) -> Set[str]:
+    """
+    Возвращает множество триграмм названия. Название дополняется пробелами
+    по краям, чтобы начало и конец слова тоже давали отдельные триграммы.
+    """
+    padded = "  {} ".format(normalize(title))
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ChannelIndex:
+    """
+    Индекс названий каналов в памяти для подсказок "возможно, вы имели
+    в виду ..." при опечатках в /add.
+
+    Для нечеткого поиска используется инвертированный индекс по триграммам
+    (кандидаты ранжируются по коэффициенту Жаккара), для поиска по началу
+    названия - отсортированный список нормализованных названий.
+    """
+
+    def __init__(self, min_similarity: float = 0.4):
+        self.min_similarity = min_similarity
+
+        self._titles = {}  # type: Dict[int, str]
+        self._grams = {}  # type: Dict[int, Set[str]]
+        self._postings = defaultdict(set)  # type: Dict[str, Set[int]]
+        self._sorted = []  # type: List[tuple]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._titles)
+
+    def attach(self, bus: EventBus):
+        """
+        Подписывает индекс на события хранилища о создании и удалении каналов.
+        """
+        bus.subscribe(events.CHANNEL_CREATED, self._on_channel_created)
+        bus.subscribe(events.CHANNEL_DELETED, self._on_channel_deleted)
+
+    def _on_channel_created(self, event: Event):
+        self.add(event.data["channel_id"], event.data["title"])
+
+    def _on_channel_deleted(self, event: Event):
+        self.remove(event.data["channel_id"])
+
+    def load(self, channels: Iterable):
+        """
+        Заполняет индекс объектами Channel (например, из Store.get_channels()).
+        """
+        for chan in channels:
+            self.add(chan.id, chan.title)
+
+    def add(self, channel_id: int, title: str):
+        """
+        Добавляет канал в индекс. Повторное добавление того же канала ничего
+        не меняет.
+        """
+        with self._lock:
+            if self._titles.get(channel_id) == title:
+                return
+            self._remove(channel_id)
+            grams = trigrams(title)
+            self._titles[channel_id] = title
+            self._grams[channel_id] = grams
+            for gram in grams:
+                self._postings[gram].add(channel_id)
+            insort(self._sorted, (normalize(title), channel_id))
+
+    def remove(self, channel_id: int):
+        with self._lock:
+            self._remove(channel_id)
+
+    def _remove(self, channel_id: int):
+        title = self._titles.pop(channel_id, None)
+        if title is None:
+            return
+        for gram in self._grams.pop(channel_id):
+            ids = self._postings[gram]
+            ids.discard(channel_id)
+            if not ids:
+                del self._postings[gram]
+        key = (normalize(title), channel_id)
+        i = bisect_left(self._sorted, key)
+        if i < len(self._sorted) and self._sorted[i] == key:
+            del self._sorted[i]
+
+    def find(self, title: str) -> Union[str, None]:
+        """
+        Возвращает название известного канала, которое совпадает с
+        переданным без учета регистра (юзернеймы в Телеграме к регистру не
+        чувствительны), или None.
+        """
+        norm = normalize(title)
+        with self._lock:
+            i = bisect_left(self._sorted, (norm,))
+            if i < len(self._sorted) and self._sorted[i][0] == norm:
+                return self._titles[self._sorted[i][1]]
+            return None
+
+    def with_prefix(self, prefix: str, limit: int = 5) -> List[str]:
+        """
+        Возвращает названия каналов, начинающиеся с переданной строки.
+        """
+        prefix = normalize(prefix)
+        with self._lock:
+            found = []
+            i = bisect_left(self._sorted, (prefix,))
+            while i < len(self._sorted) and len(found) < limit:
+                norm, channel_id = self._sorted[i]
+                if not norm.startswith(prefix):
+                    break
+                found.append(self._titles[channel_id])
+                i += 1
+            return found
+
+    def suggest(self, title: str, limit: int = 3) -> List[str]:
+        """
+        Возвращает до limit названий известных каналов, похожих на переданное.
+        Точные совпадения (без учета регистра) не возвращаются - их находит
+        find().
+        """
+        grams = trigrams(title)
+        norm = normalize(title)
+        with self._lock:
+            # Похожее название должно делить с искомым не меньше
+            # min_similarity * len(grams) триграмм, поэтому достаточно собрать
+            # кандидатов по самым редким триграммам, оставив за бортом столько
+            # частых, сколько кандидат может не содержать.
+            min_shared = max(
+                1, math.ceil(self.min_similarity * len(grams) - 1e-9)
+            )
+            by_rarity = sorted(
+                grams, key=lambda g: len(self._postings.get(g, ()))
+            )
+            candidates = set()
+            for gram in by_rarity[:len(grams) - min_shared + 1]:
+                candidates.update(self._postings.get(gram, ()))
+
+            scored = []
+            for channel_id in candidates:
+                if normalize(self._titles[channel_id]) == norm:
+                    continue
+                other = self._grams[channel_id]
+                shared = len(grams & other)
+                total = len(grams) + len(other) - shared
+                similarity = shared / total
+                if similarity >= self.min_similarity:
+                    scored.append((-similarity, self._titles[channel_id]))
+
+            scored.sort()
+            suggestions = []
+            for _, suggestion in scored:
+                if suggestion not in suggestions:
+                    suggestions.append(suggestion)
+                if len(suggestions) == limit:
+                    break
+            return suggestions
@@ -37,9 +37,150 @@ consts = {
   },
   "help_msg_text": {
     "en": "/{} – get usage reference.\n"
-          "/{} @channel_name – add Telegram channel.\n",
+          "/{} @channel_name – add Telegram channel.\n"
+          "/{} @channel_name – remove Telegram channel.\n"
+          "/{} – list your channels.\n"
+          "/{} – popular channels.\n"
+          "/{} @channel_name +word -word – receive only posts with "
+          "(or without) these words.\n"
+          "/{} words – search posts of your channels.\n"
+          "/{} 23:00-08:00 +3 – don't send posts at night (off to disable).\n"
+          "/{} hourly|daily|off – receive posts as a digest.\n",
     "ru": "/{} – получить справку.\n"
-          "/{} @имя_канала – добавить Телеграм-канал.\n",
+          "/{} @имя_канала – добавить Телеграм-канал.\n"
+          "/{} @имя_канала – удалить Телеграм-канал.\n"
+          "/{} – список ваших каналов.\n"
+          "/{} – популярные каналы.\n"
+          "/{} @имя_канала +слово -слово – получать только посты с "
+          "этими словами (или без них).\n"
+          "/{} слова – поиск по постам ваших каналов.\n"
+          "/{} 23:00-08:00 +3 – не присылать посты ночью (off – отключить).\n"
+          "/{} hourly|daily|off – получать посты дайджестом.\n",
+  },
+  "no_subscriptions": {
+    "en": "You have no channels yet.",
+    "ru": "У вас пока нет каналов.",
+  },
+  "subscriptions_page": {
+    "en": "Your channels (page {}):\n{}",
+    "ru": "Ваши каналы (страница {}):\n{}",
+  },
+  "prev_page": {
+    "en": "« Back",
+    "ru": "« Назад",
+  },
+  "next_page": {
+    "en": "Next »",
+    "ru": "Далее »",
+  },
+  "top_channels": {
+    "en": "Popular channels:\n{}",
+    "ru": "Популярные каналы:\n{}",
+  },
+  "top_channel_line": {
+    "en": "{}. {} – {} subscribers",
+    "ru": "{}. {} – подписчиков: {}",
+  },
+  "no_top_channels": {
+    "en": "Nobody has subscribed to any channel yet.",
+    "ru": "Пока никто не подписался ни на один канал.",
+  },
+  "did_you_mean": {
+    "en": "Did you mean {}?\n"
+          "If not, send /{} {} once again to add it anyway.",
+    "ru": "Возможно, вы имели в виду {}?\n"
+          "Если нет, отправьте /{} {} еще раз, чтобы все равно добавить его.",
+  },
+  "filter_usage": {
+    "en": "Usage: /{} @channel_name +word -word\n"
+          "Each word should start with '+' or '-'.",
+    "ru": "Использование: /{} @имя_канала +слово -слово\n"
+          "Каждое слово должно начинаться с '+' или '-'.",
+  },
+  "filters_set": {
+    "en": "Filters for {} have been set: {}",
+    "ru": "Для канала {} установлены фильтры: {}",
+  },
+  "filters_cleared": {
+    "en": "Filters for {} have been removed.",
+    "ru": "Фильтры для канала {} сброшены.",
+  },
+  "search_query_is_empty": {
+    "en": "Usage: /{} words to search",
+    "ru": "Использование: /{} слова для поиска",
+  },
+  "search_nothing_found": {
+    "en": "Nothing found.",
+    "ru": "Ничего не найдено.",
+  },
+  "search_results": {
+    "en": "Found posts:\n{}",
+    "ru": "Найденные посты:\n{}",
+  },
+  "slow_down": {
+    "en": "Too many commands. Please slow down and try again in a few seconds.",
+    "ru": "Слишком много команд. Подождите несколько секунд и попробуйте снова.",
+  },
+  "start_required": {
+    "en": "Please send /{} first.",
+    "ru": "Сначала отправьте команду /{}.",
+  },
+  "quiet_usage": {
+    "en": "Usage: /{} 23:00-08:00 [UTC offset, e.g. +3] or /{} off",
+    "ru": "Использование: /{} 23:00-08:00 [смещение от UTC, например +3] "
+          "или /{} off",
+  },
+  "quiet_set": {
+    "en": "Posts won't be sent from {} to {} (UTC{}).",
+    "ru": "Посты не будут приходить с {} до {} (UTC{}).",
+  },
+  "quiet_cleared": {
+    "en": "Quiet hours are disabled.",
+    "ru": "Тихие часы отключены.",
+  },
+  "digest_usage": {
+    "en": "Usage: /{} hourly|daily|off",
+    "ru": "Использование: /{} hourly|daily|off",
+  },
+  "digest_set": {
+    "en": "Posts will be sent as a digest: {}.",
+    "ru": "Посты будут приходить дайджестом: {}.",
+  },
+  "digest_cleared": {
+    "en": "Posts will be sent as soon as they appear.",
+    "ru": "Посты будут приходить сразу после публикации.",
+  },
+  "profile_usage": {
+    "en": "Usage: /{} seconds (at most {})",
+    "ru": "Использование: /{} секунды (не больше {})",
+  },
+  "profiling_started": {
+    "en": "Profiling for {} s…",
+    "ru": "Профилирование на {} с…",
+  },
+  "profiling_busy": {
+    "en": "Profiling is already running.",
+    "ru": "Профилирование уже запущено.",
+  },
+  "profiling_done": {
+    "en": "Profiling is done:\n{}",
+    "ru": "Профилирование завершено:\n{}",
+  },
+  "post_header": {
+    "en": "<b>@{}</b>\n\n",
+    "ru": "<b>@{}</b>\n\n",
+  },
+  "open_post": {
+    "en": "Open post",
+    "ru": "Открыть пост",
+  },
+  "post_link": {
+    "en": "Here is the post: {}",
+    "ru": "Пост: {}",
+  },
+  "post_not_found": {
+    "en": "This post is no longer available.",
+    "ru": "Этот пост больше недоступен.",
   }
 }
 
@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 
 import os
+import json
+import time
+import threading
 import sqlalchemy
 
-from typing import Union, List, Dict, Any
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Union
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy import create_engine, exists, and_
+from sqlalchemy.orm import relationship, sessionmaker, configure_mappers
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, exists, and_, or_, func, select, event
+
+import events
+from events import Event, EventBus
 
 Base = declarative_base()
 
@@ -19,17 +27,39 @@ class User(Base):
     nickname = Column(String, unique=True)
     tg_id = Column(Integer, unique=True)
     subscriptions = relationship("Subscription", cascade="all,delete")
+    # Настройки доставки (см. модуль deferred): тихие часы в минутах от
+    # начала суток по местному времени, смещение местного времени от UTC в
+    # минутах и режим дайджеста ("hourly", "daily" или None).
+    quiet_from = Column(Integer, nullable=True)
+    quiet_to = Column(Integer, nullable=True)
+    utc_offset = Column(Integer, nullable=False, default=0, server_default='0')
+    digest = Column(String(10), nullable=True)
+    # ID бота, через которого пользователь начал работу (см.
+    # hosting.bot_id()); посты ему рассылаются от имени этого бота. NULL -
+    # первый бот процесса.
+    bot_id = Column(String(20), nullable=True)
 
     def __repr__(self):
         return f"<User(id={self.id} nickname='{self.nickname}')>"
 
 
+DELIVERY_PREFS = ("quiet_from", "quiet_to", "utc_offset", "digest")
+
+
+def delivery_prefs(user: User) -> Dict[str, Any]:
+    return {name: getattr(user, name) for name in DELIVERY_PREFS}
+
+
 class Channel(Base):
     __tablename__ = 'channels'
 
     id = Column(Integer, primary_key=True)
     title = Column(String(500), nullable=False)
     tg_id = Column(Integer, unique=True)
+    # Счетчик подписчиков, который обновляется в тех же транзакциях, что и
+    # таблица subs. Нужен, чтобы не делать COUNT(*) ... GROUP BY по subs.
+    subs_count = Column(Integer, nullable=False, default=0, server_default='0',
+                        index=True)
 
     def __repr__(self):
         return f"<Channel(id={self.id}, title='{self.title}')>"
@@ -39,8 +69,12 @@ class Subscription(Base):
     __tablename__ = 'subs'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
-    channel_id = Column(Integer, ForeignKey('channels.id', ondelete='CASCADE'))
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                     index=True)
+    channel_id = Column(Integer, ForeignKey('channels.id', ondelete='CASCADE'),
+                        index=True)
+    # Фильтры по ключевым словам вида "+слово -слово" (см. модуль kwfilter).
+    filters = Column(String(1000), nullable=True)
 
     channel = relationship("Channel", cascade="all,delete")
     user = relationship("User", cascade="all,delete")
@@ -49,32 +83,219 @@ class Subscription(Base):
         return f"<Subscription(id={self.id})>"
 
 
+class OutboxEvent(Base):
+    __tablename__ = 'outbox'
+
+    id = Column(Integer, primary_key=True)
+    type = Column(String(100), nullable=False)
+    data = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<OutboxEvent(id={self.id}, type='{self.type}')>"
+
+
+class BotState(Base):
+    __tablename__ = 'bot_state'
+
+    key = Column(String(100), primary_key=True)
+    value = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return f"<BotState(key='{self.key}')>"
+
+
+_engine = None
+_Session = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """
+    Возвращает общий для процесса движок SQLAlchemy (и его пул
+    соединений), создавая его при первом обращении.
+    """
+    global _engine, _Session
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(os.getenv("DB_URL", None), echo=True)
+            _Session = sessionmaker(bind=_engine)
+        return _engine
+
+
+def track_query_time(callback: Callable[[float], None],
+                     engine: sqlalchemy.engine.Engine = None):
+    """
+    Вызывает callback со временем выполнения (в секундах) каждого запроса
+    к БД через engine (по умолчанию - общий движок процесса).
+    """
+    engine = engine or get_engine()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault("query_started", []).append(time.monotonic())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context,
+                      executemany):
+        started = conn.info["query_started"].pop()
+        callback(time.monotonic() - started)
+
+
+def preconnect(connections: int = 5) -> int:
+    """
+    Заранее открывает соединения пула, чтобы первые запросы после старта
+    не ждали установки соединений с БД, и настраивает мапперы ORM, что
+    иначе происходит при первом запросе.
+    :param connections: сколько соединений открыть одновременно (имеет
+    смысл не больше pool_size движка).
+    :return: количество открытых соединений.
+    """
+    engine = get_engine()
+    configure_mappers()
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(engine.connect())
+    finally:
+        # Закрытые соединения возвращаются в пул и остаются открытыми.
+        for conn in opened:
+            conn.close()
+    return len(opened)
+
+
 class Store:
-    def __init__(self, session=None):
+    def __init__(self, session=None, bus: EventBus = None, outbox: bool = False):
+        """
+        :param session: сессия SQLAlchemy; если не передана - создается новая.
+        :param bus: шина, в которую после коммита публикуются события об
+        изменениях (см. модуль events).
+        :param outbox: если True, события дополнительно записываются в таблицу
+        outbox в той же транзакции, что и сами изменения.
+        """
         self._session = session or self._create_session()
+        self._bus = bus
+        self._outbox = outbox
+        self._pending_events = []  # type: List[Event]
+        # Глубина вложенности открытых блоков transaction().
+        self._depth = 0
 
     @staticmethod
     def _create_session() -> sqlalchemy.orm.session.Session:
         """
         Создает и возвращает объект сессии, через который можно производить
-        взаимодействие с БД.
+        взаимодействие с БД. Все сессии процесса используют один пул
+        соединений (см. get_engine()).
         :return: sqlalchemy.orm.session.Session
         """
-        db_url = os.getenv("DB_URL", None)
-        engine = create_engine(db_url, echo=True)
-        Session = sessionmaker(bind=engine)
-        return Session()
+        get_engine()
+        return _Session()
 
-    def session(self) -> sqlalchemy.orm.session.Session:
+    def _get_session(self) -> sqlalchemy.orm.session.Session:
         if not self._session or not self._session.is_active:
             self._session = self._create_session()
         return self._session
 
+    @property
+    def bus(self) -> Union[EventBus, None]:
+        return self._bus
+
+    def _events_enabled(self) -> bool:
+        return self._outbox or self._bus is not None
+
+    def _emit(self, event_type: str, **data):
+        """
+        Откладывает событие до ближайшего коммита. При включенном outbox
+        событие также добавляется в текущую транзакцию.
+        """
+        if not self._events_enabled():
+            return
+        if self._outbox:
+            self._get_session().add(
+                OutboxEvent(type=event_type, data=json.dumps(data))
+            )
+        self._pending_events.append(Event(event_type, data))
+
+    def _publish_pending(self):
+        pending, self._pending_events = self._pending_events, []
+        if self._bus is None:
+            return
+        for event in pending:
+            self._bus.publish(event)
+
     def save(self):
         """
-        Применяет изменения, которые были произведены с объектами данных.
+        Применяет изменения, которые были произведены с объектами данных,
+        и публикует накопленные события. Внутри transaction() изменения
+        только отправляются в БД (flush), а коммит откладывается до выхода
+        из блока.
+        """
+        if self._depth:
+            self._get_session().flush()
+            return
+        try:
+            self._get_session().commit()
+        except BaseException:
+            self._pending_events = []
+            raise
+        self._publish_pending()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Выполняет блок как одну транзакцию: методы, изменяющие данные, не
+        коммитят каждый сам по себе, а изменения сохраняются одним коммитом
+        при выходе из блока. Вложенные блоки входят во внешнюю транзакцию;
+        исключение в любом из них откатывает ее целиком.
+        """
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            self._get_session().rollback()
+            self._pending_events = []
+            raise
+        self._depth -= 1
+        if not self._depth:
+            self.save()
+
+    def get_state(self, key: str) -> Union[str, None]:
         """
-        self.session().commit()
+        Возвращает значение служебного параметра бота (например, ID
+        последнего обработанного обновления).
+        """
+        state = self._get_session().query(BotState).get(key)
+        return state.value if state is not None else None
+
+    def set_state(self, key: str, value: str):
+        """
+        Записывает значение служебного параметра бота в текущую транзакцию.
+        """
+        self._get_session().merge(BotState(key=key, value=value))
+
+    def _cascaded_subscriptions(self,
+                                column,
+                                ids: List[int]) -> Dict[int, List[Dict]]:
+        """
+        Возвращает подписки, которые будут каскадно удалены вместе с
+        пользователями или каналами, сгруппированные по их ID.
+        :param column: Subscription.user_id или Subscription.channel_id.
+        :param ids: ID удаляемых пользователей или каналов.
+        """
+        cascaded = {i: [] for i in ids}
+        if not ids:
+            return cascaded
+        rows = self._get_session().query(
+            Subscription.id, Subscription.user_id, Subscription.channel_id
+        ).filter(column.in_(ids)).all()
+        for sub_id, user_id, channel_id in rows:
+            owner = user_id if column is Subscription.user_id else channel_id
+            cascaded[owner].append(
+                {"sub_id": sub_id, "user_id": user_id, "channel_id": channel_id}
+            )
+        return cascaded
 
     def delete_user(self,
                     user_id: int = None,
@@ -96,8 +317,38 @@ class Store:
 
         if stmt is None:
             return
-        self.session().query(User).filter(stmt).delete()
+        self._delete_users(stmt)
+
+    def delete_users_bulk(self, tg_ids: List[int]) -> int:
+        """
+        Удаляет пользователей с переданными ID в Телеграме одним DELETE-запросом.
+        Подписки при этом не загружаются в сессию, а удаляются самой БД
+        по внешнему ключу с ON DELETE CASCADE.
+        :param tg_ids: ID пользователей в Телеграме.
+        :return: количество удаленных пользователей.
+        """
+        if not tg_ids:
+            return 0
+        return self._delete_users(User.tg_id.in_(tg_ids),
+                                  synchronize_session=False)
+
+    def _delete_users(self, stmt, synchronize_session='evaluate') -> int:
+        self._decrement_subs_counts(Subscription.user_id.in_(
+            select([User.id]).where(stmt)
+        ))
+        if self._events_enabled():
+            users = self._get_session().query(User.id, User.tg_id).filter(stmt).all()
+            cascaded = self._cascaded_subscriptions(
+                Subscription.user_id, [u.id for u in users]
+            )
+            for u in users:
+                self._emit(events.USER_DELETED, user_id=u.id, tg_id=u.tg_id,
+                           subscriptions=cascaded[u.id])
+        deleted = self._get_session().query(User).filter(stmt).delete(
+            synchronize_session=synchronize_session
+        )
         self.save()
+        return deleted
 
     def delete_channel(self,
                     chan_id: int = None,
@@ -119,48 +370,92 @@ class Store:
 
         if stmt is None:
             return
-        self.session().query(Channel).filter(stmt).delete()
+        if self._events_enabled():
+            chans = self._get_session().query(Channel.id, Channel.title).filter(
+                stmt
+            ).all()
+            cascaded = self._cascaded_subscriptions(
+                Subscription.channel_id, [c.id for c in chans]
+            )
+            for c in chans:
+                self._emit(events.CHANNEL_DELETED, channel_id=c.id,
+                           title=c.title, subscriptions=cascaded[c.id])
+        self._get_session().query(Channel).filter(stmt).delete()
         self.save()
 
     def delete_subscription(self, user_id: int, channel_id: int):
         """
-        Удаляет подписку, выбирая ее по одному из переданных аргументов.
+        Удаляет подписку, выбирая ее по переданным аргументам.
         :param user_id: ID пользователя в БД.
         :param channel_id: ID канала в БД.
         """
-        stmt = None
+        statements = []
         if user_id is not None:
-            stmt = Subscription.user_id == user_id
-        elif channel_id is not None:
-            stmt = Subscription.channel_id == channel_id
+            statements.append(Subscription.user_id == user_id)
+        if channel_id is not None:
+            statements.append(Subscription.channel_id == channel_id)
 
-        if stmt is None:
+        if not statements:
             return
-        self.session().query(Subscription).filter(stmt).delete()
+        query = self._get_session().query(Subscription).filter(and_(*statements))
+        self._decrement_subs_counts(and_(*statements))
+        if self._events_enabled():
+            rows = self._get_session().query(
+                Subscription.id, Subscription.user_id, Subscription.channel_id
+            ).filter(and_(*statements)).all()
+            for sub_id, sub_user_id, sub_channel_id in rows:
+                self._emit(events.SUBSCRIPTION_DELETED, sub_id=sub_id,
+                           user_id=sub_user_id, channel_id=sub_channel_id)
+        query.delete()
         self.save()
 
-    def create_user(self, tg_id: int, nickname: str = None) -> User:
+    def _decrement_subs_counts(self, sub_filter):
+        """
+        Одним UPDATE-запросом уменьшает счетчики подписчиков каналов на
+        количество подписок, подходящих под фильтр и удаляемых следом.
+        :param sub_filter: условие на таблицу subs.
+        """
+        removed = select([func.count(Subscription.id)]).where(
+            and_(Subscription.channel_id == Channel.id, sub_filter)
+        ).as_scalar()
+        affected = select([Subscription.channel_id]).where(sub_filter)
+        self._get_session().query(Channel).filter(Channel.id.in_(affected)).update(
+            {Channel.subs_count: Channel.subs_count - removed},
+            synchronize_session=False
+        )
+
+    def create_user(self,
+                    tg_id: int,
+                    nickname: str = None,
+                    bot_id: str = None) -> User:
         """
         Добавляет в БД запись о пользователе с данными, переданными в аргументах.
         :param nickname: ник пользователя.
+        :param bot_id: ID бота, через которого пользователь начал работу.
         :return: объект User c заполненными данными и его ID в БД.
         """
-        s = self.session()
-        new_user = User(nickname=nickname, tg_id=tg_id)
+        s = self._get_session()
+        new_user = User(nickname=nickname, tg_id=tg_id, bot_id=bot_id)
         s.add(new_user)
-        s.commit()
+        s.flush()
+        self._emit(events.USER_CREATED, user_id=new_user.id,
+                   tg_id=new_user.tg_id, nickname=new_user.nickname)
+        self.save()
         return new_user
 
-    def create_channel(self, title: str, tg_id: int) -> Channel:
+    def create_channel(self, title: str, tg_id: int = None) -> Channel:
         """
         Добавляет в БД запись о канале с данными, переданными в аргументах.
         :param title: название канала.
         :param tg_id: ID канала в Телеграме.
         :return: объект Channel c заполненными данными и его ID в БД.
         """
-        s = self.session()
+        s = self._get_session()
         new_chan = Channel(title=title, tg_id=tg_id)
         s.add(new_chan)
+        s.flush()
+        self._emit(events.CHANNEL_CREATED, channel_id=new_chan.id,
+                   title=new_chan.title, tg_id=new_chan.tg_id)
         self.save()
         return new_chan
 
@@ -177,12 +472,64 @@ class Store:
             raise Exception("Subscription creating error:"
                             "user_id or channel_id is None.")
 
-        s = self.session()
+        s = self._get_session()
         new_sub = Subscription(user_id=user_id, channel_id=channel_id)
         s.add(new_sub)
+        s.query(Channel).filter(Channel.id == channel_id).update(
+            {Channel.subs_count: Channel.subs_count + 1},
+            synchronize_session=False
+        )
+        s.flush()
+        self._emit(events.SUBSCRIPTION_CREATED, sub_id=new_sub.id,
+                   user_id=user_id, channel_id=channel_id)
         self.save()
         return new_sub
 
+    def set_subscription_filters(self,
+                                 user_id: int,
+                                 channel_id: int,
+                                 filters: str = None) -> bool:
+        """
+        Сохраняет фильтры по ключевым словам для подписки пользователя на канал.
+        :param user_id: ID пользователя в БД.
+        :param channel_id: ID канала в БД.
+        :param filters: строка вида "+слово -слово" или None, чтобы сбросить.
+        :return: True, если подписка найдена и обновлена.
+        """
+        updated = self._get_session().query(Subscription).filter(and_(
+            Subscription.user_id == user_id,
+            Subscription.channel_id == channel_id
+        )).update({Subscription.filters: filters or None},
+                  synchronize_session='evaluate')
+        if updated:
+            self._emit(events.SUBSCRIPTION_FILTERS_CHANGED, user_id=user_id,
+                       channel_id=channel_id, filters=filters or "")
+        self.save()
+        return updated != 0
+
+    def update_delivery_prefs(self, user_id: int, **prefs) -> bool:
+        """
+        Меняет настройки доставки пользователя.
+        :param user_id: ID пользователя в БД.
+        :param prefs: новые значения полей из DELIVERY_PREFS.
+        :return: True, если пользователь найден.
+        """
+        unknown = set(prefs) - set(DELIVERY_PREFS)
+        if unknown:
+            raise ValueError("Unknown delivery prefs: {}".format(
+                ", ".join(sorted(unknown))
+            ))
+        user = self._get_session().query(User).get(user_id)
+        if user is None:
+            return False
+        for name, value in prefs.items():
+            setattr(user, name, value)
+        self._get_session().flush()
+        self._emit(events.USER_PREFS_CHANGED, user_id=user.id,
+                   tg_id=user.tg_id, **delivery_prefs(user))
+        self.save()
+        return True
+
     def user_exists(self,
                     nickname: str = None,
                     tg_id: int = None,
@@ -195,7 +542,7 @@ class Store:
         if user_id is not None:
             statements.append(User.id == user_id)
 
-        count = self.session().query(User.id).filter(
+        count = self._get_session().query(User.id).filter(
             exists().where(and_(*statements))
         ).count()
 
@@ -213,7 +560,7 @@ class Store:
         if channel_id is not None:
             statements.append(Channel.id == channel_id)
 
-        count = self.session().query(Channel.id).filter(
+        count = self._get_session().query(Channel.id).filter(
             exists().where(and_(*statements))
         ).count()
 
@@ -229,7 +576,7 @@ class Store:
         if user_id is not None:
             statements.append(Subscription.user_id == user_id)
 
-        count = self.session().query(Subscription.id).filter(
+        count = self._get_session().query(Subscription.id).filter(
             exists().where(and_(*statements))
         ).count()
 
@@ -256,7 +603,27 @@ class Store:
         if nicknames is not None:
             statements.append(User.nickname.in_(nicknames))
 
-        return self.session().query(User).filter(and_(*statements)).all()
+        return self._get_session().query(User).filter(and_(*statements)).all()
+
+    def get_subscription_filters(self, batch_size: int = 1000) -> Iterable:
+        """
+        Возвращает потоком строки (user_id, channel_id, filters) подписок с
+        фильтрами по ключевым словам, не загружая объекты Subscription (см.
+        kwfilter.FilterIndex.load()).
+        :param batch_size: сколько строк читается из БД за раз.
+        """
+        return self._get_session().query(
+            Subscription.user_id, Subscription.channel_id, Subscription.filters
+        ).filter(Subscription.filters.isnot(None)).yield_per(batch_size)
+
+    def get_users_with_delivery_prefs(self) -> List[User]:
+        """
+        Возвращает пользователей с тихими часами или дайджестом - только их
+        доставки откладываются (см. deferred.DeliveryScheduler.load()).
+        """
+        return self._get_session().query(User).filter(
+            or_(User.quiet_from.isnot(None), User.digest.isnot(None))
+        ).all()
 
     def get_subscriptions(self,
                           sub_ids: List[int] = None,
@@ -279,7 +646,7 @@ class Store:
         if user_ids is not None:
             statements.append(Subscription.user_id.in_(user_ids))
 
-        return self.session().query(Subscription).filter(and_(*statements)).all()
+        return self._get_session().query(Subscription).filter(and_(*statements)).all()
 
     def get_channels(self,
                      chan_ids: List[int] = None,
@@ -302,7 +669,53 @@ class Store:
         if titles is not None:
             statements.append(Channel.title.in_(titles))
 
-        return self.session().query(Channel).filter(and_(*statements)).all()
+        return self._get_session().query(Channel).filter(and_(*statements)).all()
+
+    def get_user_channels(self,
+                          user_id: int,
+                          after_channel_id: int = None,
+                          limit: int = 10) -> List[Channel]:
+        """
+        Возвращает каналы, на которые подписан пользователь, упорядоченные по
+        ID. Выборка делается одним запросом с JOIN и постраничной навигацией
+        по ключу (keyset pagination) вместо OFFSET.
+        :param user_id: ID пользователя в БД.
+        :param after_channel_id: ID последнего канала предыдущей страницы.
+        :param limit: максимальное количество каналов.
+        :return: список объектов Channel.
+        """
+        query = self._get_session().query(Channel).join(
+            Subscription, Subscription.channel_id == Channel.id
+        ).filter(Subscription.user_id == user_id)
+        if after_channel_id is not None:
+            query = query.filter(Channel.id > after_channel_id)
+        return query.order_by(Channel.id).limit(limit).all()
+
+    def get_top_channels(self, limit: int = 10) -> List[Channel]:
+        """
+        Возвращает каналы с наибольшим количеством подписчиков. Запрос идет
+        по индексу на channels.subs_count и читает только limit строк.
+        :param limit: количество каналов.
+        :return: список объектов Channel по убыванию числа подписчиков.
+        """
+        return self._get_session().query(Channel).filter(
+            Channel.subs_count > 0
+        ).order_by(Channel.subs_count.desc(), Channel.id).limit(limit).all()
+
+    def get_outbox_events(self,
+                          after_id: int = 0,
+                          limit: int = 100) -> List[OutboxEvent]:
+        """
+        Возвращает события из таблицы outbox в порядке их записи. Используется
+        для доставки событий за пределы процесса и для догоняющего чтения
+        после рестарта.
+        :param after_id: ID последнего уже обработанного события.
+        :param limit: максимальное количество событий.
+        :return: список объектов OutboxEvent.
+        """
+        return self._get_session().query(OutboxEvent).filter(
+            OutboxEvent.id > after_id
+        ).order_by(OutboxEvent.id).limit(limit).all()
 
     @staticmethod
     def _prepare_args_for_multiple_select(args: List[Any],
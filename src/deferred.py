@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import time
+import heapq
+import threading
+import traceback
+
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Tuple, \
+    Union
+
+import events
+from admission import AdmissionController, BULK, ADMIT, DEFER, SHED
+from events import Event, EventBus
+
+HOURLY = "hourly"
+DAILY = "daily"
+DIGEST_MODES = (HOURLY, DAILY)
+
+# В котором часу по местному времени отправляется ежедневный дайджест.
+DAILY_DIGEST_HOUR = 9
+
+MINUTES_IN_DAY = 24 * 60
+
+TIME_RE = re.compile(r"^(\d{1,2}):(\d{2})$")
+OFFSET_RE = re.compile(r"^(?:UTC)?([+-])(\d{1,2})(?::(\d{2}))?$", re.IGNORECASE)
+
+
+def parse_time(value: str) -> int:
+    """
+    Разбирает время вида "23:30".
+    :return: количество минут от начала суток.
+    """
+    match = TIME_RE.match(value.strip())
+    if match is None:
+        raise ValueError("Bad time: {}".format(value))
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if hours > 23 or minutes > 59:
+        raise ValueError("Bad time: {}".format(value))
+    return hours * 60 + minutes
+
+
+def parse_offset(value: str) -> int:
+    """
+    Разбирает смещение от UTC вида "+3", "-05:30" или "UTC+3".
+    :return: смещение в минутах.
+    """
+    match = OFFSET_RE.match(value.strip())
+    if match is None:
+        raise ValueError("Bad UTC offset: {}".format(value))
+    sign = -1 if match.group(1) == "-" else 1
+    minutes = int(match.group(2)) * 60 + int(match.group(3) or 0)
+    if minutes > 14 * 60:
+        raise ValueError("Bad UTC offset: {}".format(value))
+    return sign * minutes
+
+
+def parse_quiet_hours(args: List[str]) -> Tuple[int, int, int]:
+    """
+    Разбирает аргументы команды /quiet: "23:00-08:00 [+3]".
+    :return: (начало, конец, смещение от UTC) в минутах.
+    """
+    if not 1 <= len(args) <= 2 or args[0].count("-") != 1:
+        raise ValueError("Bad quiet hours: {}".format(" ".join(args)))
+    start, end = args[0].split("-")
+    offset = parse_offset(args[1]) if len(args) == 2 else 0
+    quiet_from, quiet_to = parse_time(start), parse_time(end)
+    if quiet_from == quiet_to:
+        raise ValueError("Empty quiet hours: {}".format(args[0]))
+    return quiet_from, quiet_to, offset
+
+
+def format_time(minutes: int) -> str:
+    return "{:02d}:{:02d}".format(minutes // 60, minutes % 60)
+
+
+def format_offset(minutes: int) -> str:
+    sign = "-" if minutes < 0 else "+"
+    return sign + format_time(abs(minutes))
+
+
+class DeliveryPrefs(NamedTuple):
+    """
+    Настройки доставки пользователя (поля User с теми же именами).
+    """
+    quiet_from: Union[int, None] = None
+    quiet_to: Union[int, None] = None
+    utc_offset: int = 0
+    digest: Union[str, None] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DeliveryPrefs":
+        return cls(data.get("quiet_from"), data.get("quiet_to"),
+                   data.get("utc_offset") or 0, data.get("digest"))
+
+    def is_default(self) -> bool:
+        return self.quiet_from is None and self.digest is None
+
+    def _is_quiet(self, minute: int) -> bool:
+        if self.quiet_from is None:
+            return False
+        if self.quiet_from < self.quiet_to:
+            return self.quiet_from <= minute < self.quiet_to
+        return minute >= self.quiet_from or minute < self.quiet_to
+
+    def next_window(self, now: float) -> float:
+        """
+        Ближайший момент не раньше now, когда пользователю можно доставить
+        сообщения: конец тихих часов или время отправки дайджеста.
+        :param now: текущее время (unix time).
+        :return: now, если доставлять можно сразу.
+        """
+        offset = self.utc_offset * 60
+        local = now + offset
+        day_start = local - local % 86400
+
+        due = local
+        if self.digest == HOURLY:
+            due = local - local % 3600 + 3600
+        elif self.digest == DAILY:
+            due = day_start + DAILY_DIGEST_HOUR * 3600
+            if due <= local:
+                due += 86400
+
+        minute = int(due % 86400) // 60
+        if self._is_quiet(minute):
+            day_start = due - due % 86400
+            end = day_start + self.quiet_to * 60
+            if end <= due:
+                end += 86400
+            due = end
+        return due - offset
+
+
+class DeliveryScheduler:
+    """
+    Очередь отложенных доставок для пользователей с тихими часами или
+    дайджестом.
+
+    Для каждого пользователя заводится не больше одного таймера - момент
+    открытия его окна доставки; все сообщения, пришедшие до этого момента,
+    копятся в его очереди и отправляются одной пачкой. Таймеры хранятся в
+    куче с ленивым удалением устаревших записей, поэтому миллионы
+    ожидающих пользователей стоят O(log n) на операцию, а настройки
+    берутся из памяти (load() и события USER_PREFS_CHANGED), а не из БД.
+
+    С контроллером допуска (admission) планировщик также сглаживает
+    перегрузку: пока контроллер откладывает массовую доставку, сообщения
+    любого пользователя копятся так же, как в тихие часы, и уходят одной
+    пачкой через defer_delay секунд, а при сильной перегрузке или более
+    чем max_items отложенных сообщениях новые отбрасываются.
+
+    Сообщения, пришедшие пользователю, пока его пачка отправляется, уходят
+    сразу за пачкой, а не в обгон нее. Если задан path, при остановке
+    отложенные сообщения сохраняются в этот файл и загружаются из него при
+    создании планировщика.
+    """
+
+    def __init__(self,
+                 send_batch: Callable[[int, List[Any]], None],
+                 max_batches: int = 1000,
+                 clock: Callable[[], float] = time.time,
+                 admission: AdmissionController = None,
+                 defer_delay: float = 60.0,
+                 max_items: int = 1000000,
+                 path: str = None,
+                 decode: Callable[[Any], Any] = None):
+        """
+        :param send_batch: функция send_batch(tg_id, items), отправляющая
+        накопленные сообщения пользователю.
+        :param max_batches: сколько пользователей обрабатывается за один
+        вызов flush_due().
+        :param path: файл (JSON), в котором отложенные сообщения хранятся
+        между запусками.
+        :param decode: восстанавливает сообщение из его JSON-представления.
+        """
+        self.send_batch = send_batch
+        self.max_batches = max_batches
+        self._clock = clock
+        self.admission = admission
+        self.defer_delay = defer_delay
+        self.max_items = max_items
+        self.path = path
+        self.decode = decode
+
+        self._prefs = {}  # type: Dict[int, DeliveryPrefs]
+        self._pending = {}  # type: Dict[int, List[Any]]
+        self._due = {}  # type: Dict[int, float]
+        self._heap = []  # type: List[Tuple[float, int]]
+        # Пользователи, чья пачка сейчас отправляется -> сообщения, которые
+        # нужно отправить сразу за ней.
+        self._flushing = {}  # type: Dict[int, List[Any]]
+        self._items = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if path is not None:
+            self._load_pending()
+
+    def _load_pending(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            pending = json.load(f)
+        for tg_id, due, items in pending:
+            if self.decode is not None:
+                items = [self.decode(item) for item in items]
+            self._pending[tg_id] = items
+            self._items += len(items)
+            self._schedule(tg_id, due)
+
+    def save(self):
+        """
+        Сохраняет отложенные сообщения в path (вызывается из stop()).
+        """
+        with self._lock:
+            pending = [[tg_id, self._due[tg_id], items]
+                       for tg_id, items in self._pending.items()]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(pending, f)
+        os.replace(tmp_path, self.path)
+
+    def attach(self, bus: EventBus):
+        """
+        Подписывает планировщик на изменения настроек и удаление
+        пользователей.
+        """
+        bus.subscribe(events.USER_PREFS_CHANGED, self._on_prefs_changed)
+        bus.subscribe(events.USER_DELETED, self._on_user_deleted)
+
+    def _on_prefs_changed(self, event: Event):
+        self.set_prefs(event.data["tg_id"], DeliveryPrefs.from_dict(event.data))
+
+    def _on_user_deleted(self, event: Event):
+        self.forget(event.data["tg_id"])
+
+    def load(self, users: Iterable):
+        """
+        Загружает настройки доставки из объектов User.
+        """
+        for user in users:
+            prefs = DeliveryPrefs(user.quiet_from, user.quiet_to,
+                                  user.utc_offset or 0, user.digest)
+            if not prefs.is_default():
+                self._prefs[user.tg_id] = prefs
+
+    def prefs(self, tg_id: int) -> DeliveryPrefs:
+        return self._prefs.get(tg_id, DeliveryPrefs())
+
+    def set_prefs(self, tg_id: int, prefs: DeliveryPrefs):
+        """
+        Меняет настройки пользователя и переносит его таймер, если у него
+        есть отложенные сообщения.
+        """
+        with self._lock:
+            if prefs.is_default():
+                self._prefs.pop(tg_id, None)
+            else:
+                self._prefs[tg_id] = prefs
+            if tg_id in self._pending:
+                self._schedule(tg_id, prefs.next_window(self._clock()))
+
+    def forget(self, tg_id: int):
+        with self._lock:
+            self._prefs.pop(tg_id, None)
+            self._items -= len(self._pending.pop(tg_id, ()))
+            self._due.pop(tg_id, None)
+            if tg_id in self._flushing:
+                self._items -= len(self._flushing[tg_id])
+                self._flushing[tg_id] = []
+
+    def _schedule(self, tg_id: int, due: float):
+        self._due[tg_id] = due
+        heapq.heappush(self._heap, (due, tg_id))
+
+    def submit(self, tg_id: int, item: Any, now: float = None) -> bool:
+        """
+        Решает, когда доставить сообщение пользователю.
+        :return: True, если сообщение нужно отправить сразу; иначе оно
+        отложено до открытия окна доставки или отброшено из-за перегрузки
+        (учитывается в admission).
+        """
+        now = self._clock() if now is None else now
+        decision = ADMIT
+        if self.admission is not None:
+            decision = self.admission.decide(BULK)
+        send_now = False
+        with self._lock:
+            if self._items >= self.max_items:
+                decision = SHED
+            if decision != SHED and tg_id in self._flushing:
+                self._flushing[tg_id].append(item)
+                self._items += 1
+            elif decision != SHED:
+                if tg_id not in self._pending:
+                    prefs = self._prefs.get(tg_id)
+                    due = now if prefs is None else prefs.next_window(now)
+                    if due <= now and decision == DEFER:
+                        due = now + self.defer_delay
+                    if due <= now:
+                        send_now = True
+                    else:
+                        self._pending[tg_id] = []
+                        self._schedule(tg_id, due)
+                if not send_now:
+                    self._pending[tg_id].append(item)
+                    self._items += 1
+        if self.admission is not None:
+            self.admission.count(BULK, decision)
+        return send_now
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def pending_items(self) -> int:
+        """
+        Сколько сообщений всего ждет отправки.
+        """
+        return self._items
+
+    def next_due(self) -> Union[float, None]:
+        with self._lock:
+            while self._heap and \
+                    self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now: float) -> List[Tuple[int, List[Any]]]:
+        batches = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and \
+                    len(batches) < self.max_batches:
+                due, tg_id = heapq.heappop(self._heap)
+                if self._due.get(tg_id) != due:
+                    continue
+                del self._due[tg_id]
+                items = self._pending.pop(tg_id)
+                self._items -= len(items)
+                self._flushing[tg_id] = []
+                batches.append((tg_id, items))
+        return batches
+
+    def _finish_flush(self, tg_id: int) -> List[Any]:
+        """
+        :return: сообщения, пришедшие во время отправки пачки; если их нет,
+        пользователь больше не считается отправляемым.
+        """
+        with self._lock:
+            items = self._flushing.pop(tg_id)
+            self._items -= len(items)
+            if items:
+                self._flushing[tg_id] = []
+            return items
+
+    def flush_due(self, now: float = None) -> int:
+        """
+        Отправляет накопленные сообщения пользователям, чье окно доставки
+        уже открылось.
+        :return: количество пользователей, которым отправлены сообщения.
+        """
+        now = self._clock() if now is None else now
+        flushed = 0
+        while True:
+            batches = self._pop_due(now)
+            for tg_id, items in batches:
+                while items:
+                    try:
+                        self.send_batch(tg_id, items)
+                    except Exception as e:
+                        print("Error in DeliveryScheduler.send_batch() for "
+                              "{}: {}\n{}".format(tg_id, str(e),
+                                                  traceback.format_exc()))
+                    items = self._finish_flush(tg_id)
+            flushed += len(batches)
+            if len(batches) < self.max_batches:
+                return flushed
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush_due()
+            except Exception as e:
+                print("Error in DeliveryScheduler.flush_due(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start(self, interval: float = 30.0):
+        """
+        Запускает фоновый поток, который раз в interval секунд отправляет
+        накопленные сообщения.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(interval,), name="delivery-scheduler",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.path is not None:
+            self.save()
@@ -0,0 +1,618 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import time
+import struct
+import threading
+import traceback
+
+from array import array
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, \
+    Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Виды событий доставки. OPENED - переход пользователя по посту.
+SENT = 0
+FAILED = 1
+BLOCKED = 2
+OPENED = 3
+KIND_NAMES = {SENT: "sent", FAILED: "failed", BLOCKED: "blocked",
+              OPENED: "opened"}
+
+HOUR = 3600
+
+CHUNK_EXT = ".chunk"
+ROLLUP_EXT = ".rollup"
+
+# Заголовок чанка: сигнатура, количество событий, минимальное и
+# максимальное время события. За ним колонки подряд, от 8-байтовых к
+# 1-байтовым, чтобы каждая была выровнена по размеру своего элемента.
+CHUNK_HEADER = struct.Struct("<4sIII")
+CHUNK_MAGIC = b"DLV1"
+CHUNK_COLUMNS = (("channel", "q"), ("user", "q"), ("time", "I"), ("kind", "B"))
+
+# Заголовок свертки чанка: сигнатура и количество строк (канал, час, вид,
+# количество событий).
+ROLLUP_HEADER = struct.Struct("<4sI")
+ROLLUP_MAGIC = b"DLR1"
+ROLLUP_COLUMNS = (("channel", "q"), ("hour", "I"), ("count", "I"),
+                  ("kind", "B"))
+
+_DTYPES = {"q": "<i8", "I": "<u4", "B": "u1"}
+
+
+def _to_bytes(column: array) -> bytes:
+    if sys.byteorder != "little" and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_columns(data: bytes, offset: int, count: int,
+                  layout) -> Dict[str, Sequence[int]]:
+    """
+    Колонки из данных файла: массивы numpy без копирования, если numpy
+    установлен, иначе array.
+    """
+    columns = {}
+    for name, typecode in layout:
+        size = array(typecode).itemsize * count
+        if numpy is not None:
+            columns[name] = numpy.frombuffer(data, _DTYPES[typecode], count,
+                                             offset)
+        else:
+            column = array(typecode)
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder != "little" and column.itemsize > 1:
+                column.byteswap()
+            columns[name] = column
+        offset += size
+    return columns
+
+
+def _mask(column: Sequence[int], low: int, high: int):
+    """
+    Маска строк, у которых low <= значение < high.
+    """
+    if numpy is not None:
+        column = numpy.asarray(column)
+        return (column >= low) & (column < high)
+    return [low <= value < high for value in column]
+
+
+def _mask_in(column: Sequence[int], values) -> Any:
+    if numpy is not None:
+        return numpy.isin(numpy.asarray(column), list(values))
+    values = set(values)
+    return [value in values for value in column]
+
+
+def _and(left, right):
+    if numpy is not None:
+        return left & right
+    return [a and b for a, b in zip(left, right)]
+
+
+def _take(column: Sequence[int], mask) -> Sequence[int]:
+    if mask is None:
+        return column
+    if numpy is not None:
+        return numpy.asarray(column)[mask]
+    return [value for value, keep in zip(column, mask) if keep]
+
+
+def _group(keys: List[Sequence[int]],
+           weights: List[Sequence[int]] = None
+           ) -> Tuple[List[Sequence[int]], List[Sequence[int]]]:
+    """
+    Группирует строки по значениям колонок keys.
+    :param weights: колонки, которые суммируются по группам; без них
+    считается количество строк.
+    :return: колонки ключей групп и колонки сумм (по одной на weights).
+    """
+    if numpy is not None:
+        if not len(keys[0]):
+            return ([numpy.zeros(0, dtype=numpy.int64) for _ in keys],
+                    [numpy.zeros(0, dtype=numpy.int64)
+                     for _ in weights or [None]])
+        # Каждая колонка заменяется номерами ее различных значений, а
+        # номера объединяются в один ключ int64: сортировка одномерного
+        # массива намного быстрее, чем unique(axis=0) по строкам.
+        values = []
+        combined = numpy.zeros(len(keys[0]), dtype=numpy.int64)
+        for key in keys:
+            unique, inverse = numpy.unique(numpy.asarray(key),
+                                           return_inverse=True)
+            values.append(unique)
+            combined = combined * len(unique) + inverse.ravel()
+        groups, inverse = numpy.unique(combined, return_inverse=True)
+        inverse = inverse.ravel()
+        if weights is None:
+            sums = [numpy.bincount(inverse, minlength=len(groups))]
+        else:
+            sums = [numpy.bincount(inverse, minlength=len(groups),
+                                   weights=numpy.asarray(weight,
+                                                         dtype=numpy.float64)
+                                   ).astype(numpy.int64)
+                    for weight in weights]
+        columns = []
+        for unique in reversed(values):
+            columns.append(unique[groups % len(unique)].astype(numpy.int64))
+            groups = groups // len(unique)
+        return columns[::-1], sums
+
+    totals = {}  # type: Dict[Tuple[int, ...], List[int]]
+    weights = weights or []
+    for i, key in enumerate(zip(*keys)):
+        row = totals.get(key)
+        if row is None:
+            row = totals[key] = [0] * max(len(weights), 1)
+        if weights:
+            for j, weight in enumerate(weights):
+                row[j] += weight[i]
+        else:
+            row[0] += 1
+    return ([[key[i] for key in totals] for i in range(len(keys))],
+            [[row[j] for row in totals.values()]
+             for j in range(max(len(weights), 1))])
+
+
+def _equals(column: Sequence[int], value: int):
+    if numpy is not None:
+        return numpy.asarray(column) == value
+    return [item == value for item in column]
+
+
+def _column_bytes(typecode: str, column: Sequence[int]) -> bytes:
+    if numpy is not None and not isinstance(column, array):
+        return numpy.asarray(column, dtype=_DTYPES[typecode]).tobytes()
+    return _to_bytes(array(typecode, column))
+
+
+def _hours(times: Sequence[int]) -> Sequence[int]:
+    if numpy is not None:
+        return numpy.asarray(times) // HOUR
+    return [t // HOUR for t in times]
+
+
+class _ChunkInfo(NamedTuple):
+    path: str
+    count: int
+    min_time: int
+    max_time: int
+
+
+class DeliveryLog:
+    """
+    Колоночный журнал событий доставки (отправлено, ошибка, бот
+    заблокирован, переход) на локальном диске вместо строки в БД на каждую
+    отправку.
+
+    События копятся в памяти в массивах по колонкам и записываются чанками
+    по chunk_size событий: файл чанка - заголовок с количеством событий и
+    диапазоном времени, за которым колонки (канал, пользователь, время,
+    вид) лежат подряд в формате, который numpy читает без копирования. Рядом
+    с каждым чанком пишется его почасовая свертка (канал, час, вид,
+    количество), поэтому запросы с точностью до часа читают только свертки,
+    а по диапазону времени из заголовков пропускаются целые чанки.
+
+    В один каталог могут писать несколько процессов (например, шарды
+    доставки) - у каждого свой writer, который входит в имена файлов.
+    Агрегация векторная, если установлен numpy, иначе те же запросы
+    выполняются на array и словарях. Большие результаты возвращаются по
+    колонкам (HourlyCounts, UserEngagement).
+    """
+
+    def __init__(self, root: str, writer: str = "main",
+                 chunk_size: int = 65536):
+        self.root = root
+        self.writer = writer
+        self.chunk_size = chunk_size
+
+        self._columns = {name: array(typecode)
+                         for name, typecode in CHUNK_COLUMNS}
+        self._chunks = {}  # type: Dict[str, _ChunkInfo]
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._next_chunk = self._last_chunk_number() + 1
+        self.refresh()
+
+    def _last_chunk_number(self) -> int:
+        # У writer "shard" и "shard-1" общий префикс имен чанков.
+        pattern = re.compile(r"^{}-(\d{{10}}){}$".format(
+            re.escape(self.writer), re.escape(CHUNK_EXT)
+        ))
+        numbers = [int(match.group(1)) for match in map(pattern.match,
+                                                        os.listdir(self.root))
+                   if match is not None]
+        return max(numbers, default=0)
+
+    def __len__(self):
+        with self._lock:
+            return sum(info.count for info in self._chunks.values()) + \
+                len(self._columns["time"])
+
+    def append(self, channel_id: int, tg_id: int, kind: int,
+               timestamp: float = None):
+        """
+        Добавляет событие доставки поста канала channel_id пользователю tg_id.
+        """
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        with self._lock:
+            self._columns["channel"].append(channel_id)
+            self._columns["user"].append(tg_id)
+            self._columns["time"].append(timestamp)
+            self._columns["kind"].append(kind)
+            if len(self._columns["time"]) >= self.chunk_size:
+                self._seal()
+
+    def flush(self):
+        """
+        Записывает накопленные события в новый чанк, не дожидаясь chunk_size.
+        """
+        with self._lock:
+            if len(self._columns["time"]):
+                self._seal()
+
+    def close(self):
+        self.flush()
+
+    def _seal(self):
+        columns = self._columns
+        self._columns = {name: array(typecode)
+                         for name, typecode in CHUNK_COLUMNS}
+
+        base = os.path.join(self.root, "{}-{:010d}".format(self.writer,
+                                                           self._next_chunk))
+        self._next_chunk += 1
+        times = columns["time"]
+        header = CHUNK_HEADER.pack(CHUNK_MAGIC, len(times), min(times),
+                                   max(times))
+        # Свертка пишется первой: чанк без свертки при чтении не виден.
+        self._write(base + ROLLUP_EXT, self._rollup_bytes(columns))
+        self._write(base + CHUNK_EXT, header + b"".join(
+            _to_bytes(columns[name]) for name, _ in CHUNK_COLUMNS
+        ))
+        self._chunks[base + CHUNK_EXT] = _ChunkInfo(
+            base + CHUNK_EXT, len(times), min(times), max(times)
+        )
+
+    @staticmethod
+    def _rollup(columns: Dict[str, Sequence[int]]) -> Dict[str, Sequence[int]]:
+        (channels, hours, kinds), (counts,) = _group([
+            columns["channel"], _hours(columns["time"]), columns["kind"]
+        ])
+        return {"channel": channels, "hour": hours, "count": counts,
+                "kind": kinds}
+
+    def _rollup_bytes(self, columns: Dict[str, Sequence[int]]) -> bytes:
+        rollup = self._rollup(columns)
+        return ROLLUP_HEADER.pack(ROLLUP_MAGIC, len(rollup["count"])) + \
+            b"".join(_column_bytes(typecode, rollup[name])
+                     for name, typecode in ROLLUP_COLUMNS)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def refresh(self):
+        """
+        Перечитывает список чанков: подхватывает чанки других процессов.
+        """
+        chunks = {}
+        for name in sorted(os.listdir(self.root)):
+            if not name.endswith(CHUNK_EXT):
+                continue
+            path = os.path.join(self.root, name)
+            info = self._chunks.get(path)
+            if info is None:
+                # Чанк может удалить очистка в другом процессе.
+                try:
+                    with open(path, "rb") as f:
+                        magic, count, min_time, max_time = \
+                            CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+                except FileNotFoundError:
+                    continue
+                if magic != CHUNK_MAGIC:
+                    continue
+                info = _ChunkInfo(path, count, min_time, max_time)
+            chunks[path] = info
+        with self._lock:
+            self._chunks = chunks
+
+    def drop_before(self, timestamp: float) -> int:
+        """
+        Удаляет чанки, все события которых старше timestamp.
+        :return: количество удаленных событий.
+        """
+        with self._lock:
+            old = [info for info in self._chunks.values()
+                   if info.max_time < timestamp]
+            for info in old:
+                del self._chunks[info.path]
+        for info in old:
+            for path in (info.path, info.path[:-len(CHUNK_EXT)] + ROLLUP_EXT):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return sum(info.count for info in old)
+
+    def _chunks_between(self, start: int, end: int) -> List[_ChunkInfo]:
+        with self._lock:
+            return [info for info in self._chunks.values()
+                    if info.max_time >= start and info.min_time < end]
+
+    def _pending(self) -> Dict[str, Sequence[int]]:
+        with self._lock:
+            return {name: array(column.typecode, column)
+                    for name, column in self._columns.items()}
+
+    def _scan(self, start: int, end: int):
+        """
+        Колонки событий из чанков (и еще не записанных событий), которые
+        пересекаются с [start, end), с маской попадания в диапазон (None,
+        если в диапазон попадает весь чанк).
+        """
+        for info in self._chunks_between(start, end):
+            with open(info.path, "rb") as f:
+                data = f.read()
+            columns = _read_columns(data, CHUNK_HEADER.size, info.count,
+                                    CHUNK_COLUMNS)
+            inside = start <= info.min_time and info.max_time < end
+            yield columns, None if inside else _mask(columns["time"], start,
+                                                     end)
+        pending = self._pending()
+        yield pending, _mask(pending["time"], start, end)
+
+    def _rollups(self, start_hour: int, end_hour: int):
+        """
+        Строки сверток (и свертка еще не записанных событий) за часы
+        [start_hour, end_hour) в виде колонок.
+        """
+        for info in self._chunks_between(start_hour * HOUR, end_hour * HOUR):
+            path = info.path[:-len(CHUNK_EXT)] + ROLLUP_EXT
+            with open(path, "rb") as f:
+                data = f.read()
+            _, count = ROLLUP_HEADER.unpack_from(data)
+            columns = _read_columns(data, ROLLUP_HEADER.size, count,
+                                    ROLLUP_COLUMNS)
+            yield columns, _mask(columns["hour"], start_hour, end_hour)
+
+        columns = self._rollup(self._pending())
+        yield columns, _mask(columns["hour"], start_hour, end_hour)
+
+    def _sum_rollups(self, start: float, end: float, key_names: List[str],
+                     kinds=None):
+        start_hour = int(start) // HOUR
+        end_hour = -(-int(end) // HOUR)
+        keys = {name: [] for name in key_names}
+        counts = []
+        for columns, mask in self._rollups(start_hour, end_hour):
+            if kinds is not None:
+                mask = _and(mask, _mask_in(columns["kind"], kinds))
+            for name in key_names:
+                keys[name].append(_take(columns[name], mask))
+            counts.append(_take(columns["count"], mask))
+        return _group([_concat(keys[name]) for name in key_names],
+                      [_concat(counts)])
+
+    def sends_per_channel_hour(self,
+                               start: float,
+                               end: float,
+                               kind: int = SENT) -> "HourlyCounts":
+        """
+        Количество событий kind по каналам и часам. Границы периода
+        округляются до целых часов наружу.
+        """
+        (channels, hours), (counts,) = self._sum_rollups(
+            start, end, ["channel", "hour"], [kind]
+        )
+        if numpy is not None:
+            hours = hours * HOUR
+        else:
+            hours = [hour * HOUR for hour in hours]
+        return HourlyCounts(channels, hours, counts)
+
+    def channel_stats(self,
+                      start: float,
+                      end: float) -> Dict[int, Dict[str, Any]]:
+        """
+        Количество событий каждого вида и доля неудачных доставок по
+        каналам. Границы периода округляются до целых часов наружу.
+        :return: {ID канала: {"sent": ..., "failed": ..., "blocked": ...,
+        "opened": ..., "failure_rate": ...}}.
+        """
+        stats = {}  # type: Dict[int, Dict[str, Any]]
+        (channels, kinds), (counts,) = self._sum_rollups(
+            start, end, ["channel", "kind"]
+        )
+        for channel_id, kind, count in zip(_list(channels), _list(kinds),
+                                           _list(counts)):
+            channel = stats.setdefault(
+                channel_id, {name: 0 for name in KIND_NAMES.values()}
+            )
+            channel[KIND_NAMES[kind]] = count
+        for channel in stats.values():
+            attempts = channel["sent"] + channel["failed"] + channel["blocked"]
+            channel["failure_rate"] = \
+                (channel["failed"] + channel["blocked"]) / attempts \
+                if attempts else 0.0
+        return stats
+
+    def user_engagement(self, start: float, end: float) -> "UserEngagement":
+        """
+        Количество полученных постов и переходов по ним по пользователям за
+        период [start, end) - с точностью до секунды, по самим событиям.
+        """
+        users, sent, opened = [], [], []
+        for columns, mask in self._scan(int(start), int(end)):
+            kind_mask = _mask_in(columns["kind"], (SENT, OPENED))
+            mask = kind_mask if mask is None else _and(mask, kind_mask)
+            kinds = _take(columns["kind"], mask)
+            users.append(_take(columns["user"], mask))
+            sent.append(_equals(kinds, SENT))
+            opened.append(_equals(kinds, OPENED))
+        (users,), (sent, opened) = _group(
+            [_concat(users)], [_concat(sent), _concat(opened)]
+        )
+        return UserEngagement(users, sent, opened)
+
+
+class LogRetention:
+    """
+    Фоновое обслуживание журнала доставок: раз в interval секунд записывает
+    накопленные события процесса (переходы, которые пишет бот), подхватывает
+    чанки шардов и удаляет чанки, все события которых старше max_age секунд.
+    """
+
+    def __init__(self, log: DeliveryLog, max_age: float,
+                 clock: Callable[[], float] = time.time):
+        self.log = log
+        self.max_age = max_age
+        self.clock = clock
+        self.total_dropped = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self) -> int:
+        """
+        :return: количество удаленных событий.
+        """
+        self.log.flush()
+        self.log.refresh()
+        dropped = self.log.drop_before(self.clock() - self.max_age)
+        self.total_dropped += dropped
+        return dropped
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Error in LogRetention.run_once(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start(self, interval: float = 3600.0):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(interval,), name="delivery-log-retention",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Останавливает поток и записывает еще не записанные события.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.log.close()
+
+
+class HourlyCounts(NamedTuple):
+    """
+    Результат DeliveryLog.sends_per_channel_hour() по колонкам: ID канала,
+    начало часа (unix time) и количество событий.
+    """
+    channel_id: Sequence[int]
+    hour: Sequence[int]
+    count: Sequence[int]
+
+    def to_dict(self) -> Dict[Tuple[int, int], int]:
+        return dict(zip(zip(_list(self.channel_id), _list(self.hour)),
+                        _list(self.count)))
+
+
+class UserEngagement(NamedTuple):
+    """
+    Результат DeliveryLog.user_engagement() по колонкам: ID пользователя,
+    количество полученных постов и переходов.
+    """
+    tg_id: Sequence[int]
+    sent: Sequence[int]
+    opened: Sequence[int]
+
+    def to_dict(self) -> Dict[int, Dict[str, Any]]:
+        return {
+            tg_id: {"sent": sent, "opened": opened,
+                    "open_rate": opened / sent if sent else 0.0}
+            for tg_id, sent, opened in zip(_list(self.tg_id),
+                                           _list(self.sent),
+                                           _list(self.opened))
+        }
+
+
+def _list(column: Sequence[int]) -> List[int]:
+    return column.tolist() if hasattr(column, "tolist") else list(column)
+
+
+def _concat(parts: List[Sequence[int]]) -> Sequence[int]:
+    if numpy is not None:
+        return numpy.concatenate([numpy.asarray(part, dtype=numpy.int64)
+                                  for part in parts]) \
+            if parts else numpy.zeros(0, dtype=numpy.int64)
+    result = []  # type: List[int]
+    for part in parts:
+        result.extend(part)
+    return result
+
+
+QUERIES = ("channels", "hourly", "users")
+
+
+def main(argv: List[str] = None, out=sys.stdout):
+    """
+    Запросы к журналу доставок для операторов:
+    python deliverylog.py channels|hourly|users [часов, по умолчанию 24]
+    Каталог журнала - DELIVERY_EVENTS_DIR (как у бота). Результат - строки
+    JSON: channels - channel_stats() по каналам, hourly - отправки по
+    каналам и часам, users - user_engagement() по пользователям.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in QUERIES:
+        raise SystemExit("usage: deliverylog.py {} [hours]".format(
+            "|".join(QUERIES)
+        ))
+    hours = float(argv[1]) if len(argv) > 1 else 24.0
+    root = os.getenv("DELIVERY_EVENTS_DIR") or os.path.join(
+        os.getenv("DELIVERY_DIR", "delivery"), "events"
+    )
+    # Запись в журнал из этого процесса не идет, writer нужен только для
+    # имен файлов.
+    log = DeliveryLog(root, writer="query")
+    # Конец периода не включается - берется следующая секунда.
+    end = int(time.time()) + 1
+    start = end - hours * HOUR
+    if argv[0] == "channels":
+        rows = [dict(channel_id=channel_id, **stats) for channel_id, stats
+                in sorted(log.channel_stats(start, end).items())]
+    elif argv[0] == "hourly":
+        rows = [{"channel_id": channel_id, "hour": hour, "sent": count}
+                for (channel_id, hour), count in sorted(
+                    log.sends_per_channel_hour(start, end).to_dict().items()
+                )]
+    else:
+        rows = [dict(tg_id=tg_id, **stats) for tg_id, stats
+                in sorted(log.user_engagement(start, end).to_dict().items())]
+    for row in rows:
+        out.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
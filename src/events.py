@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import traceback
+
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple
+
+USER_CREATED = "user_created"
+USER_DELETED = "user_deleted"
+USER_PREFS_CHANGED = "user_prefs_changed"
+CHANNEL_CREATED = "channel_created"
+CHANNEL_DELETED = "channel_deleted"
+SUBSCRIPTION_CREATED = "subscription_created"
+SUBSCRIPTION_DELETED = "subscription_deleted"
+SUBSCRIPTION_FILTERS_CHANGED = "subscription_filters_changed"
+
+ALL_EVENTS = "*"
+
+
+class Event(NamedTuple):
+    """
+    Событие об изменении данных в хранилище.
+    type - одна из констант выше (USER_CREATED и т.д.),
+    data - словарь с ID и полями измененного объекта. Для событий удаления
+    пользователя/канала в data["subscriptions"] перечислены подписки,
+    удаленные каскадно вместе с ним.
+    """
+    type: str
+    data: Dict[str, Any]
+
+
+Handler = Callable[[Event], None]
+
+
+class EventBus:
+    """
+    Внутрипроцессная шина событий: хранилище публикует в нее события после
+    коммита, а кэши и индексы подписываются на нужные им типы событий и
+    обновляются инкрементально.
+    """
+
+    def __init__(self):
+        self._handlers = defaultdict(list)  # type: Dict[str, List[Handler]]
+
+    def subscribe(self, event_type: str, handler: Handler):
+        """
+        Подписывает обработчик на события указанного типа.
+        :param event_type: тип события или ALL_EVENTS для всех событий.
+        :param handler: функция, принимающая объект Event.
+        """
+        self._handlers[event_type].append(handler)
+
+    def unsubscribe(self, event_type: str, handler: Handler):
+        if handler in self._handlers.get(event_type, []):
+            self._handlers[event_type].remove(handler)
+
+    def has_subscribers(self) -> bool:
+        return any(self._handlers.values())
+
+    def publish(self, event: Event):
+        """
+        Вызывает все обработчики события. Ошибка в одном обработчике не мешает
+        остальным и не пробрасывается в код, изменивший данные.
+        """
+        handlers = self._handlers.get(event.type, []) + \
+            self._handlers.get(ALL_EVENTS, [])
+        for handler in handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                print("Error in event handler {}() for {}: {}\n{}".format(
+                    getattr(handler, "__name__", handler), event.type,
+                    str(e), traceback.format_exc()
+                ))
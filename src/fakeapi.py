@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import json
+import time
+import zlib
+import random
+import threading
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Deque, Dict, NamedTuple, Tuple, \
+    Union
+from urllib.parse import parse_qsl
+
+BOT_ID = 1000000
+
+
+class Call(NamedTuple):
+    """
+    Запись о вызове метода Bot API.
+    """
+    time: float
+    method: str
+    params: Dict[str, Any]
+    status: int
+    result: Any
+
+
+class FakeTelegram:
+    """
+    Состояние поддельного Bot API: очередь обновлений для getUpdates,
+    отправленные ботом сообщения и журнал всех вызовов.
+
+    latency - задержка ответа в секундах (число или функция без
+    аргументов), too_many_requests - доля вызовов send*, на которые
+    отвечается 429 с retry_after.
+    """
+
+    def __init__(self,
+                 latency: Union[float, Callable[[], float]] = 0.0,
+                 too_many_requests: float = 0.0,
+                 retry_after: int = 1,
+                 record_path: str = None,
+                 max_calls: int = 100000,
+                 seed: int = None):
+        self.latency = latency
+        self.too_many_requests = too_many_requests
+        self.retry_after = retry_after
+        self.record_path = record_path
+        self.webhook_url = ""
+
+        self.calls = deque(maxlen=max_calls)  # type: Deque[Call]
+        self.sent = deque(maxlen=max_calls)  # type: Deque[Dict[str, Any]]
+        self.on_send = None  # type: Callable[[Dict[str, Any]], None]
+
+        self._updates = deque()  # type: Deque[Dict[str, Any]]
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._cond = threading.Condition()
+        self._random = random.Random(seed)
+        self._record_lock = threading.Lock()
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        """
+        Ставит обновление в очередь getUpdates, присваивая ему update_id.
+        """
+        with self._cond:
+            update = dict(update, update_id=self._next_update_id)
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+            return update["update_id"]
+
+    def pending_updates(self) -> int:
+        with self._cond:
+            return len(self._updates)
+
+    def _delay(self):
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+    def call(self,
+             method: str,
+             params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """
+        Выполняет метод Bot API.
+        :return: HTTP-статус и тело ответа.
+        """
+        handler = getattr(self, "_api_" + method.lower(), None)
+        if handler is None:
+            status, body = 404, {"ok": False, "error_code": 404,
+                                 "description": "Not Found: method not found"}
+        elif method.lower().startswith("send") and \
+                self._random.random() < self.too_many_requests:
+            status, body = 429, {
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after {}".format(
+                    self.retry_after),
+                "parameters": {"retry_after": self.retry_after},
+            }
+        else:
+            if method.lower() != "getupdates":
+                self._delay()
+            status, body = 200, {"ok": True, "result": handler(params)}
+        self._record(Call(time.time(), method, params, status,
+                          body.get("result", body)))
+        return status, body
+
+    def _record(self, call: Call):
+        self.calls.append(call)
+        if self.record_path is None:
+            return
+        with self._record_lock, open(self.record_path, "a") as f:
+            f.write(json.dumps(call._asdict(), ensure_ascii=False) + "\n")
+
+    def _api_getme(self, params):
+        return {"id": BOT_ID, "is_bot": True, "first_name": "FeedBot",
+                "username": "feed_bot"}
+
+    def _api_setwebhook(self, params):
+        self.webhook_url = params.get("url", "")
+        return True
+
+    def _api_deletewebhook(self, params):
+        self.webhook_url = ""
+        return True
+
+    def _api_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._cond:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+            return list(self._updates)[:limit]
+
+    def _api_getchat(self, params):
+        chat_id = params.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.startswith("@"):
+            return {"id": -1000000000000 - zlib.crc32(chat_id.encode()),
+                    "type": "channel", "username": chat_id[1:],
+                    "title": chat_id[1:]}
+        return {"id": int(chat_id), "type": "private", "first_name": "User"}
+
+    def _message(self, params, **fields):
+        with self._cond:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        chat_id = params.get("chat_id")
+        message = dict(fields, message_id=message_id, date=int(time.time()),
+                       chat={"id": int(chat_id), "type": "private"})
+        sent = dict(params, method_time=time.time())
+        self.sent.append(sent)
+        if self.on_send is not None:
+            self.on_send(sent)
+        return message
+
+    def _api_sendmessage(self, params):
+        return self._message(params, text=params.get("text", ""))
+
+    def _api_sendphoto(self, params):
+        return self._message(params, caption=params.get("caption"), photo=[{
+            "file_id": "photo-{}".format(self._next_message_id),
+            "file_unique_id": "u{}".format(self._next_message_id),
+            "width": 1, "height": 1,
+        }])
+
+    def _api_editmessagetext(self, params):
+        return self._message(params, text=params.get("text", ""))
+
+    def _api_answercallbackquery(self, params):
+        return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _params(self) -> Dict[str, Any]:
+        params = dict(parse_qsl(self.path.partition("?")[2]))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if not body:
+            return params
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params.update(json.loads(body.decode("utf-8")))
+        else:
+            params.update(parse_qsl(body.decode("utf-8")))
+        return params
+
+    def _handle(self):
+        # Путь вида /bot<token>/<method>.
+        method = self.path.partition("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        status, body = self.server.telegram.call(method, self._params())
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP-сервер, отвечающий на запросы Bot API от имени FakeTelegram.
+    Боту нужно передать base_url (см. BOT_API_URL в bot.py).
+    """
+    daemon_threads = True
+
+    def __init__(self, telegram: FakeTelegram, address=("127.0.0.1", 0)):
+        super().__init__(address, _Handler)
+        self.telegram = telegram
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return "http://{}:{}/bot".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="fake-telegram", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
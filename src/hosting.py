@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+from typing import List, Tuple
+
+from telegram.utils.request import Request
+
+from throttle import OutboundLimiter
+
+# Методы Bot API, которые отправляют сообщения и подпадают под лимиты
+# Телеграма на исходящие сообщения.
+LIMITED_METHODS = {
+    "sendmessage", "sendphoto", "sendvideo", "sendanimation", "senddocument",
+    "sendmediagroup", "forwardmessage", "copymessage", "editmessagetext",
+}
+
+
+def parse_bot_tokens(value: str, default_lang: str) -> List[Tuple[str, str]]:
+    """
+    Разбирает список ботов из BOT_TOKENS: "token[=lang],token[=lang]".
+    :return: список пар (токен, язык).
+    """
+    bots = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        token, _, lang = item.partition("=")
+        bots.append((token.strip(), (lang.strip() or default_lang).lower()))
+    return bots
+
+
+def bot_id(token: str) -> str:
+    """
+    ID бота - часть токена до двоеточия.
+    """
+    return token.split(":", 1)[0]
+
+
+class LimitedRequest:
+    """
+    HTTP-клиент Bot API, общий для всех ботов процесса: один пул
+    соединений, а отправка сообщений каждого бота проходит через общий
+    OutboundLimiter.
+
+    Оборачивает Request, а не наследует его: объекты PTB не позволяют
+    добавлять свои атрибуты (TelegramDeprecationWarning).
+    """
+
+    def __init__(self, limiter: OutboundLimiter, request: Request = None,
+                 **kwargs):
+        """
+        :param request: клиент, через который идут запросы; без него
+        создается Request(**kwargs).
+        """
+        self.limiter = limiter
+        self.request = request if request is not None else Request(**kwargs)
+
+    @property
+    def con_pool_size(self) -> int:
+        return self.request.con_pool_size
+
+    def post(self, url: str, data, timeout: float = None):
+        # URL вида <base_url><token>/<method>.
+        head, _, method = url.rstrip("/").rpartition("/")
+        if method.lower() in LIMITED_METHODS:
+            self.limiter.acquire(bot_id(head.rsplit("/", 1)[-1]))
+        return self.request.post(url, data, timeout=timeout)
+
+    def retrieve(self, url: str, timeout: float = None) -> bytes:
+        return self.request.retrieve(url, timeout=timeout)
+
+    def download(self, url: str, filename: str, timeout: float = None):
+        self.request.download(url, filename, timeout=timeout)
+
+    def stop(self):
+        self.request.stop()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import threading
+
+from collections import deque
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
+
+import events
+from events import Event, EventBus
+
+
+def parse_filters(text: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """
+    Разбирает строку фильтров вида "+слово -слово" на множества слов, которые
+    должны и не должны встречаться в посте.
+    :raise ValueError: если слово не начинается с '+' или '-'.
+    """
+    include, exclude = set(), set()
+    for word in (text or "").split():
+        sign, word = word[0], word[1:].strip().lower()
+        if sign not in "+-" or not word:
+            raise ValueError("Filter word should start with '+' or '-'.")
+        (include if sign == "+" else exclude).add(word)
+    return frozenset(include), frozenset(exclude)
+
+
+def format_filters(include: Iterable[str], exclude: Iterable[str]) -> str:
+    return " ".join(
+        ["+" + word for word in sorted(include)] +
+        ["-" + word for word in sorted(exclude)]
+    )
+
+
+class Automaton:
+    """
+    Автомат Ахо-Корасик для поиска набора слов в тексте за один проход.
+    Совпадение засчитывается, только если слово стоит отдельно - не является
+    частью более длинного слова.
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self.words = []  # type: List[str]
+        self._goto = [{}]  # type: List[Dict[str, int]]
+        self._fail = [0]
+        self._out = [[]]  # type: List[List[int]]
+
+        for word in sorted(set(words)):
+            self._insert(word)
+        self._build_fail_links()
+
+    def _insert(self, word: str):
+        state = 0
+        for char in word:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(len(self.words))
+        self.words.append(word)
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def search(self, text: str) -> Set[str]:
+        """
+        Возвращает множество слов автомата, встречающихся в тексте.
+        """
+        text = text.lower()
+        found = set()
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for word_id in self._out[state]:
+                word = self.words[word_id]
+                start, end = i - len(word) + 1, i + 1
+                if (start == 0 or not text[start - 1].isalnum()) and \
+                        (end == len(text) or not text[end].isalnum()):
+                    found.add(word)
+        return found
+
+
+class _ChannelFilters:
+    def __init__(self):
+        self.filters = {}  # type: Dict[int, Tuple[FrozenSet, FrozenSet]]
+        self.automaton = None
+
+    def vocabulary(self) -> Set[str]:
+        words = set()
+        for include, exclude in self.filters.values():
+            words |= include | exclude
+        return words
+
+
+class FilterIndex:
+    """
+    Фильтры по ключевым словам для подписок, сгруппированные по каналам.
+
+    Все слова из фильтров подписчиков одного канала собираются в один
+    автомат, поэтому пост проверяется для всех подписчиков сразу за один
+    проход по тексту. Автомат канала перестраивается лениво и только когда в
+    фильтрах появилось слово, которого в нем еще нет.
+    """
+
+    def __init__(self):
+        self._channels = {}  # type: Dict[int, _ChannelFilters]
+        self._lock = threading.Lock()
+
+    def attach(self, bus: EventBus):
+        """
+        Подписывает индекс на события хранилища об изменении фильтров и
+        удалении подписок.
+        """
+        bus.subscribe(events.SUBSCRIPTION_FILTERS_CHANGED, self._on_changed)
+        bus.subscribe(events.SUBSCRIPTION_DELETED, self._on_deleted)
+        bus.subscribe(events.USER_DELETED, self._on_cascade)
+        bus.subscribe(events.CHANNEL_DELETED, self._on_cascade)
+
+    def _on_changed(self, event: Event):
+        self.set_filters(event.data["channel_id"], event.data["user_id"],
+                         event.data["filters"])
+
+    def _on_deleted(self, event: Event):
+        self.remove(event.data["channel_id"], event.data["user_id"])
+
+    def _on_cascade(self, event: Event):
+        for sub in event.data["subscriptions"]:
+            self.remove(sub["channel_id"], sub["user_id"])
+
+    def load(self, subscriptions: Iterable):
+        """
+        Заполняет индекс подписками - объектами с полями user_id,
+        channel_id и filters (например, из Store.get_subscription_filters()).
+        """
+        for sub in subscriptions:
+            if sub.filters:
+                self.set_filters(sub.channel_id, sub.user_id, sub.filters)
+
+    def set_filters(self, channel_id: int, user_id: int, filters: str):
+        include, exclude = parse_filters(filters)
+        if not include and not exclude:
+            self.remove(channel_id, user_id)
+            return
+
+        with self._lock:
+            channel = self._channels.setdefault(channel_id, _ChannelFilters())
+            channel.filters[user_id] = (include, exclude)
+            known = set(channel.automaton.words) if channel.automaton else set()
+            if not (include | exclude) <= known:
+                channel.automaton = None
+
+    def remove(self, channel_id: int, user_id: int):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return
+            channel.filters.pop(user_id, None)
+            if not channel.filters:
+                del self._channels[channel_id]
+
+    def has_filters(self, channel_id: int) -> bool:
+        return channel_id in self._channels
+
+    def recipients(self,
+                   channel_id: int,
+                   subscribers: Iterable[int],
+                   text: str) -> List[int]:
+        """
+        Отбирает подписчиков канала, которым нужно доставить пост.
+        Подписчики без фильтров получают все посты.
+        :param channel_id: ID канала в БД.
+        :param subscribers: ID подписчиков канала в БД.
+        :param text: текст поста.
+        :return: список ID пользователей в исходном порядке.
+        """
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return list(subscribers)
+            if channel.automaton is None:
+                channel.automaton = Automaton(channel.vocabulary())
+            filters = dict(channel.filters)
+            automaton = channel.automaton
+
+        found = automaton.search(text or "")
+        result = []
+        for user_id in subscribers:
+            user_filters = filters.get(user_id)
+            if user_filters is not None:
+                include, exclude = user_filters
+                if include and not include & found:
+                    continue
+                if exclude & found:
+                    continue
+            result.append(user_id)
+        return result
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Union
+
+import events
+from events import Event, EventBus
+
+
+class ListPage(NamedTuple):
+    number: int
+    titles: List[str]
+    has_prev: bool
+    has_next: bool
+
+
+class _UserView:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.pages = []  # type: List[List]
+        self.complete = False
+
+
+class SubscriptionListCache:
+    """
+    Кэш постраничного списка подписок пользователя для команды /list.
+
+    Страницы подгружаются из хранилища по одной (Store.get_user_channels()
+    с навигацией по ключу) и запоминаются, поэтому повторное листание не
+    обращается к БД. Представление пользователя сбрасывается при изменении
+    его подписок. Количество пользователей в кэше ограничено, давно не
+    использованные представления вытесняются (LRU).
+    """
+
+    def __init__(self, store, page_size: int = 10, max_users: int = 10000):
+        self.store = store
+        self.page_size = page_size
+        self.max_users = max_users
+
+        self._views = OrderedDict()  # type: Dict[int, _UserView]
+        self._tg_ids = {}  # type: Dict[int, int]
+        self._lock = threading.Lock()
+
+    def attach(self, bus: EventBus):
+        """
+        Подписывает кэш на события хранилища, чтобы сбрасывать представления
+        при изменениях подписок, сделанных в обход команд бота.
+        """
+        bus.subscribe(events.SUBSCRIPTION_CREATED, self._on_user_event)
+        bus.subscribe(events.SUBSCRIPTION_DELETED, self._on_user_event)
+        bus.subscribe(events.USER_DELETED, self._on_user_event)
+        bus.subscribe(events.CHANNEL_DELETED, self._on_channel_deleted)
+
+    def _on_user_event(self, event: Event):
+        self.invalidate_user_id(event.data["user_id"])
+
+    def _on_channel_deleted(self, event: Event):
+        for sub in event.data["subscriptions"]:
+            self.invalidate_user_id(sub["user_id"])
+
+    def invalidate(self, tg_id: int):
+        with self._lock:
+            view = self._views.pop(tg_id, None)
+            if view is not None:
+                self._tg_ids.pop(view.user_id, None)
+
+    def invalidate_user_id(self, user_id: int):
+        with self._lock:
+            tg_id = self._tg_ids.pop(user_id, None)
+            if tg_id is not None:
+                self._views.pop(tg_id, None)
+
+    def _get_view(self, tg_id: int, store) -> Union[_UserView, None]:
+        view = self._views.get(tg_id)
+        if view is not None:
+            self._views.move_to_end(tg_id)
+            return view
+
+        user = store.get_user(tg_id=tg_id)
+        if user is None:
+            return None
+
+        view = _UserView(user.id)
+        self._views[tg_id] = view
+        self._tg_ids[user.id] = tg_id
+        if len(self._views) > self.max_users:
+            _, evicted = self._views.popitem(last=False)
+            self._tg_ids.pop(evicted.user_id, None)
+        return view
+
+    def _load_next_page(self, view: _UserView, store):
+        after = view.pages[-1][-1][0] if view.pages else None
+        channels = store.get_user_channels(
+            view.user_id, after, self.page_size + 1
+        )
+        page = [(chan.id, chan.title) for chan in channels[:self.page_size]]
+        view.complete = len(channels) <= self.page_size
+        if page:
+            view.pages.append(page)
+
+    def get_page(self, tg_id: int, number: int = 0) -> Union[ListPage, None]:
+        """
+        Возвращает страницу списка подписок пользователя. Если запрошенной
+        страницы нет, возвращается последняя.
+        :param tg_id: ID пользователя в Телеграме.
+        :param number: номер страницы, начиная с 0.
+        :return: объект ListPage или None, если пользователь не найден.
+        """
+        number = max(number, 0)
+        with self._lock:
+            view = self._get_view(tg_id, self.store)
+            if view is None:
+                return None
+
+            while len(view.pages) <= number and not view.complete:
+                self._load_next_page(view, self.store)
+
+            if not view.pages:
+                return ListPage(0, [], False, False)
+
+            number = min(number, len(view.pages) - 1)
+            has_next = number + 1 < len(view.pages) or not view.complete
+            return ListPage(
+                number,
+                [title for _, title in view.pages[number]],
+                number > 0,
+                has_next,
+            )
+
+    def hot_users(self, limit: int = None) -> List[int]:
+        """
+        Возвращает ID в Телеграме пользователей, чьи списки есть в кэше,
+        начиная с недавно использованных. Сохраняется при остановке бота,
+        чтобы после рестарта прогреть кэш (см. warm()).
+        """
+        with self._lock:
+            tg_ids = list(reversed(self._views))
+        return tg_ids[:limit] if limit is not None else tg_ids
+
+    def warm(self, tg_ids: Iterable[int], store=None) -> int:
+        """
+        Загружает в кэш первые страницы списков пользователей.
+        :param tg_ids: ID пользователей, начиная с самых активных.
+        :param store: хранилище для загрузки. Прогрев идет в фоне, пока бот
+        уже отвечает на команды, поэтому ему нужна своя сессия БД.
+        :return: количество загруженных пользователей.
+        """
+        store = store or self.store
+        loaded = 0
+        # Загрузка от менее активных к более активным, чтобы последние
+        # вытеснялись из LRU последними.
+        for tg_id in reversed(list(tg_ids)[:self.max_users]):
+            with self._lock:
+                if tg_id in self._views:
+                    continue
+                view = self._get_view(tg_id, store)
+                if view is None:
+                    continue
+                self._load_next_page(view, store)
+            loaded += 1
+        return loaded
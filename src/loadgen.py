@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+import os
+import time
+import random
+import threading
+
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, NamedTuple, Set
+
+from fakeapi import FakeTelegram, FakeTelegramServer
+
+START_CMD = "/start"
+ADD_CMD = "/add"
+DEL_CMD = "/del"
+
+# Доли команд в потоке обновлений от пользователей.
+DEFAULT_MIX = {START_CMD: 0.1, ADD_CMD: 0.6, DEL_CMD: 0.3}
+
+FIRST_USER_ID = 100000
+FIRST_CHANNEL_ID = -1001000000000
+
+
+class LoadReport(NamedTuple):
+    commands: int
+    posts: int
+    replies: int
+    duration: float
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+    def format(self) -> str:
+        return ("commands={} posts={} replies={} duration={:.1f}s "
+                "throughput={:.1f}/s latency p50={:.1f}ms p95={:.1f}ms "
+                "p99={:.1f}ms max={:.1f}ms").format(
+            self.commands, self.posts, self.replies, self.duration,
+            self.throughput, self.p50 * 1000, self.p95 * 1000,
+            self.p99 * 1000, self.max * 1000
+        )
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Перцентиль q (от 0 до 100) отсортированного списка значений.
+    """
+    if not values:
+        return 0.0
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class LoadGenerator:
+    """
+    Генерирует поток обновлений для FakeTelegram с заданной частотой:
+    команды пользователей (/start, /add, /del в пропорциях mix) и посты
+    каналов (доля post_share). Популярность каналов распределена по закону
+    Ципфа, /del удаляет один из ранее добавленных пользователем каналов.
+
+    Задержка команды - время от постановки обновления в очередь до первого
+    ответа бота в тот же чат.
+    """
+
+    def __init__(self,
+                 telegram: FakeTelegram,
+                 users: int = 1000,
+                 channels: int = 100,
+                 mix: Dict[str, float] = None,
+                 post_share: float = 0.2,
+                 seed: int = None):
+        self.telegram = telegram
+        self.users = users
+        self.channels = channels
+        self.mix = mix or DEFAULT_MIX
+        self.post_share = post_share
+
+        self._random = random.Random(seed)
+        self._channel_weights = [1 / (i + 1) for i in range(channels)]
+        self._started = set()  # type: Set[int]
+        self._added = defaultdict(list)  # type: Dict[int, List[str]]
+        self._post_ids = defaultdict(int)  # type: Dict[int, int]
+
+        self._waiting = defaultdict(deque)  # type: Dict[int, Deque[float]]
+        self._latencies = []  # type: List[float]
+        self._lock = threading.Lock()
+        telegram.on_send = self._on_send
+
+    def _on_send(self, params: Dict[str, Any]):
+        now = time.monotonic()
+        try:
+            chat_id = int(params.get("chat_id"))
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            waiting = self._waiting.get(chat_id)
+            if waiting:
+                self._latencies.append(now - waiting.popleft())
+
+    def _channel_name(self, index: int) -> str:
+        return "@loadtest_channel_{}".format(index)
+
+    def _command(self, user_id: int) -> str:
+        if user_id not in self._started:
+            self._started.add(user_id)
+            return START_CMD
+
+        commands = list(self.mix)
+        command = self._random.choices(
+            commands, weights=[self.mix[c] for c in commands]
+        )[0]
+        added = self._added[user_id]
+        if command == DEL_CMD and added:
+            return "{} {}".format(DEL_CMD, added.pop(
+                self._random.randrange(len(added))
+            ))
+        if command == START_CMD:
+            return START_CMD
+
+        index = self._random.choices(range(self.channels),
+                                     weights=self._channel_weights)[0]
+        added.append(self._channel_name(index))
+        return "{} {}".format(ADD_CMD, added[-1])
+
+    def command_update(self) -> Dict[str, Any]:
+        user_id = FIRST_USER_ID + self._random.randrange(self.users)
+        text = self._command(user_id)
+        command = text.split(" ", 1)[0]
+        return {"message": {
+            "message_id": self._random.randrange(1, 2 ** 31),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False,
+                     "first_name": "User{}".format(user_id),
+                     "username": "user{}".format(user_id)},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0,
+                          "length": len(command)}],
+        }}
+
+    def post_update(self) -> Dict[str, Any]:
+        index = self._random.choices(range(self.channels),
+                                     weights=self._channel_weights)[0]
+        chat_id = FIRST_CHANNEL_ID - index
+        self._post_ids[chat_id] += 1
+        return {"channel_post": {
+            "message_id": self._post_ids[chat_id],
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "channel",
+                     "username": self._channel_name(index)[1:]},
+            "text": "Post {} of {}".format(self._post_ids[chat_id],
+                                           self._channel_name(index)),
+        }}
+
+    def run(self,
+            rate: float,
+            duration: float,
+            drain_timeout: float = 10.0) -> LoadReport:
+        """
+        Подает обновления с частотой rate в секунду в течение duration
+        секунд, затем ждет ответов на команды не дольше drain_timeout.
+        """
+        commands = posts = 0
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - started >= duration:
+                break
+            # Равномерный темп: следующее обновление ставится в момент
+            # started + (commands + posts) / rate.
+            delay = started + (commands + posts) / rate - now
+            if delay > 0:
+                time.sleep(delay)
+            if self._random.random() < self.post_share:
+                self.telegram.push_update(self.post_update())
+                posts += 1
+                continue
+            update = self.command_update()
+            with self._lock:
+                self._waiting[update["message"]["chat"]["id"]].append(
+                    time.monotonic()
+                )
+            self.telegram.push_update(update)
+            commands += 1
+
+        deadline = time.monotonic() + drain_timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if len(self._latencies) >= commands:
+                    break
+            time.sleep(0.01)
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            latencies = sorted(self._latencies)
+        return LoadReport(
+            commands=commands,
+            posts=posts,
+            replies=len(latencies),
+            duration=elapsed,
+            throughput=len(latencies) / elapsed if elapsed else 0.0,
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            max=latencies[-1] if latencies else 0.0,
+        )
+
+
+if __name__ == "__main__":
+    # Запускает поддельный Bot API и подает в него нагрузку. Бот
+    # запускается отдельно с BOT_API_URL, напечатанным ниже.
+    telegram = FakeTelegram(
+        latency=float(os.getenv("FAKE_API_LATENCY", "0.05")),
+        too_many_requests=float(os.getenv("FAKE_API_429_SHARE", "0")),
+        record_path=os.getenv("FAKE_API_RECORD") or None,
+    )
+    server = FakeTelegramServer(
+        telegram, ("127.0.0.1", int(os.getenv("FAKE_API_PORT", "8081")))
+    )
+    server.start()
+    print("BOT_API_URL={}".format(server.base_url))
+    input("Start the bot and press Enter to begin the load test...")
+
+    generator = LoadGenerator(telegram,
+                              users=int(os.getenv("LOAD_USERS", "1000")),
+                              channels=int(os.getenv("LOAD_CHANNELS", "100")))
+    report = generator.run(rate=float(os.getenv("LOAD_RATE", "50")),
+                           duration=float(os.getenv("LOAD_DURATION", "60")))
+    print(report.format())
+    server.stop()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import traceback
+
+from itertools import chain
+from collections import OrderedDict
+from urllib.request import urlopen
+from typing import Any, BinaryIO, Callable, Dict, Union
+
+# Ключ хэша содержимого в описании медиа поста ({"type", "url", ...}).
+HASH_KEY = "sha256"
+
+BLOBS_DIR = "blobs"
+TMP_DIR = "tmp"
+INDEX_FILE = "index.json"
+
+# Размер блока при потоковом скачивании и хэшировании.
+CHUNK_SIZE = 64 * 1024
+
+
+class _Blob:
+    __slots__ = ("size", "refs", "file_id", "stored")
+
+    def __init__(self,
+                 size: int,
+                 refs: int = 0,
+                 file_id: str = None,
+                 stored: bool = True):
+        """
+        :param stored: лежит ли файл на диске; без него от файла остается
+        только file_id.
+        """
+        self.size = size
+        self.refs = refs
+        self.file_id = file_id
+        self.stored = stored
+
+
+class MediaCache:
+    """
+    Локальное контентно-адресуемое хранилище медиа из постов каналов.
+
+    Файл скачивается потоком во временный файл с одновременным подсчетом
+    SHA-256 и хранится под своим хэшем: одна и та же картинка, репостнутая
+    в десятки каналов, лежит на диске один раз. У каждого файла есть
+    счетчик ссылок (сколько постов архива на него ссылается) и file_id
+    Телеграма после первой загрузки - дальше рассылка отправляет file_id и
+    не загружает файл снова, из какого бы канала ни был пост.
+
+    Суммарный размер файлов ограничен max_bytes: сверх него удаляются
+    давно не использовавшиеся файлы, сначала те, на которые больше не
+    ссылается ни один пост. У удаленного файла, на который еще ссылаются
+    посты и который уже загружен в Телеграм, остается file_id - рассылка
+    продолжает его отправлять. Описание файлов сохраняется в index.json
+    (save()), а сами файлы при старте находятся по каталогу.
+    """
+
+    def __init__(self,
+                 root: str,
+                 max_bytes: int = 10 * 1024 ** 3,
+                 opener: Callable[[str], BinaryIO] = urlopen):
+        """
+        :param opener: функция, открывающая URL медиа для чтения.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.opener = opener
+
+        self._blobs = OrderedDict()  # type: OrderedDict[str, _Blob]
+        self.size = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        os.makedirs(os.path.join(root, BLOBS_DIR), exist_ok=True)
+        os.makedirs(os.path.join(root, TMP_DIR), exist_ok=True)
+        self._load()
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._blobs
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, BLOBS_DIR, digest[:2], digest)
+
+    def _load(self):
+        # Недокачанные файлы остаются во временном каталоге после падения.
+        tmp_dir = os.path.join(self.root, TMP_DIR)
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+
+        index = {}  # type: Dict[str, Dict[str, Any]]
+        index_path = os.path.join(self.root, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+
+        blobs = []
+        found = set()
+        blobs_dir = os.path.join(self.root, BLOBS_DIR)
+        for prefix in os.listdir(blobs_dir):
+            for digest in os.listdir(os.path.join(blobs_dir, prefix)):
+                entry = index.get(digest, {})
+                blob = _Blob(os.path.getsize(self.path(digest)),
+                             entry.get("refs", 0), entry.get("file_id"))
+                blobs.append((entry.get("order", -1), digest, blob))
+                found.add(digest)
+        for digest, entry in index.items():
+            if digest not in found and self._keeps_file_id(
+                    entry.get("refs", 0), entry.get("file_id")):
+                blob = _Blob(0, entry["refs"], entry["file_id"], stored=False)
+                blobs.append((entry["order"], digest, blob))
+        for _, digest, blob in sorted(blobs, key=lambda item: item[0]):
+            self._blobs[digest] = blob
+            self.size += blob.size
+
+    def save(self):
+        """
+        Сохраняет счетчики ссылок, file_id и порядок использования файлов.
+        """
+        with self._lock:
+            index = {
+                digest: {"refs": blob.refs, "file_id": blob.file_id,
+                         "order": order}
+                for order, (digest, blob) in enumerate(self._blobs.items())
+            }
+        path = os.path.join(self.root, INDEX_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, path)
+
+    def put_stream(self, stream: BinaryIO) -> str:
+        """
+        Сохраняет файл из потока и добавляет ссылку на него.
+        :return: SHA-256 содержимого (hex).
+        """
+        sha = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self.root, TMP_DIR),
+                                         delete=False) as tmp:
+            try:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        digest = sha.hexdigest()
+
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None or not blob.stored:
+                path = self.path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp.name, path)
+                if blob is None:
+                    blob = self._blobs[digest] = _Blob(size)
+                blob.size, blob.stored = size, True
+                self.size += size
+            else:
+                os.remove(tmp.name)
+            self._blobs.move_to_end(digest)
+            blob.refs += 1
+            self._evict(keep=digest)
+        return digest
+
+    def download(self, url: str) -> str:
+        """
+        Скачивает файл по URL (см. put_stream()).
+        """
+        with self.opener(url) as response:
+            return self.put_stream(response)
+
+    def release(self, digest: str):
+        """
+        Убирает ссылку на файл. Файл без ссылок остается в кэше, пока не
+        понадобится место.
+        """
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is not None and blob.refs > 0:
+                blob.refs -= 1
+
+    @staticmethod
+    def _keeps_file_id(refs: int, file_id: Union[str, None]) -> bool:
+        return refs > 0 and file_id is not None
+
+    def _drop(self, digest: str, blob: _Blob):
+        """
+        Убирает файл с диска; от загруженного файла, на который ссылаются
+        посты, остается file_id.
+        """
+        self.size -= blob.size
+        if self._keeps_file_id(blob.refs, blob.file_id):
+            blob.size, blob.stored = 0, False
+        else:
+            del self._blobs[digest]
+
+    def _evict(self, keep: str = None):
+        excess = self.size - self.max_bytes
+        if excess <= 0:
+            return
+        # Обход ленивый: обычно хватает нескольких самых старых файлов.
+        candidates = chain(
+            ((digest, blob) for digest, blob in self._blobs.items()
+             if blob.refs == 0 and blob.stored and digest != keep),
+            ((digest, blob) for digest, blob in self._blobs.items()
+             if blob.refs > 0 and blob.stored and digest != keep),
+        )
+        victims = []
+        for digest, blob in candidates:
+            if excess <= 0:
+                break
+            victims.append((digest, blob))
+            excess -= blob.size
+        for digest, blob in victims:
+            self._drop(digest, blob)
+            self.evicted += 1
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+
+    def open(self, digest: str) -> Union[BinaryIO, None]:
+        """
+        Открывает файл для загрузки в Телеграм.
+        :return: None, если файла нет в кэше.
+        """
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None or not blob.stored:
+                return None
+            self._blobs.move_to_end(digest)
+            try:
+                return open(self.path(digest), "rb")
+            except FileNotFoundError:
+                self._drop(digest, blob)
+                return None
+
+    def file_id(self, digest: str) -> Union[str, None]:
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None:
+                return None
+            self._blobs.move_to_end(digest)
+            return blob.file_id
+
+    def set_file_id(self, digest: str, file_id: str):
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is not None:
+                blob.file_id = file_id
+
+    def add_post_media(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Скачивает медиа поста (data["media"]["url"]) в кэш и дописывает в
+        описание медиа хэш содержимого. Вызывается граббером до записи
+        поста в архив (см. archive_post()); если скачать не удалось, пост остается без хэша и
+        рассылается по URL.
+        """
+        media = data.get("media")
+        if not media or not media.get("url") or HASH_KEY in media:
+            return data
+        try:
+            media[HASH_KEY] = self.download(media["url"])
+        except Exception as e:
+            print("Error in MediaCache.download() for {}: {}\n{}".format(
+                media["url"], str(e), traceback.format_exc()
+            ))
+        return data
+
+    def archive_post(self,
+                     archive,
+                     channel_id: int,
+                     msg_id: int,
+                     data: Dict[str, Any],
+                     date: float = None) -> bool:
+        """
+        Кэширует медиа поста (add_post_media()) и дописывает пост в архив
+        (archive.PostArchive.append()). Если архив отклонил пост как
+        повтор, ссылка на медиа снимается - иначе файл так и остался бы
+        занятым постом, которого в архиве нет. Повтор, известный заранее,
+        не скачивается.
+        :return: результат append().
+        """
+        if msg_id <= archive.last_msg_id(channel_id):
+            return False
+        data = self.add_post_media(data)
+        if archive.append(channel_id, msg_id, data, date):
+            return True
+        self.release_post_media(data)
+        return False
+
+    def release_post_media(self, data: Dict[str, Any]):
+        """
+        Убирает ссылку поста на его медиа (например, при удалении поста из
+        архива, см. PostArchive(on_drop=...)).
+        """
+        digest = (data.get("media") or {}).get(HASH_KEY)
+        if digest is not None:
+            self.release(digest)
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.save()
+            except Exception as e:
+                print("Error in MediaCache.save(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start(self, interval: float = 300.0):
+        """
+        Запускает фоновый поток, который раз в interval секунд сохраняет
+        описание файлов (save()): счетчики ссылок и file_id, набранные с
+        последнего сохранения, теряются только при падении процесса.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(interval,), name="media-cache",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Останавливает поток и сохраняет описание файлов.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "blobs": sum(1 for blob in self._blobs.values()
+                             if blob.stored),
+                "file_id_only": sum(1 for blob in self._blobs.values()
+                                    if not blob.stored),
+                "bytes": self.size,
+                "unreferenced": sum(1 for blob in self._blobs.values()
+                                    if blob.refs == 0),
+                "uploaded": sum(1 for blob in self._blobs.values()
+                                if blob.file_id is not None),
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+
+import heapq
+
+from bisect import bisect_right
+from contextlib import contextmanager
+from itertools import count
+from typing import List, Dict, Set, Iterable, Union
+
+import events
+
+from dal import User, Channel, Subscription, Store
+from dal import DELIVERY_PREFS, delivery_prefs
+from events import EventBus
+
+
+class MemoryStore(Store):
+    """
+    Хранилище с тем же интерфейсом, что и dal.Store, но целиком в памяти
+    процесса. Используется в тестах и бенчмарках вместо живой БД.
+
+    Пользователи и каналы индексируются хэш-таблицами по id, tg_id и
+    нику/названию, а подписки хранятся в виде списков смежности
+    user_id -> {channel_id: sub_id} и channel_id -> {user_id: sub_id}.
+    Результат get_top_channels() кэшируется до первого изменения подписок
+    или каналов.
+    """
+
+    def __init__(self, bus: EventBus = None):
+        self._bus = bus
+        self._outbox = False
+        self._pending_events = []
+        self._depth = 0
+        self._snapshot = None
+        self._state = {}  # type: Dict[str, str]
+
+        self._users = {}  # type: Dict[int, User]
+        self._users_by_tg_id = {}  # type: Dict[int, int]
+        self._users_by_nickname = {}  # type: Dict[str, int]
+
+        self._channels = {}  # type: Dict[int, Channel]
+        self._channels_by_tg_id = {}  # type: Dict[int, int]
+        self._channels_by_title = {}  # type: Dict[str, Set[int]]
+
+        self._subs = {}  # type: Dict[int, Subscription]
+        self._subs_by_user = {}  # type: Dict[int, Dict[int, int]]
+        self._subs_by_channel = {}  # type: Dict[int, Dict[int, int]]
+        # ID каналов из последнего get_top_channels() и limit, с которым он
+        # был вызван; None - кэш сброшен.
+        self._top_ids = None  # type: Union[List[int], None]
+        self._top_limit = 0
+
+        self._user_seq = count(1)
+        self._channel_seq = count(1)
+        self._sub_seq = count(1)
+
+    def save(self):
+        """
+        Изменения применяются сразу, поэтому остается только опубликовать
+        накопленные события (внутри transaction() - при выходе из блока).
+        """
+        if not self._depth:
+            self._publish_pending()
+
+    def _take_snapshot(self) -> dict:
+        return {
+            "state": dict(self._state),
+            "users": dict(self._users),
+            "users_by_tg_id": dict(self._users_by_tg_id),
+            "users_by_nickname": dict(self._users_by_nickname),
+            "channels": dict(self._channels),
+            "channels_by_tg_id": dict(self._channels_by_tg_id),
+            "channels_by_title": {title: set(ids) for title, ids
+                                  in self._channels_by_title.items()},
+            "subs": dict(self._subs),
+            "subs_by_user": {user_id: dict(subs) for user_id, subs
+                             in self._subs_by_user.items()},
+            "subs_by_channel": {channel_id: dict(subs) for channel_id, subs
+                                in self._subs_by_channel.items()},
+            # Поля, которые меняются у существующих объектов.
+            "prefs": {user_id: delivery_prefs(user)
+                      for user_id, user in self._users.items()},
+            "subs_counts": {channel_id: channel.subs_count
+                            for channel_id, channel in self._channels.items()},
+            "filters": {sub_id: sub.filters
+                        for sub_id, sub in self._subs.items()},
+        }
+
+    def _restore_snapshot(self, snapshot: dict):
+        for name in ("state", "users", "users_by_tg_id", "users_by_nickname",
+                     "channels", "channels_by_tg_id", "channels_by_title",
+                     "subs", "subs_by_user", "subs_by_channel"):
+            setattr(self, "_" + name, snapshot[name])
+        for user_id, prefs in snapshot["prefs"].items():
+            for name, value in prefs.items():
+                setattr(self._users[user_id], name, value)
+        for channel_id, subs_count in snapshot["subs_counts"].items():
+            self._channels[channel_id].subs_count = subs_count
+        for sub_id, filters in snapshot["filters"].items():
+            self._subs[sub_id].filters = filters
+        self._top_ids = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Работает как Store.transaction(): события публикуются при выходе из
+        внешнего блока, а при исключении данные возвращаются к состоянию на
+        его входе (по снимку индексов, поэтому блок стоит O(n)).
+        """
+        if not self._depth:
+            self._snapshot = self._take_snapshot()
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            self._restore_snapshot(self._snapshot)
+            self._pending_events = []
+            if not self._depth:
+                self._snapshot = None
+            raise
+        self._depth -= 1
+        if not self._depth:
+            self._snapshot = None
+            self.save()
+
+    def get_outbox_events(self, after_id: int = 0, limit: int = 100) -> List:
+        """
+        MemoryStore не ведет outbox: события есть только на шине.
+        """
+        return []
+
+    def get_state(self, key: str) -> Union[str, None]:
+        return self._state.get(key)
+
+    def set_state(self, key: str, value: str):
+        self._state[key] = value
+
+    def _add_user(self, user: User) -> User:
+        self._users[user.id] = user
+        if user.tg_id is not None:
+            self._users_by_tg_id[user.tg_id] = user.id
+        if user.nickname is not None:
+            self._users_by_nickname[user.nickname] = user.id
+        return user
+
+    def _add_channel(self, channel: Channel) -> Channel:
+        self._top_ids = None
+        self._channels[channel.id] = channel
+        if channel.tg_id is not None:
+            self._channels_by_tg_id[channel.tg_id] = channel.id
+        self._channels_by_title.setdefault(channel.title, set()).add(channel.id)
+        return channel
+
+    def _add_subscription(self, sub: Subscription) -> Subscription:
+        self._subs[sub.id] = sub
+        self._top_ids = None
+        if sub.channel_id in self._channels:
+            self._channels[sub.channel_id].subs_count += 1
+        self._subs_by_user.setdefault(sub.user_id, {})[sub.channel_id] = sub.id
+        self._subs_by_channel.setdefault(sub.channel_id, {})[sub.user_id] = sub.id
+        return sub
+
+    def _remove_subscription(self, sub_id: int) -> Subscription:
+        sub = self._subs.pop(sub_id)
+        self._top_ids = None
+        if sub.channel_id in self._channels:
+            self._channels[sub.channel_id].subs_count -= 1
+        by_user = self._subs_by_user.get(sub.user_id, {})
+        by_user.pop(sub.channel_id, None)
+        if not by_user:
+            self._subs_by_user.pop(sub.user_id, None)
+        by_channel = self._subs_by_channel.get(sub.channel_id, {})
+        by_channel.pop(sub.user_id, None)
+        if not by_channel:
+            self._subs_by_channel.pop(sub.channel_id, None)
+        return sub
+
+    @staticmethod
+    def _sub_data(sub: Subscription) -> dict:
+        return {"sub_id": sub.id,
+                "user_id": sub.user_id,
+                "channel_id": sub.channel_id}
+
+    def _find_user_id(self,
+                      user_id: int = None,
+                      tg_id: int = None,
+                      nickname: str = None) -> int:
+        if user_id is not None:
+            return user_id if user_id in self._users else None
+        if tg_id is not None:
+            return self._users_by_tg_id.get(tg_id)
+        if nickname is not None:
+            return self._users_by_nickname.get(nickname)
+        return None
+
+    def delete_user(self,
+                    user_id: int = None,
+                    tg_id: int = None,
+                    nickname: str = None):
+        """
+        Удаляет пользователя вместе с его подписками, выбирая его по одному из
+        переданных аргументов.
+        :param user_id: ID пользователя.
+        :param tg_id: ID пользователя в Телеграме.
+        :param nickname: ник пользователя в Телеграме.
+        """
+        user_id = self._find_user_id(user_id, tg_id, nickname)
+        if user_id is None:
+            return
+
+        cascaded = [
+            self._sub_data(self._remove_subscription(sub_id))
+            for sub_id in list(self._subs_by_user.get(user_id, {}).values())
+        ]
+
+        user = self._users.pop(user_id)
+        self._users_by_tg_id.pop(user.tg_id, None)
+        self._users_by_nickname.pop(user.nickname, None)
+        self._emit(events.USER_DELETED, user_id=user.id, tg_id=user.tg_id,
+                   subscriptions=cascaded)
+        self.save()
+
+    def delete_users_bulk(self, tg_ids: List[int]) -> int:
+        """
+        Удаляет пользователей с переданными ID в Телеграме вместе с их
+        подписками (аналогично Store.delete_users_bulk()).
+        :param tg_ids: ID пользователей в Телеграме.
+        :return: количество удаленных пользователей.
+        """
+        deleted = 0
+        for tg_id in tg_ids:
+            if tg_id in self._users_by_tg_id:
+                self.delete_user(tg_id=tg_id)
+                deleted += 1
+        return deleted
+
+    def delete_channel(self,
+                       chan_id: int = None,
+                       tg_id: int = None,
+                       title: str = None):
+        """
+        Удаляет канал вместе с подписками на него, выбирая его по одному из
+        переданных аргументов.
+        :param chan_id: ID канала.
+        :param tg_id: ID канала в Телеграме.
+        :param title: название канала в Телеграме.
+        """
+        if chan_id is not None:
+            chan_ids = {chan_id} if chan_id in self._channels else set()
+        elif tg_id is not None:
+            chan_ids = {self._channels_by_tg_id[tg_id]} \
+                if tg_id in self._channels_by_tg_id else set()
+        elif title is not None:
+            chan_ids = set(self._channels_by_title.get(title, set()))
+        else:
+            return
+
+        for chan_id in chan_ids:
+            cascaded = [
+                self._sub_data(self._remove_subscription(sub_id))
+                for sub_id in list(self._subs_by_channel.get(chan_id, {}).values())
+            ]
+
+            channel = self._channels.pop(chan_id)
+            self._top_ids = None
+            self._channels_by_tg_id.pop(channel.tg_id, None)
+            titled = self._channels_by_title[channel.title]
+            titled.discard(chan_id)
+            if not titled:
+                del self._channels_by_title[channel.title]
+            self._emit(events.CHANNEL_DELETED, channel_id=channel.id,
+                       title=channel.title, subscriptions=cascaded)
+        self.save()
+
+    def delete_subscription(self, user_id: int, channel_id: int):
+        """
+        Удаляет подписки, выбирая их по переданным аргументам.
+        :param user_id: ID пользователя.
+        :param channel_id: ID канала.
+        """
+        if user_id is None and channel_id is None:
+            return
+
+        subs = self.get_subscriptions(
+            user_ids=None if user_id is None else [user_id],
+            channel_ids=None if channel_id is None else [channel_id],
+        )
+        for sub in subs:
+            self._remove_subscription(sub.id)
+            self._emit(events.SUBSCRIPTION_DELETED, **self._sub_data(sub))
+        self.save()
+
+    def create_user(self,
+                    tg_id: int,
+                    nickname: str = None,
+                    bot_id: str = None) -> User:
+        """
+        Добавляет запись о пользователе с данными, переданными в аргументах.
+        :param tg_id: ID пользователя в Телеграме.
+        :param nickname: ник пользователя.
+        :param bot_id: ID бота, через которого пользователь начал работу.
+        :return: объект User c заполненными данными и его ID.
+        """
+        if tg_id in self._users_by_tg_id or nickname in self._users_by_nickname:
+            raise Exception("User creating error: "
+                            "tg_id or nickname is already taken.")
+        user = self._add_user(
+            User(id=next(self._user_seq), nickname=nickname, tg_id=tg_id,
+                 utc_offset=0, bot_id=bot_id)
+        )
+        self._emit(events.USER_CREATED, user_id=user.id, tg_id=user.tg_id,
+                   nickname=user.nickname)
+        self.save()
+        return user
+
+    def create_channel(self, title: str, tg_id: int = None) -> Channel:
+        """
+        Добавляет запись о канале с данными, переданными в аргументах.
+        :param title: название канала.
+        :param tg_id: ID канала в Телеграме.
+        :return: объект Channel c заполненными данными и его ID.
+        """
+        if tg_id is not None and tg_id in self._channels_by_tg_id:
+            raise Exception("Channel creating error: tg_id is already taken.")
+        channel = self._add_channel(
+            Channel(id=next(self._channel_seq), title=title, tg_id=tg_id,
+                    subs_count=0)
+        )
+        self._emit(events.CHANNEL_CREATED, channel_id=channel.id,
+                   title=channel.title, tg_id=channel.tg_id)
+        self.save()
+        return channel
+
+    def create_subscription(self, user_id: int, channel_id: int) -> Subscription:
+        """
+        Добавляет запись о подписке с данными, переданными в аргументах.
+        :param user_id: ID пользователя.
+        :param channel_id: ID канала.
+        :return: объект Subscription c заполненными данными и его ID.
+        """
+        if user_id is None or channel_id is None:
+            raise Exception("Subscription creating error:"
+                            "user_id or channel_id is None.")
+
+        sub = Subscription(id=next(self._sub_seq),
+                           user_id=user_id,
+                           channel_id=channel_id)
+        sub.user = self._users.get(user_id)
+        sub.channel = self._channels.get(channel_id)
+        self._add_subscription(sub)
+        self._emit(events.SUBSCRIPTION_CREATED, **self._sub_data(sub))
+        self.save()
+        return sub
+
+    def set_subscription_filters(self,
+                                 user_id: int,
+                                 channel_id: int,
+                                 filters: str = None) -> bool:
+        """
+        Сохраняет фильтры по ключевым словам для подписки пользователя на канал.
+        :param user_id: ID пользователя.
+        :param channel_id: ID канала.
+        :param filters: строка вида "+слово -слово" или None, чтобы сбросить.
+        :return: True, если подписка найдена и обновлена.
+        """
+        sub_id = self._subs_by_user.get(user_id, {}).get(channel_id)
+        if sub_id is None:
+            return False
+        self._subs[sub_id].filters = filters or None
+        self._emit(events.SUBSCRIPTION_FILTERS_CHANGED, user_id=user_id,
+                   channel_id=channel_id, filters=filters or "")
+        self.save()
+        return True
+
+    def update_delivery_prefs(self, user_id: int, **prefs) -> bool:
+        unknown = set(prefs) - set(DELIVERY_PREFS)
+        if unknown:
+            raise ValueError("Unknown delivery prefs: {}".format(
+                ", ".join(sorted(unknown))
+            ))
+        user = self._users.get(user_id)
+        if user is None:
+            return False
+        for name, value in prefs.items():
+            setattr(user, name, value)
+        self._emit(events.USER_PREFS_CHANGED, user_id=user.id,
+                   tg_id=user.tg_id, **delivery_prefs(user))
+        self.save()
+        return True
+
+    def user_exists(self,
+                    nickname: str = None,
+                    tg_id: int = None,
+                    user_id: int = None) -> bool:
+        return len(self.get_users(
+            user_ids=None if user_id is None else [user_id],
+            tg_ids=None if tg_id is None else [tg_id],
+            nicknames=None if nickname is None else [nickname],
+        )) != 0
+
+    def channel_exists(self,
+                       title: str = None,
+                       tg_id: int = None,
+                       channel_id: int = None) -> bool:
+        return len(self.get_channels(
+            chan_ids=None if channel_id is None else [channel_id],
+            tg_ids=None if tg_id is None else [tg_id],
+            titles=None if title is None else [title],
+        )) != 0
+
+    def subscription_exists(self, user_id: int, channel_id: int) -> bool:
+        if user_id is None or channel_id is None:
+            raise Exception("Subscription creating error:"
+                            "user_id or channel_id is None.")
+        return channel_id in self._subs_by_user.get(user_id, {})
+
+    @staticmethod
+    def _intersect(candidates: Set[int], ids: Iterable[int]) -> Set[int]:
+        ids = set(ids)
+        return ids if candidates is None else candidates & ids
+
+    def get_users(self,
+                  user_ids: List[int] = None,
+                  tg_ids: List[int] = None,
+                  nicknames: List[str] = None) -> List[User]:
+        """
+        Возвращает список пользователей, которые соответствуют всем переданным
+        фильтрам (аналогично Store.get_users()).
+        :param user_ids: ID пользователей.
+        :param tg_ids: ID в пользователей в Телеграме.
+        :param nicknames: никнеймы пользователей в Телеграме.
+        :return: список объектов User.
+        """
+        found = None
+        if user_ids is not None:
+            found = self._intersect(
+                found, (i for i in user_ids if i in self._users)
+            )
+        if tg_ids is not None:
+            found = self._intersect(
+                found, (self._users_by_tg_id[i] for i in tg_ids
+                        if i in self._users_by_tg_id)
+            )
+        if nicknames is not None:
+            found = self._intersect(
+                found, (self._users_by_nickname[n] for n in nicknames
+                        if n in self._users_by_nickname)
+            )
+        if found is None:
+            found = self._users.keys()
+
+        return [self._users[i] for i in sorted(found)]
+
+    def get_subscription_filters(self, batch_size: int = 1000) -> Iterable:
+        return (self._subs[sub_id] for sub_id in sorted(self._subs)
+                if self._subs[sub_id].filters is not None)
+
+    def get_users_with_delivery_prefs(self) -> List[User]:
+        return [user for _, user in sorted(self._users.items())
+                if user.quiet_from is not None or user.digest is not None]
+
+    def get_subscriptions(self,
+                          sub_ids: List[int] = None,
+                          channel_ids: List[int] = None,
+                          user_ids: List[int] = None) -> List[Subscription]:
+        """
+        Возвращает список подписок, которые соответствуют всем переданным
+        фильтрам (аналогично Store.get_subscriptions()).
+        :param sub_ids: ID подписок.
+        :param channel_ids: ID каналов, по которым нужно получить подписки.
+        :param user_ids: ID пользователей, по которым нужно получить подписки.
+        :return: список объектов Subscription.
+        """
+        found = None
+        if sub_ids is not None:
+            found = self._intersect(
+                found, (i for i in sub_ids if i in self._subs)
+            )
+        if channel_ids is not None:
+            found = self._intersect(
+                found, (sub_id for i in channel_ids
+                        for sub_id in self._subs_by_channel.get(i, {}).values())
+            )
+        if user_ids is not None:
+            found = self._intersect(
+                found, (sub_id for i in user_ids
+                        for sub_id in self._subs_by_user.get(i, {}).values())
+            )
+        if found is None:
+            found = self._subs.keys()
+
+        return [self._subs[i] for i in sorted(found)]
+
+    def get_user_channels(self,
+                          user_id: int,
+                          after_channel_id: int = None,
+                          limit: int = 10) -> List[Channel]:
+        """
+        Возвращает каналы, на которые подписан пользователь, упорядоченные по
+        ID (аналогично Store.get_user_channels()).
+        :param user_id: ID пользователя.
+        :param after_channel_id: ID последнего канала предыдущей страницы.
+        :param limit: максимальное количество каналов.
+        :return: список объектов Channel.
+        """
+        chan_ids = sorted(self._subs_by_user.get(user_id, {}))
+        if after_channel_id is not None:
+            chan_ids = chan_ids[bisect_right(chan_ids, after_channel_id):]
+        return [self._channels[i] for i in chan_ids[:limit]]
+
+    def get_top_channels(self, limit: int = 10) -> List[Channel]:
+        """
+        Возвращает каналы с наибольшим количеством подписчиков (аналогично
+        Store.get_top_channels()).
+        :param limit: количество каналов.
+        :return: список объектов Channel по убыванию числа подписчиков.
+        """
+        # Кэш с большим limit подходит и для меньшего, если в нем столько
+        # каналов, сколько просили, или он содержит все каналы с подписками.
+        if self._top_ids is None or \
+                limit > self._top_limit == len(self._top_ids):
+            top = heapq.nsmallest(
+                limit,
+                ((chan_id, subs)
+                 for chan_id, subs in self._subs_by_channel.items()
+                 if chan_id in self._channels),
+                key=lambda item: (-len(item[1]), item[0])
+            )
+            self._top_ids = [chan_id for chan_id, _ in top]
+            self._top_limit = limit
+        return [self._channels[chan_id] for chan_id in self._top_ids[:limit]]
+
+    def get_channels(self,
+                     chan_ids: List[int] = None,
+                     tg_ids: List[int] = None,
+                     titles: List[str] = None) -> List[Channel]:
+        """
+        Возвращает список каналов, которые соответствуют всем переданным
+        фильтрам (аналогично Store.get_channels()).
+        :param chan_ids: ID каналов.
+        :param tg_ids: ID в каналов в Телеграме.
+        :param titles: названия каналов в Телеграме.
+        :return: список объектов Channel.
+        """
+        found = None
+        if chan_ids is not None:
+            found = self._intersect(
+                found, (i for i in chan_ids if i in self._channels)
+            )
+        if tg_ids is not None:
+            found = self._intersect(
+                found, (self._channels_by_tg_id[i] for i in tg_ids
+                        if i in self._channels_by_tg_id)
+            )
+        if titles is not None:
+            found = self._intersect(
+                found, (i for t in titles
+                        for i in self._channels_by_title.get(t, ()))
+            )
+        if found is None:
+            found = self._channels.keys()
+
+        return [self._channels[i] for i in sorted(found)]
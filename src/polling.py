@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+import time
+import heapq
+import threading
+import traceback
+
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+import events
+from events import Event, EventBus
+from throttle import TokenBucket
+
+
+class _ChannelState:
+    __slots__ = ("interval", "rate", "last_poll", "due")
+
+    def __init__(self, interval: float, due: float):
+        self.interval = interval
+        self.rate = 0.0
+        self.last_poll = None
+        self.due = due
+
+
+class PollScheduler:
+    """
+    Планировщик опроса каналов, подстраивающийся под частоту их постов.
+
+    Для каждого канала оценивается скорость публикации (экспоненциальное
+    скользящее среднее постов в секунду), и следующий опрос назначается
+    так, чтобы за интервал набиралось около target_posts новых постов.
+    Опрос без новых постов увеличивает интервал в backoff раз, а опрос,
+    принесший больше target_posts постов, сразу сокращает его как минимум
+    вдвое.
+
+    Каналы лежат в куче по времени следующего опроса. Каналы без
+    подписчиков не опрашиваются, а общее число опросов ограничено
+    ведром budget: когда токены кончаются, просроченные каналы ждут, и
+    первыми опрашиваются самые просроченные.
+
+    Процесс бота (bot.main()) каналы не опрашивает: планировщик
+    предназначен для цикла граббера, который живет в отдельном сервисе
+    (grabber в docker-compose.yml) и в этот репозиторий не входит. Граббер
+    создает его со своей функцией poll(), подключает к шине событий
+    хранилища (attach()), загружает каналы (load()) и запускает (start())
+    вместо опроса всех каналов с одним интервалом.
+    """
+
+    def __init__(self,
+                 poll: Callable[[int], int],
+                 budget: TokenBucket = None,
+                 min_interval: float = 30.0,
+                 max_interval: float = 6 * 3600.0,
+                 initial_interval: float = 300.0,
+                 target_posts: float = 1.0,
+                 backoff: float = 2.0,
+                 alpha: float = 0.3,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param poll: функция poll(channel_id), которая забирает новые посты
+        канала и возвращает их количество.
+        :param budget: ведро, ограничивающее общее число опросов.
+        """
+        self.poll = poll
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.target_posts = target_posts
+        self.backoff = backoff
+        self.alpha = alpha
+        self._clock = clock
+
+        self._channels = {}  # type: Dict[int, _ChannelState]
+        self._subs_counts = {}  # type: Dict[int, int]
+        self._heap = []  # type: List[Tuple[float, int]]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.polls = 0
+        self.deferred = 0
+
+    def __len__(self):
+        return len(self._channels)
+
+    def attach(self, bus: EventBus):
+        """
+        Подписывает планировщик на события о подписках, чтобы начинать
+        опрос канала с первым подписчиком и прекращать с последним.
+        """
+        bus.subscribe(events.SUBSCRIPTION_CREATED, self._on_sub_created)
+        bus.subscribe(events.SUBSCRIPTION_DELETED, self._on_sub_deleted)
+        bus.subscribe(events.USER_DELETED, self._on_user_deleted)
+        bus.subscribe(events.CHANNEL_DELETED, self._on_channel_deleted)
+
+    def _on_sub_created(self, event: Event):
+        self._change_subs_count(event.data["channel_id"], 1)
+
+    def _on_sub_deleted(self, event: Event):
+        self._change_subs_count(event.data["channel_id"], -1)
+
+    def _on_user_deleted(self, event: Event):
+        for sub in event.data["subscriptions"]:
+            self._change_subs_count(sub["channel_id"], -1)
+
+    def _on_channel_deleted(self, event: Event):
+        self.remove(event.data["channel_id"])
+
+    def load(self, channels: Iterable):
+        """
+        Добавляет каналы (объекты Channel) с их счетчиками подписчиков.
+        Первые опросы равномерно распределяются по initial_interval, чтобы
+        после рестарта не опрашивать все каналы разом.
+        """
+        channels = [chan for chan in channels if chan.subs_count > 0]
+        now = self._clock()
+        with self._lock:
+            for i, chan in enumerate(channels):
+                self._subs_counts[chan.id] = chan.subs_count
+                offset = self.initial_interval * i / len(channels)
+                self._add(chan.id, now + offset)
+
+    def _change_subs_count(self, channel_id: int, delta: int):
+        with self._lock:
+            count = max(self._subs_counts.get(channel_id, 0) + delta, 0)
+            if count:
+                self._subs_counts[channel_id] = count
+                if channel_id not in self._channels:
+                    # Новый канал опрашивается сразу, чтобы быстро узнать
+                    # его частоту постов.
+                    self._add(channel_id, self._clock())
+            else:
+                self._subs_counts.pop(channel_id, None)
+                self._channels.pop(channel_id, None)
+
+    def remove(self, channel_id: int):
+        with self._lock:
+            self._subs_counts.pop(channel_id, None)
+            self._channels.pop(channel_id, None)
+
+    def _add(self, channel_id: int, due: float):
+        state = _ChannelState(self.initial_interval, due)
+        self._channels[channel_id] = state
+        heapq.heappush(self._heap, (due, channel_id))
+
+    def interval(self, channel_id: int) -> Union[float, None]:
+        state = self._channels.get(channel_id)
+        return state.interval if state is not None else None
+
+    def next_due(self) -> Union[float, None]:
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _drop_stale(self):
+        while self._heap:
+            due, channel_id = self._heap[0]
+            state = self._channels.get(channel_id)
+            if state is not None and state.due == due:
+                return
+            heapq.heappop(self._heap)
+
+    def record(self, channel_id: int, new_posts: int, now: float = None):
+        """
+        Учитывает результат опроса канала и назначает следующий опрос.
+        """
+        now = self._clock() if now is None else now
+        with self._lock:
+            state = self._channels.get(channel_id)
+            if state is None:
+                return
+            if state.last_poll is not None and now > state.last_poll:
+                observed = new_posts / (now - state.last_poll)
+                state.rate = self.alpha * observed + \
+                    (1 - self.alpha) * state.rate
+            state.last_poll = now
+
+            if new_posts == 0:
+                interval = state.interval * self.backoff
+            else:
+                interval = self.target_posts / state.rate \
+                    if state.rate > 0 else state.interval
+                if new_posts > self.target_posts:
+                    interval = min(interval, state.interval / 2)
+            state.interval = min(max(interval, self.min_interval),
+                                 self.max_interval)
+            state.due = now + state.interval
+            heapq.heappush(self._heap, (state.due, channel_id))
+
+    def _take_due(self, now: float) -> Union[int, None]:
+        with self._lock:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            if self.budget is not None and not self.budget.try_acquire():
+                self.deferred += 1
+                return None
+            _, channel_id = heapq.heappop(self._heap)
+            return channel_id
+
+    def run_once(self, now: float = None) -> int:
+        """
+        Опрашивает все каналы, время которых подошло, пока позволяет бюджет.
+        :return: количество опрошенных каналов.
+        """
+        now = self._clock() if now is None else now
+        polled = 0
+        while True:
+            channel_id = self._take_due(now)
+            if channel_id is None:
+                return polled
+            try:
+                new_posts = self.poll(channel_id)
+            except Exception as e:
+                print("Error in PollScheduler.poll() for {}: {}\n{}".format(
+                    channel_id, str(e), traceback.format_exc()
+                ))
+                new_posts = 0
+            self.record(channel_id, new_posts, now)
+            self.polls += 1
+            polled += 1
+
+    def _sleep_time(self, max_sleep: float) -> float:
+        due = self.next_due()
+        if due is None:
+            return max_sleep
+        wait = due - self._clock()
+        if self.budget is not None:
+            wait = max(wait, self.budget.wait_time())
+        return min(max(wait, 0.0), max_sleep)
+
+    def _loop(self, max_sleep: float):
+        while not self._stop.wait(self._sleep_time(max_sleep)):
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Error in PollScheduler.run_once(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start(self, max_sleep: float = 5.0):
+        """
+        Запускает фоновый поток опроса. Поток спит до ближайшего опроса,
+        но не дольше max_sleep секунд, чтобы замечать новые каналы.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(max_sleep,), name="poll-scheduler",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
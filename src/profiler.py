@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import socket
+import threading
+import traceback
+import tracemalloc
+
+from collections import Counter, defaultdict
+from functools import wraps
+from typing import Callable, Dict, List, Tuple, Union
+
+# Сколько строк с самыми "тяжелыми" местами выделения памяти попадает в отчет.
+TRACEMALLOC_TOP = 50
+TRACEMALLOC_FRAMES = 10
+
+MAX_PROFILE_SECONDS = 300
+
+
+def _collapse(frame) -> str:
+    """
+    Стек кадра в "свернутом" формате flamegraph: функции от внешней к
+    внутренней через ";".
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{}:{}:{}".format(os.path.basename(code.co_filename),
+                                       code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """
+    Профилирование работающего бота по запросу оператора.
+
+    trigger(seconds) на заданное время запускает:
+    - сэмплирующий профиль CPU: фоновый поток каждые interval секунд
+      снимает стеки всех потоков через sys._current_frames();
+    - tracemalloc, снимок которого делается в конце;
+    - сбор стеков отдельно по хэндлерам, обернутым в track().
+
+    Результаты пишутся в out_dir: cpu-*.collapsed (формат для
+    flamegraph.pl), handlers-*.txt и tracemalloc-*.txt. Вне сеанса
+    профилирования track() добавляет к вызову хэндлера одну проверку флага.
+    """
+
+    def __init__(self, out_dir: str, interval: float = 0.005):
+        self.out_dir = out_dir
+        self.interval = interval
+        self._active = False
+        self._handlers = {}  # type: Dict[int, str]
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_files = []  # type: List[str]
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    def track(self, handler):
+        """
+        Оборачивает хэндлер, чтобы во время профилирования его стеки
+        учитывались отдельно.
+        """
+        name = getattr(handler, "__name__", repr(handler))
+
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not self._active:
+                return handler(*args, **kwargs)
+            thread_id = threading.get_ident()
+            self._handlers[thread_id] = name
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                self._handlers.pop(thread_id, None)
+
+        return wrapper
+
+    def trigger(self,
+                seconds: float,
+                on_done: Callable[[List[str]], None] = None) -> bool:
+        """
+        Запускает сеанс профилирования в фоне.
+        :param seconds: длительность сеанса.
+        :param on_done: вызывается со списком записанных файлов.
+        :return: False, если сеанс уже идет.
+        """
+        with self._lock:
+            if self._active:
+                return False
+            self._active = True
+        self._thread = threading.Thread(
+            target=self._run, args=(seconds, on_done), name="profiler",
+            daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def wait(self, timeout: float = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, seconds: float, on_done):
+        files = []
+        try:
+            files = self._profile(seconds)
+        except Exception as e:
+            print("Error in Profiler: {}\n{}".format(
+                str(e), traceback.format_exc()
+            ))
+        finally:
+            self._active = False
+            self._handlers.clear()
+        self.last_files = files
+        if on_done is not None:
+            on_done(files)
+
+    def _profile(self, seconds: float) -> List[str]:
+        own_tracemalloc = not tracemalloc.is_tracing()
+        if own_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        stacks = Counter()  # type: Counter
+        handler_stacks = defaultdict(Counter)  # type: Dict[str, Counter]
+        samples = 0
+        me = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + seconds
+        while time.monotonic() < deadline:
+            handlers = dict(self._handlers)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = _collapse(frame)
+                stacks[stack] += 1
+                handler = handlers.get(thread_id)
+                if handler is not None:
+                    handler_stacks[handler][stack] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        snapshot = tracemalloc.take_snapshot()
+        if own_tracemalloc:
+            tracemalloc.stop()
+        elapsed = time.monotonic() - started
+        return self._dump(stacks, handler_stacks, snapshot, samples, elapsed)
+
+    def _dump(self, stacks, handler_stacks, snapshot, samples: int,
+              elapsed: float) -> List[str]:
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+
+        cpu_path = os.path.join(self.out_dir, "cpu-{}.collapsed".format(stamp))
+        with open(cpu_path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+        handlers_path = os.path.join(self.out_dir,
+                                     "handlers-{}.txt".format(stamp))
+        with open(handlers_path, "w") as f:
+            f.write("samples={} elapsed={:.1f}s interval={}s\n".format(
+                samples, elapsed, self.interval
+            ))
+            by_total = sorted(handler_stacks.items(),
+                              key=lambda item: -sum(item[1].values()))
+            for handler, counter in by_total:
+                f.write("\n== {} ({} samples)\n".format(
+                    handler, sum(counter.values())
+                ))
+                for stack, count in counter.most_common(20):
+                    f.write("{:6d} {}\n".format(count, stack))
+
+        memory_path = os.path.join(self.out_dir,
+                                   "tracemalloc-{}.txt".format(stamp))
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        with open(memory_path, "w") as f:
+            for stat in snapshot.statistics("traceback")[:TRACEMALLOC_TOP]:
+                f.write("{} KiB in {} blocks\n".format(
+                    stat.size // 1024, stat.count
+                ))
+                for line in stat.traceback.format():
+                    f.write("    {}\n".format(line))
+        return [cpu_path, handlers_path, memory_path]
+
+
+class ControlServer:
+    """
+    Локальный управляющий сокет (UNIX-сокет) для запуска профилирования
+    без перезапуска бота:
+
+        echo "profile 30" | nc -U /tmp/feedbot.sock
+
+    В ответ после окончания сеанса приходят пути к файлам с результатами.
+    """
+
+    def __init__(self, profiler: Profiler, path: str):
+        self.profiler = profiler
+        self.path = path
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(1)
+        self._thread = threading.Thread(target=self._serve,
+                                        name="control-socket", daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    request = conn.recv(1024).decode("utf-8", "replace")
+                    conn.sendall(self.handle(request).encode("utf-8"))
+                except Exception as e:
+                    print("Error in ControlServer: {}\n{}".format(
+                        str(e), traceback.format_exc()
+                    ))
+
+    def handle(self, request: str) -> str:
+        parts = request.split()
+        if len(parts) != 2 or parts[0] != "profile":
+            return "usage: profile <seconds>\n"
+        seconds, error = parse_seconds(parts[1])
+        if error:
+            return error + "\n"
+
+        done = threading.Event()
+        if not self.profiler.trigger(seconds, lambda files: done.set()):
+            return "profiling is already running\n"
+        done.wait()
+        return "\n".join(self.profiler.last_files) + "\n"
+
+    def stop(self):
+        if self._sock is not None:
+            # shutdown() будит поток, ждущий в accept().
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._sock = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def parse_seconds(value: str) -> Tuple[float, Union[str, None]]:
+    """
+    Разбирает длительность сеанса профилирования.
+    :return: (секунды, None) или (0, описание ошибки).
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        return 0.0, "bad duration: {}".format(value)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return 0.0, "duration should be in (0, {}]".format(MAX_PROFILE_SECONDS)
+    return seconds, None
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import traceback
+
+from typing import Callable, List, NamedTuple, Set
+from telegram.error import Unauthorized
+
+# Фрагменты текста ошибки 403, которые Телеграм возвращает, если
+# пользователь больше не может получать сообщения от бота.
+BLOCKED_ERROR_MARKERS = (
+    "bot was blocked by the user",
+    "user is deactivated",
+)
+
+# Ошибки 403, которые не означают блокировку: например, пользователь не
+# начинал работу с ботом, от имени которого отправлено сообщение.
+NOT_BLOCKED_ERROR_MARKERS = (
+    "bot can't initiate conversation with a user",
+)
+
+
+def is_blocked_error(error: BaseException) -> bool:
+    """
+    Проверяет, означает ли ошибка отправки, что пользователь заблокировал
+    бота (или удалил аккаунт).
+    """
+    message = str(getattr(error, "message", error)).lower()
+    if any(marker in message for marker in NOT_BLOCKED_ERROR_MARKERS):
+        return False
+    if any(marker in message for marker in BLOCKED_ERROR_MARKERS):
+        return True
+    return isinstance(error, Unauthorized) and "forbidden" in message
+
+
+class ReaperProgress(NamedTuple):
+    deleted: int
+    processed: int
+    remaining: int
+    chunks: int
+
+
+class BlockedUsersReaper:
+    """
+    Накапливает ID пользователей, заблокировавших бота (по ошибкам доставки),
+    и удаляет их из хранилища пачками через Store.delete_users_bulk().
+
+    Нагрузка на БД ограничивается параметром load_budget - долей времени,
+    которую удаление может занимать: после пачки, выполнявшейся t секунд,
+    делается пауза t * (1 - load_budget) / load_budget.
+    """
+
+    def __init__(self,
+                 store,
+                 chunk_size: int = 500,
+                 load_budget: float = 0.2,
+                 on_progress: Callable[[ReaperProgress], None] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        if not 0 < load_budget <= 1:
+            raise ValueError("load_budget should be in (0, 1].")
+        self.store = store
+        self.chunk_size = chunk_size
+        self.load_budget = load_budget
+        self.on_progress = on_progress
+        self._sleep = sleep
+
+        self._pending = set()  # type: Set[int]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.total_deleted = 0
+
+    def report_blocked(self, tg_id: int):
+        with self._lock:
+            self._pending.add(tg_id)
+
+    def report_failure(self, tg_id: int, error: BaseException) -> bool:
+        """
+        Регистрирует ошибку доставки пользователю. Если ошибка означает
+        блокировку бота - пользователь ставится в очередь на удаление.
+        :return: True, если пользователь поставлен в очередь.
+        """
+        if not is_blocked_error(error):
+            return False
+        self.report_blocked(tg_id)
+        return True
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _take_chunk(self) -> List[int]:
+        with self._lock:
+            chunk = []
+            while self._pending and len(chunk) < self.chunk_size:
+                chunk.append(self._pending.pop())
+            return chunk
+
+    def _return_chunk(self, chunk: List[int]):
+        with self._lock:
+            self._pending.update(chunk)
+
+    def run_once(self) -> int:
+        """
+        Удаляет всех накопленных на данный момент пользователей.
+        :return: количество удаленных пользователей.
+        """
+        deleted = processed = chunks = 0
+        while not self._stop.is_set():
+            chunk = self._take_chunk()
+            if not chunk:
+                break
+
+            started = time.monotonic()
+            try:
+                deleted += self.store.delete_users_bulk(chunk)
+            except BaseException:
+                self._return_chunk(chunk)
+                raise
+            elapsed = time.monotonic() - started
+
+            processed += len(chunk)
+            chunks += 1
+            if self.on_progress is not None:
+                self.on_progress(ReaperProgress(
+                    deleted, processed, self.pending_count(), chunks
+                ))
+
+            if self.pending_count():
+                self._sleep(elapsed * (1 - self.load_budget) / self.load_budget)
+
+        self.total_deleted += deleted
+        return deleted
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Error in BlockedUsersReaper.run_once(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start(self, interval: float = 60.0):
+        """
+        Запускает фоновый поток, который раз в interval секунд удаляет
+        накопленных пользователей.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(interval,), name="reaper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import html
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, NamedTuple, Tuple, Union
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from const import get_constants
+
+FULL = "full"
+PREVIEW = "preview"
+
+# Ограничения Bot API на длину текста сообщения и подписи к медиа.
+MAX_TEXT_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+PREVIEW_LENGTH = 300
+
+# Тип медиа в посте -> метод Bot API и имя параметра с файлом.
+MEDIA_METHODS = {
+    "photo": ("send_photo", "photo"),
+    "video": ("send_video", "video"),
+    "animation": ("send_animation", "animation"),
+    "document": ("send_document", "document"),
+}
+
+
+class Rendered(NamedTuple):
+    """
+    Готовое к отправке сообщение: метод Bot API и его аргументы без
+    chat_id. media_param - имя аргумента с файлом, если в сообщении есть
+    медиа; ключом в FileIdCache служит хэш содержимого медиа (media_hash,
+    см. mediacache), если он известен, иначе URL.
+    """
+    method: str
+    kwargs: Dict[str, Any]
+    media_param: Union[str, None] = None
+    media_hash: Union[str, None] = None
+
+    @property
+    def media_key(self) -> Union[str, None]:
+        if not self.media_param:
+            return None
+        return self.media_hash or self.kwargs[self.media_param]
+
+
+# Параметр /start, с которым бот открывает пост и записывает переход.
+OPEN_POST_PREFIX = "open_"
+
+
+def post_link(channel: str, msg_id: int) -> str:
+    """
+    Ссылка на пост в канале channel (имя канала с @ или без).
+    """
+    return "https://t.me/{}/{}".format(channel.lstrip("@"), msg_id)
+
+
+def open_post_link(bot_username: str) -> str:
+    """
+    Шаблон open_link для Renderer: deep link на бота, который передает
+    команде /start параметр "open_<ID канала>_<ID сообщения>".
+    """
+    return "https://t.me/{}?start={}{{channel_id}}_{{msg_id}}".format(
+        bot_username.lstrip("@"), OPEN_POST_PREFIX
+    )
+
+
+def parse_open_post(param: str) -> Union[Tuple[int, int], None]:
+    """
+    Разбирает параметр /start из open_post_link().
+    :return: пара (ID канала, ID сообщения) или None.
+    """
+    if not param.startswith(OPEN_POST_PREFIX):
+        return None
+    try:
+        channel_id, msg_id = map(int, param[len(OPEN_POST_PREFIX):].split("_"))
+    except ValueError:
+        return None
+    return channel_id, msg_id
+
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1].rstrip() + "…"
+
+
+class Renderer:
+    """
+    Рендерит посты в сообщения для рассылки и хранит результат в LRU-кэше
+    по ключу (канал, пост, язык, вариант), поэтому при рассылке одного
+    поста всем подписчикам текст и разметка собираются один раз на язык.
+
+    Пост - словарь data из архива (archive.Post): "text", "channel" (имя
+    канала без @) и необязательное "media" - {"type": ..., "url": ...}.
+
+    Если задан open_link, кнопка "Открыть пост" ведет по этому шаблону с
+    подстановкой {channel_id} и {msg_id} (например, на deep link бота, см.
+    open_post_link()), а не сразу на пост в канале - так бот узнает о
+    переходах.
+    """
+
+    def __init__(self, max_entries: int = 10000, open_link: str = None):
+        self.max_entries = max_entries
+        self.open_link = open_link
+        self._cache = OrderedDict()  # type: OrderedDict[Tuple, Rendered]
+        self._consts = {}  # type: Dict[str, Dict[str, str]]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _constants(self, lang: str) -> Dict[str, str]:
+        consts = self._consts.get(lang)
+        if consts is None:
+            consts = self._consts[lang] = get_constants(lang)
+        return consts
+
+    def render(self,
+               channel_id: int,
+               msg_id: int,
+               data: Dict[str, Any],
+               lang: str = "ru",
+               variant: str = FULL) -> Rendered:
+        """
+        Возвращает сообщение для поста, при необходимости отрендерив его.
+        :param channel_id: ID канала в БД.
+        :param msg_id: ID сообщения в канале.
+        :param data: данные поста.
+        :param lang: язык шаблонов (ключ в const.py).
+        :param variant: FULL - весь текст, PREVIEW - начало текста с кнопкой
+        перехода к посту.
+        """
+        key = (channel_id, msg_id, lang, variant)
+        with self._lock:
+            rendered = self._cache.get(key)
+            if rendered is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return rendered
+
+        rendered = self._render(channel_id, msg_id, data, lang, variant)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = rendered
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return rendered
+
+    def invalidate(self, channel_id: int, msg_id: int):
+        """
+        Удаляет все варианты поста из кэша (например, после его правки).
+        """
+        with self._lock:
+            for key in [k for k in self._cache if k[:2] == (channel_id, msg_id)]:
+                del self._cache[key]
+
+    def _render(self,
+                channel_id: int,
+                msg_id: int,
+                data: Dict[str, Any],
+                lang: str,
+                variant: str) -> Rendered:
+        consts = self._constants(lang)
+        channel = data.get("channel", "")
+        media = data.get("media")
+        limit = MAX_CAPTION_LENGTH if media else MAX_TEXT_LENGTH
+
+        header = consts["post_header"].format(html.escape(channel)) \
+            if channel else ""
+        text = data.get("text") or ""
+        if variant == PREVIEW:
+            text = _truncate(text, PREVIEW_LENGTH)
+        # Лимиты Bot API считаются по тексту после разбора разметки.
+        text = header + html.escape(_truncate(text, limit - len(header)))
+
+        kwargs = {"parse_mode": "HTML"}  # type: Dict[str, Any]
+        if channel:
+            if self.open_link is not None:
+                url = self.open_link.format(channel_id=channel_id,
+                                            msg_id=msg_id)
+            else:
+                url = post_link(channel, msg_id)
+            kwargs["reply_markup"] = InlineKeyboardMarkup([[
+                InlineKeyboardButton(consts["open_post"], url=url)
+            ]])
+
+        if media and media.get("type") in MEDIA_METHODS:
+            method, param = MEDIA_METHODS[media["type"]]
+            kwargs[param] = media["url"]
+            kwargs["caption"] = text
+            return Rendered(method, kwargs, media_param=param,
+                            media_hash=media.get("sha256"))
+
+        kwargs["text"] = text
+        kwargs["disable_web_page_preview"] = variant == PREVIEW
+        return Rendered("send_message", kwargs)
+
+
+def _sent_file_id(message) -> Union[str, None]:
+    if message is None:
+        return None
+    if getattr(message, "photo", None):
+        return message.photo[-1].file_id
+    for attr in ("video", "animation", "document"):
+        media = getattr(message, attr, None)
+        if media is not None:
+            return media.file_id
+    return None
+
+
+class FileIdCache:
+    """
+    Соответствие "ключ медиа (URL) -> file_id Телеграма". После первой
+    загрузки файла остальным подписчикам отправляется его file_id, и
+    Телеграм не скачивает файл заново.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._file_ids = OrderedDict()  # type: OrderedDict[Hashable, str]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._file_ids)
+
+    def get(self, key: Hashable) -> Union[str, None]:
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+            return file_id
+
+    def put(self, key: Hashable, file_id: str):
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            if len(self._file_ids) > self.max_entries:
+                self._file_ids.popitem(last=False)
+
+
+class Sender:
+    """
+    Отправляет отрендеренные сообщения, подставляя file_id уже
+    загруженных медиа. Первая загрузка каждого файла выполняется под
+    блокировкой, чтобы параллельные отправки не загружали его повторно.
+
+    С локальным кэшем медиа (mediacache.MediaCache) первая загрузка идет
+    из файла в кэше, а не по URL, и file_id запоминается в кэше - так он
+    переживает рестарт и общий для постов с тем же содержимым.
+    """
+
+    def __init__(self, bot, file_ids: FileIdCache = None, media=None):
+        self.bot = bot
+        self.file_ids = file_ids if file_ids is not None else FileIdCache()
+        self.media = media
+        self._upload_lock = threading.Lock()
+
+    def send(self, chat_id: int, rendered: Rendered):
+        if rendered.media_key is None:
+            return self._call(chat_id, rendered, rendered.kwargs)
+
+        file_id = self._known_file_id(rendered)
+        if file_id is None:
+            with self._upload_lock:
+                file_id = self._known_file_id(rendered)
+                if file_id is None:
+                    return self._upload(chat_id, rendered)
+
+        kwargs = dict(rendered.kwargs)
+        kwargs[rendered.media_param] = file_id
+        return self._call(chat_id, rendered, kwargs)
+
+    def _known_file_id(self, rendered: Rendered) -> Union[str, None]:
+        file_id = self.file_ids.get(rendered.media_key)
+        if file_id is None and self.media is not None and rendered.media_hash:
+            file_id = self.media.file_id(rendered.media_hash)
+            if file_id is not None:
+                self.file_ids.put(rendered.media_key, file_id)
+        return file_id
+
+    def _upload(self, chat_id: int, rendered: Rendered):
+        local = None
+        if self.media is not None and rendered.media_hash:
+            local = self.media.open(rendered.media_hash)
+        kwargs = rendered.kwargs
+        if local is not None:
+            kwargs = dict(kwargs)
+            kwargs[rendered.media_param] = local
+        try:
+            message = self._call(chat_id, rendered, kwargs)
+        finally:
+            if local is not None:
+                local.close()
+        file_id = _sent_file_id(message)
+        if file_id is not None:
+            self.file_ids.put(rendered.media_key, file_id)
+            if self.media is not None and rendered.media_hash:
+                self.media.set_file_id(rendered.media_hash, file_id)
+        return message
+
+    def _call(self, chat_id: int, rendered: Rendered, kwargs: Dict[str, Any]):
+        return getattr(self.bot, rendered.method)(chat_id=chat_id, **kwargs)
+
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import re
+import heapq
+import threading
+
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+STOP_WORDS = {
+    # en
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in",
+    "is", "it", "of", "on", "or", "that", "the", "to", "was", "with",
+    # ru
+    "а", "в", "во", "да", "для", "до", "же", "за", "и", "из", "или", "к",
+    "как", "на", "не", "но", "о", "об", "от", "по", "с", "со", "у", "что",
+    "это",
+}
+
+# Окончания, которые отбрасываются, чтобы разные формы слова попадали в
+# один терм. Проверяются от длинных к коротким.
+RU_ENDINGS = sorted((
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ией",
+    "ах", "ях", "ам", "ям", "ов", "ев", "ей", "ой", "ий", "ый", "ая", "яя",
+    "ое", "ее", "ые", "ие", "ую", "юю", "ом", "ем", "ию", "ия", "ть",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+), key=len, reverse=True)
+EN_ENDINGS = ("ing", "ies", "es", "ed", "s")
+
+MIN_STEM = 3
+
+
+def _is_cyrillic(word: str) -> bool:
+    return "а" <= word[0] <= "я"
+
+
+def stem(word: str) -> str:
+    """
+    Упрощенный стемминг: отрезает типичное окончание русского или
+    английского слова, если после этого остается не меньше MIN_STEM символов.
+    """
+    endings = RU_ENDINGS if _is_cyrillic(word) else EN_ENDINGS
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Разбивает текст на термы: слова в нижнем регистре (ё заменяется на е)
+    без стоп-слов, приведенные к основе.
+    """
+    terms = []
+    for word in WORD_RE.findall((text or "").lower().replace("ё", "е")):
+        if word in STOP_WORDS or (len(word) < 2 and not word.isdigit()):
+            continue
+        terms.append(stem(word))
+    return terms
+
+
+class SearchIndex:
+    """
+    Инвертированный индекс по текстам постов в памяти для команды /search.
+
+    Каждый пост получает порядковый номер при индексации. Для каждого терма
+    хранятся отсортированные массивы номеров постов отдельно по каналам,
+    поэтому поиск сразу ограничивается каналами пользователя, а
+    пересечение списков идет от самого короткого с бинарным поиском по
+    остальным. Результаты возвращаются от новых постов к старым.
+    """
+
+    def __init__(self):
+        self._postings = {}  # type: Dict[str, Dict[int, array]]
+        self._doc_channels = array("Q")
+        self._doc_msg_ids = array("Q")
+        self._last_msg_ids = {}  # type: Dict[int, int]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._doc_msg_ids)
+
+    def add_post(self, channel_id: int, msg_id: int, text: str) -> bool:
+        """
+        Добавляет пост в индекс. Посты канала должны добавляться в порядке
+        возрастания ID; уже проиндексированные посты пропускаются.
+        :return: True, если пост добавлен.
+        """
+        terms = set(tokenize(text))
+        with self._lock:
+            if msg_id <= self._last_msg_ids.get(channel_id, 0):
+                return False
+            self._last_msg_ids[channel_id] = msg_id
+
+            doc = len(self._doc_msg_ids)
+            self._doc_channels.append(channel_id)
+            self._doc_msg_ids.append(msg_id)
+            for term in terms:
+                by_channel = self._postings.setdefault(term, {})
+                docs = by_channel.get(channel_id)
+                if docs is None:
+                    docs = by_channel[channel_id] = array("Q")
+                docs.append(doc)
+            return True
+
+    def add_posts(self, posts: Iterable) -> int:
+        """
+        Индексирует посты из архива (объекты archive.Post).
+        :return: количество добавленных постов.
+        """
+        added = 0
+        for post in posts:
+            if self.add_post(post.channel_id, post.msg_id,
+                             post.data.get("text", "")):
+                added += 1
+        return added
+
+    def build_from_archive(self, archive) -> int:
+        """
+        Индексирует все посты, которые есть в архиве (archive.PostArchive).
+        """
+        added = 0
+        for channel_id in archive.channel_ids():
+            after = self._last_msg_ids.get(channel_id, 0)
+            added += self.add_posts(archive.read_after(channel_id, after))
+        return added
+
+    @staticmethod
+    def _contains(docs: array, doc: int) -> bool:
+        i = bisect_left(docs, doc)
+        return i < len(docs) and docs[i] == doc
+
+    def _channel_matches(self,
+                         lists: List[array]) -> Iterator[int]:
+        lists = sorted(lists, key=len)
+        shortest, others = lists[0], lists[1:]
+        for doc in reversed(shortest):
+            if all(self._contains(docs, doc) for docs in others):
+                yield doc
+
+    def search(self,
+               query: str,
+               channel_ids: Iterable[int],
+               limit: int = 10) -> List[Tuple[int, int]]:
+        """
+        Ищет посты, содержащие все слова запроса, в переданных каналах.
+        :param query: поисковый запрос.
+        :param channel_ids: ID каналов, в которых нужно искать.
+        :param limit: максимальное количество результатов.
+        :return: список пар (ID канала, ID сообщения) от новых к старым.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            per_term = [self._postings.get(term) for term in terms]
+            if not all(per_term):
+                return []
+
+            channels = set(channel_ids)  # type: Set[int]
+            for by_channel in per_term:
+                channels &= by_channel.keys()
+
+            streams = [
+                self._channel_matches([by_channel[channel_id]
+                                       for by_channel in per_term])
+                for channel_id in channels
+            ]
+            newest = heapq.merge(*streams, reverse=True)
+            return [
+                (self._doc_channels[doc], self._doc_msg_ids[doc])
+                for doc in islice(newest, limit)
+            ]
@@ -0,0 +1,662 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import zlib
+import threading
+import traceback
+import multiprocessing
+
+from queue import Empty
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, \
+    Tuple, Union
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import tracing
+import deliverylog
+from deliverylog import DeliveryLog
+from deferred import DeliveryScheduler
+from kwfilter import FilterIndex
+from reaper import is_blocked_error
+
+# Пользователи раскладываются по фиксированному числу виртуальных слотов, а
+# слоты - по шардам. При изменении числа шардов переезжают целые слоты
+# вместе со своими журналами доставки.
+NUM_SLOTS = 1024
+
+# send(tg_id, payload, bot): bot - ID бота, от имени которого отправляется
+# сообщение (None - бот по умолчанию).
+SendFunc = Callable[[int, Dict[str, Any], Union[str, None]], None]
+
+
+# Как часто (в секундах) шард записывает накопленные события доставки в
+# журнал, не дожидаясь полного чанка: иначе при небольшом потоке рассылок
+# они видны запросам только после остановки шарда.
+EVENTS_FLUSH_INTERVAL = 60.0
+
+
+def slot_for(tg_id: int) -> int:
+    return zlib.crc32(str(tg_id).encode()) % NUM_SLOTS
+
+
+def shard_for_slot(slot: int, num_shards: int) -> int:
+    return slot * num_shards // NUM_SLOTS
+
+
+def shard_for(tg_id: int, num_shards: int) -> int:
+    return shard_for_slot(slot_for(tg_id), num_shards)
+
+
+def slots_of(shard: int, num_shards: int) -> List[int]:
+    return [slot for slot in range(NUM_SLOTS)
+            if shard_for_slot(slot, num_shards) == shard]
+
+
+class Delivery(NamedTuple):
+    seq: int
+    tg_id: int
+    payload: Dict[str, Any]
+    bot: Union[str, None] = None
+
+
+def _slot_path(root: str, slot: int, ext: str) -> str:
+    return os.path.join(root, "slot-{:04d}.{}".format(slot, ext))
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Проверяет, имеет ли смысл повторить отправку: Телеграм просит
+    подождать (429) или запрос не дошел из-за сети.
+    """
+    if isinstance(error, RetryAfter):
+        return True
+    return isinstance(error, NetworkError) and \
+        not isinstance(error, BadRequest)
+
+
+class SlotJournal:
+    """
+    Журнал доставок одного слота: для каждого пользователя хранится номер
+    последнего доставленного ему поста. Каждая доставка дописывается в конец
+    журнала, а compact() сворачивает журнал в снимок.
+
+    Сообщения, которые не удалось доставить из-за временной ошибки,
+    откладываются (hold()) в файл повторов слота вместе со всеми следующими
+    сообщениями того же пользователя - отметка доставки не уходит дальше
+    недоставленного сообщения. Отложенное сообщение считается
+    выполненным, когда отметка доставки доходит до его номера.
+    """
+
+    def __init__(self, root: str, slot: int):
+        self.snapshot_path = _slot_path(root, slot, "json")
+        self.log_path = _slot_path(root, slot, "log")
+        self.retry_path = _slot_path(root, slot, "retry")
+        self.watermarks = {}  # type: Dict[int, int]
+        self.held = OrderedDict()  # type: OrderedDict[int, List[Delivery]]
+        self._log = None
+        self._retry_log = None
+        self._records = 0
+        self._load()
+
+    @staticmethod
+    def _read_lines(path: str) -> Iterable[str]:
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                # Последняя строка может быть недописана при падении.
+                if line.endswith("\n"):
+                    yield line
+
+    def _load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                self.watermarks = {int(k): v for k, v in json.load(f).items()}
+        for line in self._read_lines(self.log_path):
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            tg_id, seq = int(parts[0]), int(parts[1])
+            if seq > self.watermarks.get(tg_id, 0):
+                self.watermarks[tg_id] = seq
+        for line in self._read_lines(self.retry_path):
+            delivery = Delivery(*json.loads(line))
+            if not self.delivered(delivery.tg_id, delivery.seq):
+                self.held.setdefault(delivery.tg_id, []).append(delivery)
+
+    def delivered(self, tg_id: int, seq: int) -> bool:
+        return seq <= self.watermarks.get(tg_id, 0)
+
+    def record(self, tg_id: int, seq: int):
+        if self._log is None:
+            self._log = open(self.log_path, "a")
+        self._log.write("{} {}\n".format(tg_id, seq))
+        self._log.flush()
+        self.watermarks[tg_id] = seq
+        self._records += 1
+
+    def hold(self, delivery: Delivery):
+        """
+        Откладывает сообщение до повтора.
+        """
+        if self._retry_log is None:
+            self._retry_log = open(self.retry_path, "a")
+        self._retry_log.write(json.dumps(list(delivery)) + "\n")
+        self._retry_log.flush()
+        self.held.setdefault(delivery.tg_id, []).append(delivery)
+
+    def release(self, tg_id: int):
+        """
+        Убирает первое отложенное сообщение пользователя после того, как
+        оно доставлено (или доставлять его больше не нужно).
+        """
+        held = self.held[tg_id]
+        held.pop(0)
+        if not held:
+            del self.held[tg_id]
+
+    def compact(self):
+        self._compact_held()
+        if not self._records:
+            return
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.watermarks, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        open(self.log_path, "w").close()
+        self._records = 0
+
+    def _compact_held(self):
+        if self._retry_log is not None:
+            self._retry_log.close()
+            self._retry_log = None
+        if not self.held:
+            if os.path.exists(self.retry_path):
+                os.remove(self.retry_path)
+            return
+        tmp_path = self.retry_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for deliveries in self.held.values():
+                for delivery in deliveries:
+                    f.write(json.dumps(list(delivery)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.retry_path)
+
+    def close(self):
+        for name in ("_log", "_retry_log"):
+            log = getattr(self, name)
+            if log is not None:
+                log.close()
+                setattr(self, name, None)
+
+
+class ShardWorker:
+    """
+    Воркер доставки одного шарда. Обрабатывает доставки строго по одной в
+    порядке поступления, поэтому порядок сообщений каждого пользователя
+    сохраняется. Перед отправкой проверяет журнал слота, поэтому после
+    рестарта или перебалансировки уже доставленное не отправляется повторно.
+
+    Повтор возможен только для сообщения, отправленного прямо перед падением
+    процесса, но не успевшего попасть в журнал.
+
+    При RetryAfter (429) и сетевых ошибках отправка повторяется до
+    max_attempts раз с паузой (для RetryAfter - сколько просит Телеграм).
+    Если и это не помогло, сообщение и все следующие сообщения пользователя
+    откладываются в журнал слота и повторяются через retry_held() с
+    растущей паузой, в том числе после рестарта. Сообщения, которые
+    доставить нельзя (блокировка бота, BadRequest), отмечаются в журнале
+    как выполненные и не повторяются.
+    """
+
+    def __init__(self,
+                 shard: int,
+                 num_shards: int,
+                 journal_dir: str,
+                 send: SendFunc,
+                 on_error: Callable[[int, BaseException], None] = None,
+                 compact_every: int = 10000,
+                 on_trace: Callable[[int, Dict[str, Any]], None] = None,
+                 events: DeliveryLog = None,
+                 max_attempts: int = 3,
+                 retry_delay: float = 1.0,
+                 max_retry_delay: float = 600.0,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        :param on_trace: вызывается с tg_id и трассой после отправки поста
+        с контекстом трассировки (см. модуль tracing).
+        :param events: журнал, в который пишется результат каждой отправки
+        (канал берется из payload["channel_id"]).
+        :param retry_delay: пауза перед первым повтором; дальше она
+        удваивается, но не превышает max_retry_delay.
+        """
+        self.shard = shard
+        self.num_shards = num_shards
+        self.journal_dir = journal_dir
+        self.send = send
+        self.on_error = on_error
+        self.compact_every = compact_every
+        self.on_trace = on_trace
+        self.events = events
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._clock = clock
+        self._sleep = sleep
+
+        self._journals = {}  # type: Dict[int, SlotJournal]
+        # Пользователь с отложенными сообщениями -> (время повтора, число
+        # неудачных повторов).
+        self._retries = {}  # type: Dict[int, Tuple[float, int]]
+        self._next_retry = float("inf")
+        self.sent = 0
+        self.skipped = 0
+
+        # Отложенные сообщения слотов шарда, оставшиеся с прошлого запуска.
+        for slot in slots_of(shard, num_shards):
+            if os.path.exists(_slot_path(journal_dir, slot, "retry")):
+                for tg_id in self._journal(slot).held:
+                    self._retries[tg_id] = (0.0, 0)
+                    self._next_retry = 0.0
+
+    def _journal(self, slot: int) -> SlotJournal:
+        journal = self._journals.get(slot)
+        if journal is None:
+            journal = self._journals[slot] = SlotJournal(self.journal_dir, slot)
+        return journal
+
+    @property
+    def held(self) -> int:
+        """
+        Сколько сообщений отложено для повтора.
+        """
+        return sum(len(deliveries) for journal in self._journals.values()
+                   for deliveries in journal.held.values())
+
+    def handle(self, delivery: Delivery):
+        slot = slot_for(delivery.tg_id)
+        if shard_for_slot(slot, self.num_shards) != self.shard:
+            raise ValueError("User {} doesn't belong to shard {}.".format(
+                delivery.tg_id, self.shard
+            ))
+
+        journal = self._journal(slot)
+        if journal.delivered(delivery.tg_id, delivery.seq):
+            self.skipped += 1
+            return
+        # Пока есть отложенные сообщения, новые встают за ними.
+        if delivery.tg_id in journal.held:
+            journal.hold(delivery)
+            return
+        if not self._deliver(journal, delivery):
+            journal.hold(delivery)
+            self._schedule_retry(delivery.tg_id, 0)
+
+    def _send(self, delivery: Delivery, payload: Dict[str, Any]):
+        attempt = 1
+        while True:
+            try:
+                self.send(delivery.tg_id, payload, delivery.bot)
+                return
+            except Exception as e:
+                if not is_transient_error(e) or attempt >= self.max_attempts:
+                    raise
+                if isinstance(e, RetryAfter):
+                    delay = e.retry_after
+                else:
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                self._sleep(min(delay, self.max_retry_delay))
+                attempt += 1
+
+    def _deliver(self, journal: SlotJournal, delivery: Delivery) -> bool:
+        """
+        Отправляет сообщение и отмечает результат в журналах.
+        :return: False, если сообщение нужно повторить позже.
+        """
+        payload = delivery.payload
+        traced = tracing.TRACE_KEY in payload
+        if traced:
+            payload = tracing.fork(payload)
+            tracing.mark(payload, tracing.FAN_OUT)
+        try:
+            self._send(delivery, payload)
+        except Exception as e:
+            blocked = is_blocked_error(e)
+            self._log_event(delivery, deliverylog.BLOCKED
+                            if blocked else deliverylog.FAILED)
+            transient = not blocked and is_transient_error(e)
+            if not transient:
+                self._record(journal, delivery)
+            if self.on_error is None:
+                raise
+            self.on_error(delivery.tg_id, e)
+            return not transient
+
+        self._log_event(delivery, deliverylog.SENT)
+        if traced and self.on_trace is not None:
+            tracing.mark(payload, tracing.SEND)
+            self.on_trace(delivery.tg_id, payload[tracing.TRACE_KEY])
+        self._record(journal, delivery)
+        return True
+
+    def _schedule_retry(self, tg_id: int, failures: int):
+        delay = min(self.retry_delay * 2 ** failures, self.max_retry_delay)
+        due = self._clock() + delay
+        self._retries[tg_id] = (due, failures + 1)
+        self._next_retry = min(self._next_retry, due)
+
+    def retry_held(self) -> int:
+        """
+        Повторяет отложенные сообщения пользователей, для которых подошло
+        время повтора, по порядку и до первой неудачи.
+        :return: сколько отложенных сообщений выполнено.
+        """
+        now = self._clock()
+        if now < self._next_retry:
+            return 0
+        self._next_retry = float("inf")
+        done = 0
+        for tg_id, (due, failures) in list(self._retries.items()):
+            if due > now:
+                self._next_retry = min(self._next_retry, due)
+                continue
+            journal = self._journal(slot_for(tg_id))
+            while tg_id in journal.held:
+                delivery = journal.held[tg_id][0]
+                if not journal.delivered(tg_id, delivery.seq) and \
+                        not self._deliver(journal, delivery):
+                    self._schedule_retry(tg_id, failures)
+                    break
+                journal.release(tg_id)
+                done += 1
+            else:
+                del self._retries[tg_id]
+        return done
+
+    def _record(self, journal: SlotJournal, delivery: Delivery):
+        journal.record(delivery.tg_id, delivery.seq)
+        self.sent += 1
+        if self.sent % self.compact_every == 0:
+            self.compact()
+
+    def _log_event(self, delivery: Delivery, kind: int):
+        if self.events is not None:
+            self.events.append(delivery.payload.get("channel_id", 0),
+                               delivery.tg_id, kind)
+
+    def compact(self):
+        for journal in self._journals.values():
+            journal.compact()
+
+    def close(self):
+        self.compact()
+        for journal in self._journals.values():
+            journal.close()
+        if self.events is not None:
+            self.events.close()
+
+
+def _run_worker(shard: int,
+                num_shards: int,
+                journal_dir: str,
+                send_factory: Callable[[int], SendFunc],
+                queue: multiprocessing.Queue,
+                blocked: multiprocessing.Queue,
+                traces: multiprocessing.Queue = None,
+                events_dir: str = None):
+    def on_error(tg_id: int, error: BaseException):
+        if is_blocked_error(error):
+            blocked.put(tg_id)
+            return
+        print("Error in delivery to {}: {}\n{}".format(
+            tg_id, str(error), traceback.format_exc()
+        ))
+
+    def on_trace(tg_id: int, trace: Dict[str, Any]):
+        traces.put((tg_id, trace))
+
+    events = DeliveryLog(events_dir, "shard-{}".format(shard)) \
+        if events_dir is not None else None
+    worker = ShardWorker(shard, num_shards, journal_dir, send_factory(shard),
+                         on_error=on_error,
+                         on_trace=on_trace if traces is not None else None,
+                         events=events)
+    flushed_at = time.monotonic()
+    try:
+        while True:
+            if events is not None and \
+                    time.monotonic() - flushed_at >= EVENTS_FLUSH_INTERVAL:
+                events.flush()
+                flushed_at = time.monotonic()
+            try:
+                item = queue.get(timeout=worker.retry_delay)
+            except Empty:
+                worker.retry_held()
+                continue
+            if item is None:
+                break
+            worker.handle(Delivery(*item))
+            worker.retry_held()
+    finally:
+        worker.close()
+
+
+class ShardedDelivery:
+    """
+    Локальный запуск доставки в num_shards процессах. Этап рассылки
+    (fan_out) раскладывает пары (пост, подписчик) по очередям шардов,
+    которым принадлежат подписчики.
+
+    send_factory(shard) вызывается внутри процесса шарда и возвращает
+    функцию send(tg_id, payload, bot) - так каждому процессу достаются свои
+    клиенты Телеграма.
+
+    Пользователи, заблокировавшие бота, передаются из процессов шардов в
+    on_blocked (например, BlockedUsersReaper.report_blocked) в основном
+    процессе, а трассы доставок постов с контекстом трассировки - в tracer.
+    Если задан events_dir, шарды пишут результаты отправок в общий
+    колоночный журнал deliverylog.DeliveryLog в этом каталоге.
+
+    Если задан filters, fan_out не ставит в очереди подписчиков, чьим
+    фильтрам по ключевым словам пост не подходит. Если задан scheduler,
+    доставки подписчикам в тихие часы, с дайджестом или при перегрузке
+    откладываются в нем; его send_batch должен вызывать route_batch().
+    """
+
+    def __init__(self,
+                 num_shards: int,
+                 journal_dir: str,
+                 send_factory: Callable[[int], SendFunc],
+                 on_blocked: Callable[[int], None] = None,
+                 queue_size: int = 10000,
+                 tracer: tracing.Tracer = None,
+                 events_dir: str = None,
+                 filters: FilterIndex = None,
+                 scheduler: DeliveryScheduler = None):
+        self.num_shards = num_shards
+        self.journal_dir = journal_dir
+        self.send_factory = send_factory
+        self.on_blocked = on_blocked
+        self.queue_size = queue_size
+        self.tracer = tracer
+        self.events_dir = events_dir
+        self.filters = filters
+        self.filtered = 0
+        self.scheduler = scheduler
+
+        self._queues = []  # type: List[multiprocessing.Queue]
+        self._processes = []  # type: List[multiprocessing.Process]
+        self._blocked = multiprocessing.Queue()
+        self._traces = multiprocessing.Queue() if tracer is not None else None
+        self._drain_threads = []  # type: List[tuple]
+        self._lock = threading.Lock()
+
+        os.makedirs(journal_dir, exist_ok=True)
+        self._seq_path = os.path.join(journal_dir, "seq")
+        self._last_seq = self._load_seq()
+
+    def start(self):
+        if not self._drain_threads:
+            if self.on_blocked is not None:
+                self._start_drain(self._blocked, self.on_blocked, "on_blocked")
+            if self.tracer is not None:
+                self._start_drain(
+                    self._traces,
+                    lambda item: self.tracer.record(item[1], item[0]),
+                    "tracer"
+                )
+
+        for shard in range(self.num_shards):
+            queue = multiprocessing.Queue(self.queue_size)
+            process = multiprocessing.Process(
+                target=_run_worker,
+                args=(shard, self.num_shards, self.journal_dir,
+                      self.send_factory, queue, self._blocked, self._traces,
+                      self.events_dir),
+                name="delivery-shard-{}".format(shard),
+                daemon=True,
+            )
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+
+    def stop(self):
+        """
+        Дожидается, пока шарды доставят все из своих очередей, и
+        останавливает их.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join()
+        self._queues, self._processes = [], []
+
+    def close(self):
+        self.stop()
+        for queue, thread in self._drain_threads:
+            queue.put(None)
+            thread.join()
+        self._drain_threads = []
+
+    def _start_drain(self, queue: multiprocessing.Queue, handle, name: str):
+        """
+        Запускает поток, передающий в handle все, что процессы шардов кладут
+        в queue.
+        """
+        thread = threading.Thread(target=self._drain,
+                                  args=(queue, handle, name),
+                                  name="delivery-" + name, daemon=True)
+        thread.start()
+        self._drain_threads.append((queue, thread))
+
+    @staticmethod
+    def _drain(queue: multiprocessing.Queue, handle, name: str):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            try:
+                handle(item)
+            except Exception as e:
+                print("Error in ShardedDelivery.{}(): {}\n{}".format(
+                    name, str(e), traceback.format_exc()
+                ))
+
+    def rebalance(self, num_shards: int):
+        """
+        Меняет количество шардов: останавливает текущие процессы и запускает
+        новые. Журналы лежат по слотам, поэтому новые владельцы слотов
+        продолжают с того же места.
+        """
+        self.stop()
+        self.num_shards = num_shards
+        self.start()
+
+    def _load_seq(self) -> int:
+        try:
+            with open(self._seq_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def next_seq(self) -> int:
+        """
+        Возрастающий номер поста. Основан на времени, но последний выданный
+        номер сохраняется рядом с журналами слотов, поэтому номера растут и
+        после рестарта, даже если часы ушли назад - иначе новые посты
+        оказались бы ниже отметок доставки в журналах и не были бы
+        доставлены.
+        """
+        with self._lock:
+            self._last_seq = max(self._last_seq + 1,
+                                 int(time.time() * 1000000000))
+            tmp_path = self._seq_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(str(self._last_seq))
+            os.replace(tmp_path, self._seq_path)
+            return self._last_seq
+
+    def _filter(self,
+                payload: Dict[str, Any],
+                subscribers: Mapping[int, int]) -> Iterable[int]:
+        channel_id = payload.get("channel_id")
+        if self.filters is None or not self.filters.has_filters(channel_id):
+            return subscribers
+        matched = set(self.filters.recipients(channel_id, subscribers.values(),
+                                              payload.get("text")))
+        recipients = [tg_id for tg_id, user_id in subscribers.items()
+                      if user_id in matched]
+        self.filtered += len(subscribers) - len(recipients)
+        return recipients
+
+    def route(self, delivery: Delivery):
+        shard = shard_for(delivery.tg_id, self.num_shards)
+        self._queues[shard].put(tuple(delivery))
+
+    def route_batch(self, tg_id: int, deliveries: List[Delivery]):
+        """
+        Ставит в очередь шарда отложенные планировщиком доставки.
+        """
+        for delivery in deliveries:
+            self.route(delivery)
+
+    def fan_out(self,
+                payload: Dict[str, Any],
+                subscribers: Union[Iterable[int], Mapping[int, int]],
+                seq: int = None,
+                bots: Mapping[int, str] = None) -> int:
+        """
+        Ставит пост в очереди доставки всех подписчиков.
+        :param payload: данные сообщения для отправки.
+        :param subscribers: ID подписчиков в Телеграме или словарь {ID в
+        Телеграме: ID пользователя в БД}. Фильтры подписок (ведутся по ID в
+        БД) применяются только во втором случае.
+        :param seq: номер поста; при повторной рассылке того же поста нужно
+        передать номер, полученный в первый раз.
+        :param bots: {ID в Телеграме: ID бота, через которого подписчик
+        начал работу (User.bot_id)}; остальным пост отправляется от имени
+        бота по умолчанию.
+        :return: номер поста.
+        """
+        seq = self.next_seq() if seq is None else seq
+        if isinstance(subscribers, Mapping):
+            subscribers = self._filter(payload, subscribers)
+        # Отметка ставится до постановки в очереди: очередь сериализует
+        # payload уже в своем потоке.
+        tracing.mark(payload, tracing.QUEUE)
+        for tg_id in subscribers:
+            delivery = Delivery(seq, tg_id, payload,
+                                bots.get(tg_id) if bots else None)
+            if self.scheduler is None or \
+                    self.scheduler.submit(tg_id, delivery):
+                self.route(delivery)
+        return seq
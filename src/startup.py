@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import threading
+import traceback
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+# Этот модуль - точка входа процесса бота (python startup.py). Он намеренно
+# не импортирует telegram и SQLAlchemy: health-эндпоинт поднимается сразу,
+# а тяжелые импорты и подключение к БД идут уже после него.
+
+PENDING = "pending"
+OK = "ok"
+FAILED = "failed"
+
+
+class Readiness:
+    """
+    Готовность процесса к работе: набор именованных проверок (импорты,
+    прогрев пула соединений и кэшей, запуск опроса). Каждая проверка
+    отмечается выполненной или неудачной, процесс готов, когда выполнены
+    все. Для каждой проверки запоминается время от старта процесса, что
+    заодно показывает, из чего складывается холодный старт. Кроме проверок,
+    в состояние можно добавить показатели работы (report()).
+    """
+
+    def __init__(self, checks: Iterable[str] = (),
+                 clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._started = clock()
+        self._checks = OrderedDict()  # type: Dict[str, Dict[str, Any]]
+        self._reports = OrderedDict()  # type: Dict[str, Callable[[], Any]]
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        for name in checks:
+            self.add(name)
+
+    def add(self, name: str):
+        with self._lock:
+            self._checks.setdefault(name, {"state": PENDING})
+            self._update()
+
+    def done(self, name: str):
+        self._set(name, {"state": OK})
+
+    def fail(self, name: str, error: str):
+        self._set(name, {"state": FAILED, "error": error})
+
+    def _set(self, name: str, check: Dict[str, Any]):
+        check["seconds"] = round(self._clock() - self._started, 3)
+        with self._lock:
+            self._checks[name] = check
+            self._update()
+
+    def _update(self):
+        if self._checks and all(check["state"] == OK
+                                for check in self._checks.values()):
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    def report(self, name: str, source: Callable[[], Any]):
+        """
+        Добавляет в status() показатель name: результат source().
+        """
+        self._reports[name] = source
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            checks = {name: dict(check)
+                      for name, check in self._checks.items()}
+        status = {
+            "ready": self.ready,
+            "uptime": round(self._clock() - self._started, 3),
+            "checks": checks,
+        }
+        for name, source in list(self._reports.items()):
+            status[name] = source()
+        return status
+
+
+def warm_up(readiness: Readiness,
+            steps: List[Tuple[str, Callable[[], Any]]],
+            retry_delay: float = 1.0,
+            max_retry_delay: float = 60.0,
+            attempts: int = None,
+            sleep: Callable[[float], None] = time.sleep) -> threading.Thread:
+    """
+    Выполняет шаги прогрева по очереди в фоновом потоке. Каждый шаг
+    регистрируется в readiness как проверка и отмечается по завершении.
+    Упавший шаг не мешает остальным: он отмечается неудачным и повторяется
+    после них с паузой, которая растет вдвое от retry_delay до
+    max_retry_delay, пока не выполнится или не исчерпает attempts попыток
+    (None - без ограничения). До этого процесс остается неготовым.
+    :param steps: пары (название, функция без аргументов).
+    :return: запущенный поток.
+    """
+    for name, _ in steps:
+        readiness.add(name)
+
+    def run():
+        pending = list(steps)
+        delay = retry_delay
+        attempt = 1
+        while True:
+            failed = []
+            for name, step in pending:
+                try:
+                    step()
+                except Exception as e:
+                    print("Error in warm_up() step {}: {}\n{}".format(
+                        name, str(e), traceback.format_exc()
+                    ))
+                    readiness.fail(name, str(e))
+                    failed.append((name, step))
+                else:
+                    readiness.done(name)
+            if not failed or attempts is not None and attempt >= attempts:
+                return
+            pending = failed
+            attempt += 1
+            sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.partition("?")[0]
+        readiness = self.server.readiness
+        if path == "/healthz":
+            status = readiness.status()
+            self._reply(200 if status["ready"] else 503, status)
+        elif path == "/livez":
+            self._reply(200, {"alive": True})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def _reply(self, code: int, body: Dict[str, Any]):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HealthServer(ThreadingMixIn, HTTPServer):
+    """
+    Локальный HTTP-эндпоинт состояния процесса:
+    - GET /healthz - 200, если процесс готов (прогрет и опрашивает Bot API),
+      иначе 503; в теле - состояние всех проверок;
+    - GET /livez - 200, пока процесс жив.
+    """
+    daemon_threads = True
+
+    def __init__(self, readiness: Readiness, address=("127.0.0.1", 0)):
+        super().__init__(address, _Handler)
+        self.readiness = readiness
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="health-server", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def parse_address(value: str) -> Tuple[str, int]:
+    """
+    Разбирает адрес вида "host:port" или ":port" (слушать все интерфейсы).
+    """
+    host, _, port = value.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+if __name__ == "__main__":
+    # "polling" регистрируется сразу, чтобы процесс не считался готовым,
+    # пока bot.main() не добавил свои проверки.
+    readiness = Readiness(["imports", "polling"])
+    server = HealthServer(
+        readiness, parse_address(os.getenv("HEALTH_ADDRESS", "127.0.0.1:8000"))
+    )
+    server.start()
+
+    import bot
+    readiness.done("imports")
+    bot.main(readiness)
+    server.stop()
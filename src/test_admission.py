@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import queue
+
+from types import SimpleNamespace
+
+from admission import (ADMIT, BACKGROUND, BULK, COALESCED, DEFER,
+                       INTERACTIVE, SHED, AdmissionController, AdmissionQueue)
+from deferred import DeliveryScheduler
+
+
+def command(update_id):
+    return SimpleNamespace(update_id=update_id, message=object(),
+                           callback_query=None)
+
+
+def edit(update_id, message_id):
+    post = SimpleNamespace(chat_id=-100, message_id=message_id)
+    return SimpleNamespace(update_id=update_id, message=None,
+                           callback_query=None, edited_channel_post=post)
+
+
+def test_controller_decisions():
+    now = [0.0]
+    controller = AdmissionController(db_latency_target=0.1, db_window=5,
+                                     clock=lambda: now[0])
+    depth = [0]
+    controller.add_queue("updates", lambda: depth[0], 100)
+    assert controller.admit(BULK) == ADMIT
+
+    depth[0] = 60
+    assert [controller.decide(p) for p in (INTERACTIVE, BULK, BACKGROUND)] \
+        == [ADMIT, DEFER, SHED]
+    depth[0] = 100
+    assert [controller.decide(p) for p in (INTERACTIVE, BULK, BACKGROUND)] \
+        == [SHED, SHED, SHED]
+
+    # Медленная БД создает нагрузку, пока замеры не устарели.
+    depth[0] = 0
+    controller.observe_db(0.07)
+    assert abs(controller.pressure() - 0.7) < 1e-9
+    assert controller.admit(BULK) == DEFER
+    now[0] = 6
+    assert controller.admit(BULK) == ADMIT
+    assert controller.stats()["bulk"] == {ADMIT: 2, DEFER: 1, SHED: 0,
+                                          COALESCED: 0}
+
+
+def test_queue_priority_coalescing_and_shedding():
+    controller = AdmissionController()
+    shed = []
+    updates = AdmissionQueue(controller, capacity=4, on_shed=shed.append)
+
+    updates.put(edit(1, message_id=7))
+    updates.put(edit(2, message_id=8))
+    updates.put(command(3))
+    # Новая правка поста заменяет ожидающую, а не занимает место в очереди.
+    updates.put(edit(4, message_id=7))
+    updates.put(ValueError("network error"))
+    assert updates.qsize() == 4
+
+    # Очередь заполнена: новые обновления отбрасываются, не блокируя опрос.
+    updates.put(command(5))
+    assert [update.update_id for update in shed] == [5]
+
+    items = [updates.get_nowait() for _ in range(4)]
+    assert [getattr(item, "update_id", None) for item in items] \
+        == [None, 3, 2, 4]
+    for _ in items:
+        updates.task_done()
+    updates.join()
+    try:
+        updates.get_nowait()
+        assert False
+    except queue.Empty:
+        pass
+
+    stats = controller.stats()
+    assert stats["interactive"][ADMIT] == 1
+    assert stats["interactive"][SHED] == 1
+    assert stats["bulk"][COALESCED] == 1
+
+
+def test_scheduler_defers_bulk_delivery_under_load():
+    depth = [0]
+    controller = AdmissionController()
+    controller.add_queue("shards", lambda: depth[0], 10)
+    sent = []
+    scheduler = DeliveryScheduler(lambda tg_id, items: sent.append(items),
+                                  admission=controller, defer_delay=30,
+                                  max_items=3)
+
+    assert scheduler.submit(1, "a", now=100)
+    depth[0] = 6
+    assert not scheduler.submit(1, "b", now=100)
+    assert not scheduler.submit(1, "c", now=110)
+    assert scheduler.next_due() == 130
+    # Пока у пользователя есть отложенные сообщения, новые идут за ними.
+    depth[0] = 0
+    assert not scheduler.submit(1, "d", now=120)
+    assert not scheduler.submit(2, "e", now=120)
+    assert scheduler.pending_items() == 3
+
+    depth[0] = 9
+    assert not scheduler.submit(3, "f", now=120)
+    assert scheduler.flush_due(now=130) == 1
+    assert sent == [["b", "c", "d"]]
+    assert scheduler.pending_items() == 0
+    assert controller.stats()["bulk"] == {ADMIT: 2, DEFER: 2, SHED: 2,
+                                          COALESCED: 0}
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+
+from archive import PostArchive, RECORD_HEADER
+
+
+def fill(archive, channel_id, msg_ids):
+    for msg_id in msg_ids:
+        assert archive.append(channel_id, msg_id, {"text": "post {}".format(msg_id)},
+                              date=1000.0 + msg_id)
+
+
+def test_append_and_read_after(tmp_path):
+    archive = PostArchive(str(tmp_path), segment_bytes=200, index_interval=64)
+    fill(archive, 1, range(1, 51))
+    fill(archive, 2, [7])
+
+    assert len(os.listdir(str(tmp_path / "1"))) > 2
+    assert [p.msg_id for p in archive.read_after(1)] == list(range(1, 51))
+    assert [p.msg_id for p in archive.read_after(1, 37)] == list(range(38, 51))
+    assert [p.msg_id for p in archive.read_after(1, 10, limit=3)] == [11, 12, 13]
+
+    post = next(archive.read_after(2))
+    assert (post.channel_id, post.msg_id, post.date) == (2, 7, 1007.0)
+    assert post.data == {"text": "post 7"}
+    assert list(archive.read_after(3)) == []
+
+    # Повторно пришедший пост не дублируется.
+    assert not archive.append(1, 50, {"text": "again"})
+    archive.close()
+
+
+def test_reopen_recovers_torn_tail(tmp_path):
+    archive = PostArchive(str(tmp_path), segment_bytes=200, index_interval=64)
+    fill(archive, 1, range(1, 21))
+    archive.close()
+
+    last_segment = sorted(
+        name for name in os.listdir(str(tmp_path / "1")) if name.endswith(".seg")
+    )[-1]
+    with open(str(tmp_path / "1" / last_segment), "ab") as f:
+        f.write(RECORD_HEADER.pack(21, 0.0, 100) + b"{")
+
+    archive = PostArchive(str(tmp_path), segment_bytes=200, index_interval=64)
+    assert archive.last_msg_id(1) == 20
+    fill(archive, 1, [21, 22])
+    assert [p.msg_id for p in archive.read_after(1, 15)] == [16, 17, 18, 19, 20,
+                                                            21, 22]
+    archive.close()
+
+
+def test_reopen_skips_empty_last_segment(tmp_path):
+    archive = PostArchive(str(tmp_path), segment_bytes=200, index_interval=64)
+    fill(archive, 1, range(1, 21))
+    archive.close()
+
+    # Падение сразу после создания сегмента и посреди первой записи в нем.
+    with open(str(tmp_path / "1" / "{:020d}.seg".format(21)), "wb") as f:
+        f.write(RECORD_HEADER.pack(21, 0.0, 100) + b"{")
+    open(str(tmp_path / "1" / "{:020d}.seg".format(22)), "wb").close()
+
+    archive = PostArchive(str(tmp_path), segment_bytes=200, index_interval=64)
+    assert archive.last_msg_id(1) == 20
+    assert not archive.append(1, 5, {"text": "old"})
+    fill(archive, 1, [21])
+    assert [p.msg_id for p in archive.read_after(1, 18)] == [19, 20, 21]
+    archive.close()
+
+
+def test_compaction(tmp_path):
+    archive = PostArchive(str(tmp_path), segment_bytes=200,
+                          max_channel_bytes=500)
+    fill(archive, 1, range(1, 51))
+
+    assert archive.compact() > 0
+    msg_ids = [p.msg_id for p in archive.read_after(1)]
+    assert msg_ids[-1] == 50
+    assert msg_ids == list(range(msg_ids[0], 51))
+    assert sum(os.path.getsize(str(tmp_path / "1" / name))
+               for name in os.listdir(str(tmp_path / "1"))
+               if name.endswith(".seg")) <= 500 + 200
+
+    archive.retention_seconds = 60
+    archive.max_channel_bytes = None
+    archive.compact(now=os.path.getmtime(str(tmp_path / "1")) + 3600)
+    segments = [n for n in os.listdir(str(tmp_path / "1")) if n.endswith(".seg")]
+    assert len(segments) == 1
+    archive.close()
@@ -2,10 +2,15 @@
 
 import os
 import unittest
+import tempfile
 
-from unittest.mock import Mock, MagicMock
-from bot import FeedBot
+from unittest.mock import Mock, MagicMock, patch
+from bot import FeedBot, post_sender
+from hosting import LimitedRequest
 from dal import User, Channel, Subscription
+from memstore import MemoryStore
+from profiler import Profiler
+from deliverylog import DeliveryLog
 from const import get_constants
 
 consts = get_constants(os.getenv("BOT_LANG", "ru").lower())
@@ -129,3 +134,251 @@ class TestFeedBotAddCommandOld(unittest.TestCase):
         self.bot.store.create_subscription.assert_called_once_with(
             self.user_stub.id, self.channel_stub.id
         )
+
+
+class TestFeedBotWithMemoryStore(unittest.TestCase):
+    def setUp(self) -> None:
+        # Вместо стабов используем хранилище в памяти, чтобы проверить
+        # сценарий добавления и удаления канала целиком.
+        self.store = MemoryStore()
+        self.user = self.store.create_user(tg_id=789, nickname="mem_user")
+        self.bot = FeedBot(store=self.store)
+
+    def test_add_and_delete_channel(self):
+        self.assertEqual(
+            consts["channel_have_added"].format("@test_channel"),
+            self.bot._handle_add_channel(self.user.tg_id, "@test_channel")
+        )
+        self.assertEqual(
+            consts["you_already_add_this_channel"],
+            self.bot._handle_add_channel(self.user.tg_id, "@test_channel")
+        )
+
+        channel = self.store.get_channel(title="@test_channel")
+        self.assertTrue(self.store.subscription_exists(self.user.id, channel.id))
+
+        self.assertEqual(
+            consts["channel_deleted"].format("@test_channel"),
+            self.bot._handle_delete_channel(self.user.tg_id, "@test_channel")
+        )
+        self.assertFalse(self.store.subscription_exists(self.user.id, channel.id))
+
+    def test_list_channels(self):
+        self.bot.list_cache.page_size = 1
+        text, markup = self.bot._handle_list(self.user.tg_id, 0)
+        self.assertEqual(consts["no_subscriptions"], text)
+        self.assertIsNone(markup)
+
+        self.bot._handle_add_channel(self.user.tg_id, "@first")
+        self.bot._handle_add_channel(self.user.tg_id, "@second")
+
+        text, markup = self.bot._handle_list(self.user.tg_id, 0)
+        self.assertEqual(consts["subscriptions_page"].format(1, "@first"), text)
+        self.assertEqual(["list:1"], [
+            button.callback_data for button in markup.inline_keyboard[0]
+        ])
+
+        self.bot._handle_delete_channel(self.user.tg_id, "@first")
+        text, markup = self.bot._handle_list(self.user.tg_id, 0)
+        self.assertEqual(consts["subscriptions_page"].format(1, "@second"), text)
+        self.assertIsNone(markup)
+
+    def test_top_channels(self):
+        self.assertEqual(consts["no_top_channels"], self.bot._handle_top())
+
+        other = self.store.create_user(tg_id=790, nickname="other_user")
+        self.bot._handle_add_channel(self.user.tg_id, "@first")
+        self.bot._handle_add_channel(self.user.tg_id, "@second")
+        self.bot._handle_add_channel(other.tg_id, "@second")
+
+        self.assertEqual(
+            consts["top_channels"].format("\n".join([
+                consts["top_channel_line"].format(1, "@second", 2),
+                consts["top_channel_line"].format(2, "@first", 1),
+            ])),
+            self.bot._handle_top()
+        )
+
+    def test_add_channel_with_typo(self):
+        self.bot._handle_add_channel(self.user.tg_id, "@python_news")
+
+        self.assertEqual(
+            consts["did_you_mean"].format("@python_news", "add", "@pyton_news"),
+            self.bot._handle_add_channel(self.user.tg_id, "@pyton_news")
+        )
+        self.assertIsNone(self.store.get_channel(title="@pyton_news"))
+
+        # Повторная команда подтверждает, что нужен именно этот канал.
+        self.assertEqual(
+            consts["channel_have_added"].format("@pyton_news"),
+            self.bot._handle_add_channel(self.user.tg_id, "@pyton_news")
+        )
+
+    def test_add_channel_in_other_case(self):
+        self.bot._handle_add_channel(self.user.tg_id, "@python_news")
+        other = self.store.create_user(tg_id=self.user.tg_id + 1)
+
+        # Имя в другом регистре - тот же канал, а не новый.
+        self.assertEqual(
+            consts["channel_have_added"].format("@python_news"),
+            self.bot._handle_add_channel(other.tg_id, "@Python_News")
+        )
+        self.assertEqual(1, len(self.store.get_channels()))
+        self.assertEqual(
+            consts["channel_deleted"].format("@python_news"),
+            self.bot._handle_delete_channel(other.tg_id, "@PYTHON_NEWS")
+        )
+
+    def test_quiet_hours_and_digest(self):
+        self.assertEqual(
+            consts["quiet_usage"].format("quiet", "quiet"),
+            self.bot._handle_quiet(self.user.tg_id, ["23:00"])
+        )
+        self.assertEqual(
+            consts["quiet_set"].format("23:00", "08:00", "+03:00"),
+            self.bot._handle_quiet(self.user.tg_id, ["23:00-08:00", "+3"])
+        )
+        self.assertEqual((23 * 60, 8 * 60, 180), (
+            self.user.quiet_from, self.user.quiet_to, self.user.utc_offset
+        ))
+        self.assertEqual(consts["quiet_cleared"],
+                         self.bot._handle_quiet(self.user.tg_id, ["off"]))
+        self.assertIsNone(self.user.quiet_from)
+
+        self.assertEqual(consts["digest_usage"].format("digest"),
+                         self.bot._handle_digest(self.user.tg_id, ["weekly"]))
+        self.assertEqual(consts["digest_set"].format("daily"),
+                         self.bot._handle_digest(self.user.tg_id, ["Daily"]))
+        self.assertEqual("daily", self.user.digest)
+        self.assertEqual(consts["digest_cleared"],
+                         self.bot._handle_digest(self.user.tg_id, ["off"]))
+        self.assertIsNone(self.user.digest)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            self.bot.profiler = Profiler(out_dir, interval=0.01)
+            self.assertEqual(
+                consts["profile_usage"].format("profile", 300),
+                self.bot._handle_profile(["forever"], None)
+            )
+            done = []
+            self.assertEqual(
+                consts["profiling_started"].format(0.05),
+                self.bot._handle_profile(["0.05"], done.append)
+            )
+            self.assertEqual(consts["profiling_busy"],
+                             self.bot._handle_profile(["0.05"], None))
+            self.bot.profiler.wait()
+            self.assertEqual(3, len(done[0]))
+
+    def test_bots_with_different_languages(self):
+        en_bot = FeedBot(store=self.store, lang="en")
+        ru_bot = FeedBot(store=self.store, lang="ru")
+        self.assertEqual(get_constants("en")["channel_name_is_empty"],
+                         en_bot._handle_add_channel(self.user.tg_id, ""))
+        self.assertEqual(get_constants("ru")["channel_name_is_empty"],
+                         ru_bot._handle_add_channel(self.user.tg_id, ""))
+
+    def test_start_remembers_bot(self):
+        update = Mock()
+        update.message.chat.id = 555
+        update.message.from_user.username = "new_user"
+        FeedBot(store=self.store, bot_id="456").start(None, update)
+        self.assertEqual("456", self.store.get_user(tg_id=555).bot_id)
+
+    def test_start_with_open_post_records_event(self):
+        self.bot._handle_add_channel(self.user.tg_id, "@first")
+        channel = self.store.get_channel(title="@first")
+        with tempfile.TemporaryDirectory() as root:
+            events = DeliveryLog(root)
+            bot = FeedBot(store=self.store, events=events)
+            update = Mock()
+            update.message.chat.id = self.user.tg_id
+            bot.start(None, update, ["open_{}_10".format(channel.id)])
+            update.message.reply_text.assert_called_once_with(
+                consts["post_link"].format("https://t.me/first/10")
+            )
+            bot.start(None, update, ["open_{}_10".format(channel.id + 1)])
+            update.message.reply_text.assert_called_with(
+                consts["post_not_found"]
+            )
+            stats = events.channel_stats(0, 2 ** 32 - 1)
+            self.assertEqual(1, stats[channel.id]["opened"])
+
+    def test_filter_channel(self):
+        self.assertEqual(
+            consts["start_required"].format("start"),
+            self.bot._handle_filter(-1, ["@first", "+python"])
+        )
+        self.assertEqual(
+            consts["no_such_channel_in_subs"].format("@first"),
+            self.bot._handle_filter(self.user.tg_id, ["@first", "+python"])
+        )
+
+        self.bot._handle_add_channel(self.user.tg_id, "@first")
+        self.assertEqual(
+            consts["filter_usage"].format("filter"),
+            self.bot._handle_filter(self.user.tg_id, ["@first", "python"])
+        )
+        self.assertEqual(
+            consts["filters_set"].format("@first", "+python -ads"),
+            self.bot._handle_filter(self.user.tg_id,
+                                    ["@first", "-ads", "+Python"])
+        )
+
+        channel = self.store.get_channel(title="@first")
+        sub, = self.store.get_subscriptions(channel_ids=[channel.id])
+        self.assertEqual("+python -ads", sub.filters)
+
+        self.assertEqual(
+            consts["filters_cleared"].format("@first"),
+            self.bot._handle_filter(self.user.tg_id, ["@first"])
+        )
+        self.assertIsNone(sub.filters)
+
+    def test_search_posts(self):
+        self.assertEqual(
+            consts["search_query_is_empty"].format("search"),
+            self.bot._handle_search(self.user.tg_id, " ")
+        )
+
+        self.bot._handle_add_channel(self.user.tg_id, "@first")
+        other = self.store.create_channel("@other")
+        first = self.store.get_channel(title="@first")
+        self.bot.search_index.add_post(first.id, 7, "Python release")
+        self.bot.search_index.add_post(other.id, 8, "Python release")
+
+        self.assertEqual(
+            consts["search_results"].format("https://t.me/first/7"),
+            self.bot._handle_search(self.user.tg_id, "python")
+        )
+        self.assertEqual(
+            consts["search_nothing_found"],
+            self.bot._handle_search(self.user.tg_id, "golang")
+        )
+
+
+class TestPostSender(unittest.TestCase):
+    def test_renders_and_sends_post(self):
+        with patch("bot.Bot") as bot_cls:
+            send = post_sender([("123:token", "en")], 30, 0)
+            send(100, {"channel_id": 1, "msg_id": 7, "channel": "chan",
+                       "text": "hello"})
+        kwargs = bot_cls.return_value.send_message.call_args[1]
+        self.assertEqual(100, kwargs["chat_id"])
+        self.assertIn("hello", kwargs["text"])
+        # Отправка идет через ограничитель исходящих сообщений.
+        self.assertIsInstance(bot_cls.call_args[1]["request"], LimitedRequest)
+
+    def test_sends_through_user_bot(self):
+        with patch("bot.Bot") as bot_cls:
+            send = post_sender([("123:token", "en"), ("456:token", "ru")],
+                               30, 0)
+            post = {"channel_id": 1, "msg_id": 7, "channel": "chan",
+                    "text": "hello"}
+            send(100, post, "456")
+            send(200, post)
+            with self.assertRaises(ValueError):
+                send(300, post, "789")
+        self.assertEqual(["456:token", "123:token"],
+                         [call[0][0] for call in bot_cls.call_args_list])
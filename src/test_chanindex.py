@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import events
+
+from chanindex import ChannelIndex
+from events import EventBus
+from memstore import MemoryStore
+
+
+def make_index():
+    index = ChannelIndex()
+    for i, title in enumerate(["@channel", "@python_news", "@pythonista",
+                               "@meduzalive"]):
+        index.add(i, title)
+    return index
+
+
+def test_suggest_typos():
+    index = make_index()
+    assert index.suggest("@chanel") == ["@channel"]
+    assert index.suggest("@pyton_news")[0] == "@python_news"
+    assert index.suggest("@completely_different") == []
+    # Точное совпадение - не опечатка.
+    assert index.suggest("@Channel") == []
+
+
+def test_find_ignores_case():
+    index = make_index()
+    assert index.find("@Channel") == "@channel"
+    assert index.find("@PYTHON_NEWS") == "@python_news"
+    assert index.find("@python") is None
+
+
+def test_prefix():
+    index = make_index()
+    assert index.with_prefix("@pyth") == ["@python_news", "@pythonista"]
+    assert index.with_prefix("@x") == []
+
+
+def test_add_is_idempotent_and_remove():
+    index = make_index()
+    index.add(0, "@channel")
+    assert len(index) == 4
+
+    index.remove(0)
+    assert index.suggest("@chanel") == []
+    assert index.with_prefix("@chan") == []
+
+
+def test_follows_store_events():
+    bus = EventBus()
+    store = MemoryStore(bus=bus)
+    index = ChannelIndex()
+    index.attach(bus)
+
+    chan = store.create_channel(title="@durov")
+    assert index.suggest("@durovv") == ["@durov"]
+
+    store.delete_channel(chan_id=chan.id)
+    assert len(index) == 0
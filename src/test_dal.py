@@ -2,57 +2,25 @@
 
 import os
 import pytest
-import factory
 import dal
+import events
 
+from itertools import count, islice
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 from dal import Store
+from events import EventBus
+from memstore import MemoryStore
 
-engine = create_engine(os.getenv("DB_URL"))
 Session = sessionmaker()
-
-
-class UserFactory(factory.alchemy.SQLAlchemyModelFactory):
-    id = factory.Sequence(lambda n: -n)
-    nickname = factory.Sequence(lambda n: u'_user_{}'.format(n))
-    tg_id = factory.Sequence(lambda n: -n - 1000)
-
-    class Meta:
-        model = dal.User
-
-
-class ChannelFactory(factory.alchemy.SQLAlchemyModelFactory):
-    id = factory.Sequence(lambda n: -n)
-    title = factory.Sequence(lambda n: u'_channel_{}'.format(n))
-    tg_id = factory.Sequence(lambda n: -n - 1000)
-
-    class Meta:
-        model = dal.Channel
-
-
-class SubscriptionFactory(factory.alchemy.SQLAlchemyModelFactory):
-    id = factory.Sequence(lambda n: -n)
-    channel_id = factory.LazyAttribute(lambda o: o.channel.id)
-    user_id = factory.LazyAttribute(lambda o: o.user.id)
-
-    user = factory.SubFactory(UserFactory)
-    channel = factory.SubFactory(ChannelFactory)
-
-    class Meta:
-        model = dal.Subscription
-
-
-def patch_factories(fc_classes, session):
-    for factory_cls in fc_classes:
-        if factory_cls.__class__ is not factory.base.FactoryMetaClass:
-            continue
-        factory_cls._meta.sqlalchemy_session = session
+sequence = count()
 
 
 @pytest.fixture(scope='module')
 def connection():
-    connection = engine.connect()
+    if not os.getenv("DB_URL"):
+        pytest.skip("DB_URL is not set")
+    connection = create_engine(os.getenv("DB_URL")).connect()
     yield connection
     connection.close()
 
@@ -61,102 +29,146 @@ def connection():
 def session(connection):
     transaction = connection.begin()
     session = Session(bind=connection)
-    patch_factories(
-        (UserFactory, ChannelFactory, SubscriptionFactory),
-        session
-    )
     yield session
     session.close()
     transaction.rollback()
 
 
-def test_user_deletion(session):
-    user = UserFactory.create()
-    assert session.query(dal.User).filter(dal.User.id == user.id).one()
+@pytest.fixture(scope='function', params=["sql", "memory"])
+def store(request):
+    """
+    Одни и те же тесты проверяют оба хранилища: Store поверх БД (каждый
+    тест в откатываемой транзакции) и MemoryStore.
+    """
+    if request.param == "memory":
+        return MemoryStore()
+    return Store(request.getfixturevalue("session"))
+
+
+def create_users(store, n):
+    return [
+        store.create_user(tg_id=-i - 1000, nickname=u'_user_{}'.format(i))
+        for i in islice(sequence, n)
+    ]
+
+
+def create_channels(store, n):
+    return [
+        store.create_channel(title=u'_channel_{}'.format(i), tg_id=-i - 1000)
+        for i in islice(sequence, n)
+    ]
+
+
+def create_subscriptions(store, n):
+    users = create_users(store, n)
+    chans = create_channels(store, n)
+    return [
+        store.create_subscription(user.id, chan.id)
+        for user, chan in zip(users, chans)
+    ]
+
+
+def test_user_deletion(store):
+    user, = create_users(store, 1)
+    chan, = create_channels(store, 1)
+    store.create_subscription(user.id, chan.id)
 
-    store = Store(session)
     store.delete_user(user_id=user.id)
 
-    result = session.query(dal.User).filter(dal.User.id == user.id).one_or_none()
-    assert result is None
+    assert not store.user_exists(user_id=user.id)
+    assert store.get_user(tg_id=user.tg_id) is None
+    assert store.get_subscriptions(user_ids=[user.id]) == []
+    assert store.get_subscriptions(channel_ids=[chan.id]) == []
 
 
-def test_user_creation(session):
-    store = Store(session)
+def test_users_bulk_deletion(store):
+    subs = create_subscriptions(store, 3)
+    tg_ids = [sub.user.tg_id for sub in subs[:2]]
+    user_ids = [sub.user.id for sub in subs[:2]]
+    kept_user_id = subs[2].user.id
+
+    assert store.delete_users_bulk(tg_ids) == 2
+    assert store.delete_users_bulk([]) == 0
+
+    assert store.get_users(user_ids=user_ids) == []
+    assert store.get_subscriptions(user_ids=user_ids) == []
+    assert store.user_exists(user_id=kept_user_id)
+
+
+def test_user_creation(store):
     created_user = store.create_user(nickname="_user1", tg_id=-123)
-    user = session.query(dal.User).filter(
-        dal.User.id == created_user.id
-    ).one_or_none()
+    user = store.get_user(created_user.id)
 
     assert user is not None
     assert user.nickname == "_user1"
     assert user.tg_id == -123
 
+    with pytest.raises(Exception):
+        store.create_user(nickname="_user2", tg_id=-123)
+
+    store.create_user(nickname="_user3", tg_id=-124, bot_id="456")
+    assert store.get_user(tg_id=-124).bot_id == "456"
 
-def test_user_existence(session):
-    store = Store(session)
-    user = UserFactory.create()
+
+def test_user_existence(store):
+    user, = create_users(store, 1)
 
     assert store.user_exists(user_id=user.id)
     assert store.user_exists(tg_id=user.tg_id)
     assert store.user_exists(nickname=user.nickname)
     assert not store.user_exists(user_id=-123)
+    assert not store.user_exists(user_id=user.id, tg_id=-123)
 
 
-def test_user_getting(session):
-    store = Store(session)
-    users = UserFactory.create_batch(5)
+def test_user_getting(store):
+    users = create_users(store, 5)
 
     user_ids = [user.id for user in users[:3]]
-    fetched_users = store.get_users(user_ids=user_ids)
-    fetched_ids = [user.id for user in fetched_users]
+    fetched_ids = [user.id for user in store.get_users(user_ids=user_ids)]
     assert sorted(fetched_ids) == sorted(user_ids)
 
     tg_ids = [user.tg_id for user in users[:3]]
-    fetched_users = store.get_users(tg_ids=tg_ids)
-    fetched_ids = [user.id for user in fetched_users]
+    fetched_ids = [user.id for user in store.get_users(tg_ids=tg_ids)]
     assert sorted(fetched_ids) == sorted(user_ids)
 
     nicknames = [user.nickname for user in users[:3]]
-    fetched_users = store.get_users(nicknames=nicknames)
-    fetched_ids = [chan.id for chan in fetched_users]
+    fetched_ids = [user.id for user in store.get_users(nicknames=nicknames)]
     assert sorted(fetched_ids) == sorted(user_ids)
 
+    fetched_ids = [
+        user.id for user in store.get_users(user_ids=user_ids, tg_ids=tg_ids[:1])
+    ]
+    assert fetched_ids == user_ids[:1]
+
     user_ids = [user.id for user in users]
-    fetched_users = store.get_users()
-    fetched_ids = [user.id for user in fetched_users]
+    fetched_ids = [user.id for user in store.get_users()]
     filtered_ids = [user_id for user_id in fetched_ids if user_id in user_ids]
     assert sorted(filtered_ids) == sorted(user_ids)
 
 
-def test_channel_deletion(session):
-    chan = ChannelFactory.create()
-    assert session.query(dal.Channel).filter(dal.Channel.id == chan.id).one()
+def test_channel_deletion(store):
+    chan, = create_channels(store, 1)
+    user, = create_users(store, 1)
+    store.create_subscription(user.id, chan.id)
 
-    store = Store(session)
     store.delete_channel(chan_id=chan.id)
 
-    result = session.query(dal.Channel).filter(
-        dal.Channel.id == chan.id
-    ).one_or_none()
-    assert result is None
+    assert store.get_channel(chan.id) is None
+    assert store.get_channel(title=chan.title) is None
+    assert store.get_subscriptions(user_ids=[user.id]) == []
 
 
-def test_channel_creation(session):
-    store = Store(session)
+def test_channel_creation(store):
     created_chan = store.create_channel(title="_channel1", tg_id=-123)
-    chan = session.query(dal.Channel).filter(
-        dal.Channel.id == created_chan.id
-    ).one_or_none()
+    chan = store.get_channel(created_chan.id)
 
     assert chan is not None
     assert chan.title == "_channel1"
     assert chan.tg_id == -123
 
 
-def test_channel_existence(session):
-    store = Store(session)
-    chan = ChannelFactory.create()
+def test_channel_existence(store):
+    chan, = create_channels(store, 1)
 
     assert store.channel_exists(channel_id=chan.id)
     assert store.channel_exists(tg_id=chan.tg_id)
@@ -164,43 +176,34 @@ def test_channel_existence(session):
     assert not store.channel_exists(channel_id=-123)
 
 
-def test_channel_getting(session):
-    store = Store(session)
-    chans = ChannelFactory.create_batch(5)
+def test_channel_getting(store):
+    chans = create_channels(store, 5)
 
     chan_ids = [chan.id for chan in chans[:3]]
-    fetched_chans = store.get_channels(chan_ids=chan_ids)
-    fetched_ids = [chan.id for chan in fetched_chans]
+    fetched_ids = [chan.id for chan in store.get_channels(chan_ids=chan_ids)]
     assert sorted(fetched_ids) == sorted(chan_ids)
 
     tg_ids = [chan.tg_id for chan in chans[:3]]
-    fetched_chans = store.get_channels(tg_ids=tg_ids)
-    fetched_ids = [chan.id for chan in fetched_chans]
+    fetched_ids = [chan.id for chan in store.get_channels(tg_ids=tg_ids)]
     assert sorted(fetched_ids) == sorted(chan_ids)
 
     titles = [chan.title for chan in chans[:3]]
-    fetched_chans = store.get_channels(titles=titles)
-    fetched_ids = [chan.id for chan in fetched_chans]
+    fetched_ids = [chan.id for chan in store.get_channels(titles=titles)]
     assert sorted(fetched_ids) == sorted(chan_ids)
 
     chan_ids = [chan.id for chan in chans]
-    fetched_chans = store.get_channels()
-    fetched_ids = [chan.id for chan in fetched_chans]
+    fetched_ids = [chan.id for chan in store.get_channels()]
     filtered_ids = [chan_id for chan_id in fetched_ids if chan_id in chan_ids]
     assert sorted(filtered_ids) == sorted(chan_ids)
 
 
-def test_subscription_creation(session):
-    store = Store(session)
-    user = UserFactory.create()
-    chan = ChannelFactory.create()
+def test_subscription_creation(store):
+    user, = create_users(store, 1)
+    chan, = create_channels(store, 1)
 
     created_sub = store.create_subscription(user_id=user.id, channel_id=chan.id)
-    sub = session.query(dal.Subscription).filter(
-        dal.Subscription.id == created_sub.id
-    ).one_or_none()
+    sub, = store.get_subscriptions(sub_ids=[created_sub.id])
 
-    assert sub is not None
     assert sub.channel.id == chan.id
     assert sub.user.id == user.id
 
@@ -211,9 +214,22 @@ def test_subscription_creation(session):
         store.create_subscription(None, -123)
 
 
-def test_subscription_existence(session):
-    store = Store(session)
-    sub = SubscriptionFactory.create()
+def test_subscription_deletion(store):
+    users = create_users(store, 2)
+    chans = create_channels(store, 2)
+    for user in users:
+        for chan in chans:
+            store.create_subscription(user.id, chan.id)
+
+    store.delete_subscription(users[0].id, chans[0].id)
+
+    assert not store.subscription_exists(users[0].id, chans[0].id)
+    assert store.subscription_exists(users[0].id, chans[1].id)
+    assert store.subscription_exists(users[1].id, chans[0].id)
+
+
+def test_subscription_existence(store):
+    sub, = create_subscriptions(store, 1)
 
     assert store.subscription_exists(
         user_id=sub.user.id,
@@ -228,13 +244,11 @@ def test_subscription_existence(session):
         store.subscription_exists(channel_id=-123)
 
 
-def test_subscription_getting(session):
-    store = Store(session)
-    subs = SubscriptionFactory.create_batch(5)
+def test_subscription_getting(store):
+    subs = create_subscriptions(store, 5)
 
     sub_ids = [sub.id for sub in subs[:3]]
-    fetched_subs = store.get_subscriptions(sub_ids=sub_ids)
-    fetched_ids = [sub.id for sub in fetched_subs]
+    fetched_ids = [sub.id for sub in store.get_subscriptions(sub_ids=sub_ids)]
     assert sorted(fetched_ids) == sorted(sub_ids)
 
     chan_ids = [sub.channel.id for sub in subs[:3]]
@@ -248,12 +262,181 @@ def test_subscription_getting(session):
     assert sorted(fetched_ids) == sorted(user_ids)
 
     sub_ids = [sub.id for sub in subs]
-    fetched_subs = store.get_subscriptions()
-    fetched_ids = [sub.id for sub in fetched_subs]
+    fetched_ids = [sub.id for sub in store.get_subscriptions()]
     filtered_ids = [sub_id for sub_id in fetched_ids if sub_id in sub_ids]
     assert sorted(filtered_ids) == sorted(sub_ids)
 
 
+def test_user_channels_getting(store):
+    user, = create_users(store, 1)
+    chans = create_channels(store, 5)
+    for chan in chans:
+        store.create_subscription(user.id, chan.id)
+    create_subscriptions(store, 1)
+
+    chan_ids = sorted(chan.id for chan in chans)
+    first = store.get_user_channels(user.id, limit=3)
+    assert [chan.id for chan in first] == chan_ids[:3]
+
+    rest = store.get_user_channels(user.id, after_channel_id=first[-1].id)
+    assert [chan.id for chan in rest] == chan_ids[3:]
+
+
+def test_subscribers_counting(store):
+    users = create_users(store, 3)
+    chans = create_channels(store, 3)
+    for i, chan in enumerate(chans):
+        for user in users[:i + 1]:
+            store.create_subscription(user_id=user.id, channel_id=chan.id)
+
+    top = store.get_top_channels(limit=2)
+    assert [(chan.id, chan.subs_count) for chan in top] == [
+        (chans[2].id, 3), (chans[1].id, 2)
+    ]
+
+    store.delete_subscription(users[0].id, chans[2].id)
+    store.delete_user(user_id=users[1].id)
+    store.delete_users_bulk([users[2].tg_id])
+
+    counts = {chan.id: chan.subs_count for chan in store.get_channels(
+        chan_ids=[chan.id for chan in chans]
+    )}
+    assert counts == {chans[0].id: 1, chans[1].id: 1, chans[2].id: 0}
+
+
+def test_top_channels(store):
+    users = create_users(store, 3)
+    chans = create_channels(store, 3)
+    for i, chan in enumerate(chans):
+        for user in users[:i + 1]:
+            store.create_subscription(user.id, chan.id)
+
+    chan_ids = [chan.id for chan in chans]
+    assert [chan.id for chan in store.get_top_channels()
+            if chan.id in chan_ids] == chan_ids[::-1]
+    store.get_top_channels(limit=1)
+
+    # Повторный запрос после изменения подписок видит новый порядок.
+    store.delete_user(user_id=users[2].id)
+    store.delete_subscription(users[1].id, chans[1].id)
+    assert [chan.id for chan in store.get_top_channels()
+            if chan.id in chan_ids] == [chans[2].id, chans[0].id, chans[1].id]
+
+
+def test_subscription_filters(store):
+    sub, = create_subscriptions(store, 1)
+
+    assert store.set_subscription_filters(sub.user.id, sub.channel.id,
+                                          "+python -ads")
+    fetched, = store.get_subscriptions(sub_ids=[sub.id])
+    assert fetched.filters == "+python -ads"
+
+    assert store.set_subscription_filters(sub.user.id, sub.channel.id, None)
+    fetched, = store.get_subscriptions(sub_ids=[sub.id])
+    assert fetched.filters is None
+
+    assert not store.set_subscription_filters(-123, -456, "+python")
+
+    other, = create_subscriptions(store, 1)
+    store.set_subscription_filters(other.user.id, other.channel.id, "-ads")
+    assert [(row.user_id, row.channel_id, row.filters)
+            for row in store.get_subscription_filters(batch_size=1)] == \
+        [(other.user.id, other.channel.id, "-ads")]
+
+
+def test_delivery_prefs_updating(store):
+    user, = create_users(store, 1)
+
+    assert store.update_delivery_prefs(user.id, quiet_from=60, quiet_to=420,
+                                       utc_offset=180)
+    assert store.update_delivery_prefs(user.id, digest="daily")
+    fetched = store.get_user(user_id=user.id)
+    assert dal.delivery_prefs(fetched) == {
+        "quiet_from": 60, "quiet_to": 420, "utc_offset": 180,
+        "digest": "daily",
+    }
+
+    assert not store.update_delivery_prefs(-123, digest="daily")
+    with pytest.raises(ValueError):
+        store.update_delivery_prefs(user.id, language="en")
+
+
+def test_users_with_delivery_prefs(store):
+    quiet, plain, digest = create_users(store, 3)
+    store.update_delivery_prefs(quiet.id, quiet_from=60, quiet_to=420)
+    store.update_delivery_prefs(plain.id, utc_offset=180)
+    store.update_delivery_prefs(digest.id, digest="hourly")
+    assert [user.id for user in store.get_users_with_delivery_prefs()] == \
+        [quiet.id, digest.id]
+
+
+def test_events_after_commit(session):
+    bus = EventBus()
+    received = []
+    bus.subscribe(events.ALL_EVENTS, received.append)
+    store = Store(session, bus=bus, outbox=True)
+
+    user = store.create_user(nickname="_user1", tg_id=-123)
+    chan = store.create_channel(title="_channel1", tg_id=-123)
+    sub = store.create_subscription(user_id=user.id, channel_id=chan.id)
+    expected_cascade = [
+        {"sub_id": sub.id, "user_id": user.id, "channel_id": chan.id}
+    ]
+    store.delete_user(user_id=user.id)
+
+    assert [e.type for e in received] == [
+        events.USER_CREATED,
+        events.CHANNEL_CREATED,
+        events.SUBSCRIPTION_CREATED,
+        events.USER_DELETED,
+    ]
+    assert received[3].data["subscriptions"] == expected_cascade
+
+    outbox = store.get_outbox_events(limit=10)
+    assert [e.type for e in outbox][-4:] == [e.type for e in received]
+
+
+def test_bot_state(store):
+    assert store.get_state("_key") is None
+
+    # Изменения внутри блока коммитятся только при выходе из него, поэтому
+    # исключение откатывает и состояние, и записи, сделанные до него.
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.set_state("_key", "1")
+            with store.transaction():
+                store.create_user(nickname="_user0", tg_id=-122)
+            raise RuntimeError()
+    assert store.get_state("_key") is None
+    assert not store.user_exists(tg_id=-122)
+
+    with store.transaction():
+        store.set_state("_key", "2")
+        user = store.create_user(nickname="_user1", tg_id=-123)
+    assert store.get_state("_key") == "2"
+    assert store.user_exists(user_id=user.id)
+
+    store.set_state("_key", "3")
+    store.save()
+    assert store.get_state("_key") == "3"
+
+
+@pytest.mark.usefixtures("connection")
+def test_preconnect():
+    assert dal.preconnect(2) == 2
+    assert dal.get_engine() is dal.get_engine()
+
+
+def test_track_query_time():
+    engine = create_engine("sqlite://")
+    timings = []
+    dal.track_query_time(timings.append, engine)
+    with engine.connect() as conn:
+        conn.execute("select 1")
+        conn.execute("select 2")
+    assert len(timings) == 2 and all(t >= 0 for t in timings)
+
+
 def test_prepare_args_for_multiple_select():
     args = ["arg1", "arg2", None, "arg3"]
     kwargs = {"1kwarg": "val1", "2kwarg": "val2"}
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import pytest
+
+from datetime import datetime, timezone
+
+from deferred import (DAILY, DAILY_DIGEST_HOUR, HOURLY, DeliveryPrefs,
+                      DeliveryScheduler, parse_quiet_hours)
+from events import EventBus
+from memstore import MemoryStore
+
+
+def ts(hour, minute=0, day=1):
+    return datetime(2026, 1, day, hour, minute,
+                    tzinfo=timezone.utc).timestamp()
+
+
+def test_parse_quiet_hours():
+    assert parse_quiet_hours(["23:00-08:00"]) == (23 * 60, 8 * 60, 0)
+    assert parse_quiet_hours(["1:30-7:00", "UTC-05:30"]) == (90, 420, -330)
+    for args in (["23:00"], ["25:00-08:00"], ["23:00-08:00", "+15"],
+                 ["08:00-08:00"], []):
+        with pytest.raises(ValueError):
+            parse_quiet_hours(args)
+
+
+def test_next_window():
+    night = DeliveryPrefs(quiet_from=23 * 60, quiet_to=8 * 60, utc_offset=180)
+    # 21:00 UTC - полночь по местному времени, тихие часы до 05:00 UTC.
+    assert night.next_window(ts(21)) == ts(5, day=2)
+    assert night.next_window(ts(12)) == ts(12)
+
+    assert DeliveryPrefs(digest=HOURLY).next_window(ts(12, 10)) == ts(13)
+    daily = DeliveryPrefs(digest=DAILY)
+    assert daily.next_window(ts(8, 59)) == ts(9)
+    assert daily.next_window(ts(9)) == ts(9, day=2)
+
+    # Дайджест, попавший на тихие часы, ждет их окончания.
+    both = DeliveryPrefs(quiet_from=22 * 60, quiet_to=10 * 60, digest=HOURLY)
+    assert both.next_window(ts(20, 30)) == ts(21)
+    assert both.next_window(ts(21, 30)) == ts(10, day=2)
+
+
+def test_scheduler_batches_deferred_items():
+    sent = []
+    scheduler = DeliveryScheduler(lambda tg_id, items: sent.append((tg_id, items)),
+                                  max_batches=1)
+    scheduler.set_prefs(1, DeliveryPrefs(digest=HOURLY))
+    scheduler.set_prefs(2, DeliveryPrefs(quiet_from=0, quiet_to=6 * 60))
+
+    assert scheduler.submit(3, "a", now=ts(1))
+    assert not scheduler.submit(1, "a", now=ts(1))
+    assert not scheduler.submit(1, "b", now=ts(1, 30))
+    assert not scheduler.submit(2, "c", now=ts(1, 40))
+    # Пока есть отложенные сообщения, новые встают за ними в очередь.
+    assert not scheduler.submit(2, "d", now=ts(7))
+    assert scheduler.pending_count() == 2
+    assert scheduler.next_due() == ts(2)
+
+    assert scheduler.flush_due(now=ts(1, 59)) == 0
+    assert scheduler.flush_due(now=ts(6)) == 2
+    assert sent == [(1, ["a", "b"]), (2, ["c", "d"])]
+    assert scheduler.pending_count() == 0
+    assert scheduler.submit(2, "e", now=ts(7))
+
+
+def test_scheduler_follows_store_events():
+    bus = EventBus()
+    store = MemoryStore(bus=bus)
+    user = store.create_user(tg_id=10)
+    sent = []
+    scheduler = DeliveryScheduler(lambda tg_id, items: sent.append(items),
+                                  clock=lambda: ts(1))
+    scheduler.attach(bus)
+
+    store.update_delivery_prefs(user.id, digest=DAILY)
+    assert scheduler.prefs(10).digest == DAILY
+    assert not scheduler.submit(10, "a")
+
+    # Отключение дайджеста переносит доставку на текущий момент.
+    store.update_delivery_prefs(user.id, digest=None)
+    assert scheduler.next_due() == ts(1)
+    scheduler.flush_due()
+    assert sent == [["a"]]
+
+    store.update_delivery_prefs(user.id, digest=HOURLY)
+    scheduler.submit(10, "b")
+    store.delete_user(user_id=user.id)
+    assert scheduler.pending_count() == 0
+    assert scheduler.submit(10, "c")
+
+    loaded = DeliveryScheduler(lambda tg_id, items: None)
+    other = store.create_user(tg_id=11)
+    store.update_delivery_prefs(other.id, quiet_from=0, quiet_to=60)
+    loaded.load(store.get_users_with_delivery_prefs())
+    assert loaded.prefs(11).quiet_to == 60
+
+
+def test_items_submitted_during_flush_follow_the_batch():
+    sent = []
+    scheduler = DeliveryScheduler(lambda tg_id, items: None)
+
+    def send_batch(tg_id, items):
+        # Окно уже открыто: сообщение, пришедшее во время отправки пачки,
+        # не должно уйти раньше нее.
+        if not sent:
+            assert not scheduler.submit(tg_id, "c", now=ts(7))
+        sent.append(items)
+
+    scheduler.send_batch = send_batch
+    scheduler.set_prefs(1, DeliveryPrefs(quiet_from=0, quiet_to=6 * 60))
+    scheduler.submit(1, "a", now=ts(1))
+    scheduler.submit(1, "b", now=ts(2))
+    assert scheduler.flush_due(now=ts(7)) == 1
+    assert sent == [["a", "b"], ["c"]]
+    assert scheduler.pending_items() == 0
+    assert scheduler.submit(1, "d", now=ts(7))
+
+
+def test_pending_items_survive_restart(tmp_path):
+    path = str(tmp_path / "deferred.json")
+    scheduler = DeliveryScheduler(lambda tg_id, items: None, path=path)
+    scheduler.set_prefs(1, DeliveryPrefs(digest=DAILY))
+    scheduler.submit(1, ["post", 1], now=ts(1))
+    scheduler.stop()
+
+    sent = []
+    restored = DeliveryScheduler(lambda tg_id, items: sent.append(items),
+                                 path=path, decode=tuple)
+    assert restored.pending_items() == 1
+    assert restored.next_due() == ts(DAILY_DIGEST_HOUR)
+    assert not restored.submit(1, ("post", 2), now=ts(2))
+    restored.flush_due(now=ts(DAILY_DIGEST_HOUR))
+    assert sent == [[("post", 1), ("post", 2)]]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import io
+import os
+import json
+
+from deliverylog import (DeliveryLog, LogRetention, SENT, FAILED, BLOCKED,
+                         OPENED, HOUR, CHUNK_EXT, main)
+
+DAY = 24 * HOUR
+T0 = 1600000000 // DAY * DAY
+
+
+def fill(log):
+    # Канал 1: 3 отправки в первый час и 1 во второй, канал 2 - отправка,
+    # ошибка и блокировка.
+    for minute in (0, 10, 20):
+        log.append(1, 100, SENT, T0 + minute * 60)
+    log.append(1, 101, SENT, T0 + HOUR + 5)
+    log.append(1, 100, OPENED, T0 + HOUR + 10)
+    log.append(2, 100, SENT, T0 + 30)
+    log.append(2, 101, FAILED, T0 + 40)
+    log.append(2, 102, BLOCKED, T0 + 50)
+
+
+def test_queries_over_chunks_and_pending(tmp_path):
+    log = DeliveryLog(str(tmp_path), chunk_size=3)
+    fill(log)
+    # Два полных чанка записаны, два события еще в памяти.
+    assert len([name for name in os.listdir(str(tmp_path))
+                if name.endswith(CHUNK_EXT)]) == 2
+    assert len(log) == 8
+
+    assert log.sends_per_channel_hour(T0, T0 + DAY).to_dict() == {
+        (1, T0): 3, (1, T0 + HOUR): 1, (2, T0): 1,
+    }
+    # Границы округляются до часа наружу.
+    hour = log.sends_per_channel_hour(T0 + HOUR + 1, T0 + HOUR + 2)
+    assert hour.to_dict() == {(1, T0 + HOUR): 1}
+    failed = log.sends_per_channel_hour(T0, T0 + DAY, kind=FAILED)
+    assert failed.to_dict() == {(2, T0): 1}
+
+    stats = log.channel_stats(T0, T0 + DAY)
+    assert stats[1]["sent"] == 4 and stats[1]["failure_rate"] == 0.0
+    assert stats[2]["failed"] == stats[2]["blocked"] == 1
+    assert abs(stats[2]["failure_rate"] - 2 / 3) < 1e-9
+
+    engagement = log.user_engagement(T0, T0 + DAY).to_dict()
+    assert engagement[100] == {"sent": 4, "opened": 1, "open_rate": 0.25}
+    assert engagement[101]["sent"] == 1
+    assert 102 not in engagement
+    # Здесь период точный: первый час без переходов.
+    assert log.user_engagement(T0, T0 + HOUR).to_dict()[100]["opened"] == 0
+
+
+def test_writers_share_directory(tmp_path):
+    first = DeliveryLog(str(tmp_path), writer="shard-0")
+    second = DeliveryLog(str(tmp_path), writer="shard-1")
+    fill(first)
+    second.append(3, 100, SENT, T0)
+    first.close()
+    second.close()
+
+    reader = DeliveryLog(str(tmp_path), writer="reader")
+    assert len(reader) == 9
+    sends = reader.sends_per_channel_hour(T0, T0 + HOUR).to_dict()
+    assert sends[(3, T0)] == 1
+
+    # После рестарта writer продолжает нумерацию своих чанков.
+    first = DeliveryLog(str(tmp_path), writer="shard-0")
+    first.append(3, 100, SENT, T0 + DAY)
+    first.close()
+    reader.refresh()
+    assert len(reader) == 10
+
+    assert reader.drop_before(T0 + DAY) == 9
+    assert len(reader) == 1
+    assert reader.channel_stats(T0, T0 + 2 * DAY) == {3: {
+        "sent": 1, "failed": 0, "blocked": 0, "opened": 0,
+        "failure_rate": 0.0,
+    }}
+
+
+def test_writer_names_sharing_prefix(tmp_path):
+    for writer in ("shard-1", "shard"):
+        log = DeliveryLog(str(tmp_path), writer=writer)
+        log.append(1, 100, SENT, T0)
+        log.close()
+
+    log = DeliveryLog(str(tmp_path), writer="shard")
+    log.append(1, 100, SENT, T0 + HOUR)
+    log.close()
+    assert sorted(name for name in os.listdir(str(tmp_path))
+                  if name.endswith(CHUNK_EXT)) == [
+        "shard-0000000001.chunk", "shard-0000000002.chunk",
+        "shard-1-0000000001.chunk",
+    ]
+
+
+def test_retention_drops_old_chunks_of_all_writers(tmp_path):
+    shard = DeliveryLog(str(tmp_path), writer="shard-0")
+    shard.append(1, 100, SENT, T0)
+    shard.close()
+
+    log = DeliveryLog(str(tmp_path))
+    retention = LogRetention(log, max_age=DAY, clock=lambda: T0 + DAY + HOUR)
+    log.append(1, 100, OPENED, T0 + DAY)
+    shard.append(1, 101, SENT, T0 + DAY)
+    shard.close()
+
+    # Старый чанк шарда удален, события основного процесса записаны, новый
+    # чанк шарда подхвачен.
+    assert retention.run_once() == 1
+    assert sorted(name for name in os.listdir(str(tmp_path))
+                  if name.endswith(CHUNK_EXT)) == [
+        "main-0000000001.chunk", "shard-0-0000000002.chunk",
+    ]
+    assert len(log) == 2
+
+    log.append(1, 100, OPENED, T0 + DAY)
+    retention.start(interval=3600)
+    retention.stop()
+    assert len(DeliveryLog(str(tmp_path), writer="reader")) == 3
+
+
+def test_main_prints_channel_stats(tmp_path, monkeypatch):
+    log = DeliveryLog(str(tmp_path), writer="shard-0")
+    log.append(1, 100, SENT)
+    log.append(1, 100, OPENED)
+    log.append(2, 100, FAILED)
+    log.close()
+    monkeypatch.setenv("DELIVERY_EVENTS_DIR", str(tmp_path))
+
+    out = io.StringIO()
+    main(["channels", "1"], out)
+    rows = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(row["channel_id"], row["sent"], row["opened"], row["failed"])
+            for row in rows] == [(1, 1, 1, 0), (2, 0, 0, 1)]
+
+    out = io.StringIO()
+    main(["users"], out)
+    row, = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert (row["tg_id"], row["sent"], row["opened"]) == (100, 1, 1)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import events
+
+from events import Event, EventBus
+from memstore import MemoryStore
+
+
+def test_bus_dispatches_by_type():
+    bus = EventBus()
+    created, everything = [], []
+    bus.subscribe(events.USER_CREATED, created.append)
+    bus.subscribe(events.ALL_EVENTS, everything.append)
+
+    bus.publish(Event(events.USER_CREATED, {"user_id": 1}))
+    bus.publish(Event(events.CHANNEL_CREATED, {"channel_id": 2}))
+
+    assert [e.data for e in created] == [{"user_id": 1}]
+    assert [e.type for e in everything] == [
+        events.USER_CREATED, events.CHANNEL_CREATED
+    ]
+
+
+def test_failing_handler_does_not_break_others():
+    bus = EventBus()
+    received = []
+
+    def broken(event):
+        raise RuntimeError("boom")
+
+    bus.subscribe(events.USER_CREATED, broken)
+    bus.subscribe(events.USER_CREATED, received.append)
+    bus.publish(Event(events.USER_CREATED, {}))
+
+    assert len(received) == 1
+
+
+def test_store_mutations_emit_events():
+    bus = EventBus()
+    received = []
+    bus.subscribe(events.ALL_EVENTS, received.append)
+    store = MemoryStore(bus=bus)
+
+    user = store.create_user(tg_id=1, nickname="user")
+    chan = store.create_channel(title="@chan")
+    sub = store.create_subscription(user.id, chan.id)
+    store.delete_user(user_id=user.id)
+
+    assert [e.type for e in received] == [
+        events.USER_CREATED,
+        events.CHANNEL_CREATED,
+        events.SUBSCRIPTION_CREATED,
+        events.USER_DELETED,
+    ]
+    assert received[2].data == {
+        "sub_id": sub.id, "user_id": user.id, "channel_id": chan.id
+    }
+    assert received[3].data["subscriptions"] == [received[2].data]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import json
+import pytest
+import threading
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from fakeapi import FakeTelegram, FakeTelegramServer
+from loadgen import LoadGenerator, percentile
+
+
+@pytest.fixture
+def telegram():
+    telegram = FakeTelegram(seed=1)
+    server = FakeTelegramServer(telegram)
+    server.start()
+    telegram.base_url = server.base_url
+    yield telegram
+    server.stop()
+
+
+def test_bot_api_methods(telegram, tmp_path):
+    telegram.record_path = str(tmp_path / "calls.jsonl")
+    bot = Bot("123:abc", base_url=telegram.base_url)
+    assert bot.get_me().username == "feed_bot"
+    assert bot.set_webhook("https://example.com/hook")
+    assert telegram.webhook_url == "https://example.com/hook"
+
+    telegram.push_update({"message": {
+        "message_id": 1, "date": 0, "text": "/start",
+        "chat": {"id": 42, "type": "private"},
+    }})
+    update, = bot.get_updates(timeout=0)
+    assert update.message.chat.id == 42
+    assert bot.get_updates(offset=update.update_id + 1, timeout=0) == []
+
+    message = bot.send_message(chat_id=42, text="hello")
+    assert message.text == "hello"
+    assert bot.get_chat("@some_channel").username == "some_channel"
+
+    telegram.too_many_requests = 1.0
+    with pytest.raises(RetryAfter):
+        bot.send_message(chat_id=42, text="again")
+
+    with open(telegram.record_path) as f:
+        methods = [json.loads(line)["method"] for line in f]
+    assert methods == ["getMe", "setWebhook", "getUpdates", "getUpdates",
+                       "sendMessage", "getChat", "sendMessage"]
+    assert [call.status for call in telegram.calls][-1] == 429
+
+
+def test_load_generator_measures_replies(telegram):
+    generator = LoadGenerator(telegram, users=20, channels=5, seed=1)
+    bot = Bot("123:abc", base_url=telegram.base_url)
+
+    stop = threading.Event()
+
+    def responder():
+        offset = 0
+        while not stop.is_set():
+            for update in bot.get_updates(offset=offset, timeout=0.1):
+                offset = update.update_id + 1
+                if update.message is not None:
+                    bot.send_message(chat_id=update.message.chat.id, text="ok")
+
+    thread = threading.Thread(target=responder)
+    thread.start()
+    report = generator.run(rate=200, duration=0.5, drain_timeout=5)
+    stop.set()
+    thread.join()
+
+    assert report.commands + report.posts > 50
+    assert report.replies == report.commands
+    assert 0 < report.p50 <= report.p99 <= report.max
+
+
+def test_percentile():
+    values = list(range(101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 99) == 0.0
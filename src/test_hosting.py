@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import warnings
+
+from telegram import Bot
+
+from fakeapi import FakeTelegram, FakeTelegramServer
+from hosting import LimitedRequest, parse_bot_tokens, bot_id
+from throttle import OutboundLimiter
+
+
+def test_parse_bot_tokens():
+    assert parse_bot_tokens("1:a=EN, 2:b,", "ru") == [("1:a", "en"),
+                                                      ("2:b", "ru")]
+    assert parse_bot_tokens("", "ru") == []
+    assert bot_id("123:abc") == "123"
+
+
+class RecordingLimiter(OutboundLimiter):
+    def __init__(self):
+        super().__init__(per_bot_rate=100)
+        self.keys = []
+
+    def acquire(self, key):
+        self.keys.append(key)
+        return super().acquire(key)
+
+
+def test_bots_share_request_and_limiter():
+    limiter = RecordingLimiter()
+    telegram = FakeTelegram()
+    server = FakeTelegramServer(telegram)
+    server.start()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            request = LimitedRequest(limiter, con_pool_size=4)
+        assert request.con_pool_size == 4
+        first = Bot("123:abc", base_url=server.base_url, request=request)
+        second = Bot("456:def", base_url=server.base_url, request=request)
+        first.get_me()
+        first.send_message(chat_id=1, text="a")
+        second.send_message(chat_id=1, text="b")
+        first.send_message(chat_id=1, text="c")
+    finally:
+        server.stop()
+
+    # getMe не ограничивается, сообщения учитываются отдельно по ботам.
+    assert limiter.keys == ["bot123", "bot456", "bot123"]
+    assert [sent["text"] for sent in telegram.sent] == ["a", "b", "c"]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import pytest
+
+from events import EventBus
+from kwfilter import Automaton, FilterIndex, parse_filters, format_filters
+from memstore import MemoryStore
+
+
+def test_parse_filters():
+    include, exclude = parse_filters("+Python -ads +релиз")
+    assert include == {"python", "релиз"}
+    assert exclude == {"ads"}
+    assert format_filters(include, exclude) == "+python +релиз -ads"
+    assert parse_filters("") == (frozenset(), frozenset())
+
+    with pytest.raises(ValueError):
+        parse_filters("python")
+    with pytest.raises(ValueError):
+        parse_filters("+")
+
+
+def test_automaton_matches_whole_words():
+    automaton = Automaton(["he", "she", "hers", "кот"])
+    assert automaton.search("She said: HERS!") == {"she", "hers"}
+    assert automaton.search("ushers") == set()
+    assert automaton.search("Кот и котлета") == {"кот"}
+
+
+def test_recipients():
+    index = FilterIndex()
+    index.set_filters(1, 10, "+python")
+    index.set_filters(1, 11, "-ads")
+    index.set_filters(1, 12, "+python +rust -ads")
+    subscribers = [10, 11, 12, 13]
+
+    assert index.recipients(1, subscribers, "New Python release") == \
+        [10, 11, 12, 13]
+    assert index.recipients(1, subscribers, "Python ads") == [10, 13]
+    assert index.recipients(1, subscribers, "Nothing here") == [11, 13]
+    # В каналах без фильтров пост получают все подписчики.
+    assert index.recipients(2, subscribers, "ads") == subscribers
+
+
+def test_automaton_rebuilt_only_for_new_words():
+    index = FilterIndex()
+    index.set_filters(1, 10, "+python -ads")
+    index.recipients(1, [10], "")
+    automaton = index._channels[1].automaton
+
+    index.set_filters(1, 11, "+python")
+    index.recipients(1, [10, 11], "")
+    assert index._channels[1].automaton is automaton
+
+    index.set_filters(1, 11, "+rust")
+    assert index.recipients(1, [10, 11], "rust") == [11]
+    assert index._channels[1].automaton is not automaton
+
+
+def test_follows_store_events():
+    bus = EventBus()
+    store = MemoryStore(bus=bus)
+    index = FilterIndex()
+    index.attach(bus)
+
+    user = store.create_user(tg_id=1)
+    chan = store.create_channel(title="@chan")
+    store.create_subscription(user.id, chan.id)
+
+    assert store.set_subscription_filters(user.id, chan.id, "+python")
+    assert index.recipients(chan.id, [user.id], "golang") == []
+
+    store.delete_subscription(user.id, chan.id)
+    assert not index.has_filters(chan.id)
+    assert not store.set_subscription_filters(user.id, chan.id, "+python")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from unittest.mock import patch
+
+from events import EventBus
+from listcache import SubscriptionListCache
+from memstore import MemoryStore
+
+
+def make_store(n_channels, bus=None):
+    store = MemoryStore(bus=bus)
+    user = store.create_user(tg_id=100)
+    for i in range(n_channels):
+        chan = store.create_channel(title="@chan{}".format(i))
+        store.create_subscription(user.id, chan.id)
+    return store, user
+
+
+def test_pages():
+    store, user = make_store(5)
+    cache = SubscriptionListCache(store, page_size=2)
+
+    first = cache.get_page(user.tg_id, 0)
+    assert first.titles == ["@chan0", "@chan1"]
+    assert not first.has_prev and first.has_next
+
+    last = cache.get_page(user.tg_id, 2)
+    assert last.titles == ["@chan4"]
+    assert last.has_prev and not last.has_next
+
+    # Номер страницы за пределами списка приводится к последней странице.
+    assert cache.get_page(user.tg_id, 10) == last
+    assert cache.get_page(-1, 0) is None
+
+
+def test_repeated_paging_uses_cache():
+    store, user = make_store(5)
+    cache = SubscriptionListCache(store, page_size=2)
+    for number in range(3):
+        cache.get_page(user.tg_id, number)
+
+    with patch.object(store, "get_user_channels") as get_user_channels, \
+            patch.object(store, "get_user") as get_user:
+        for number in (2, 1, 0, 1):
+            cache.get_page(user.tg_id, number)
+    get_user_channels.assert_not_called()
+    get_user.assert_not_called()
+
+
+def test_invalidation():
+    bus = EventBus()
+    store, user = make_store(1, bus=bus)
+    cache = SubscriptionListCache(store, page_size=2)
+    cache.attach(bus)
+    assert cache.get_page(user.tg_id).titles == ["@chan0"]
+
+    chan = store.create_channel(title="@new")
+    store.create_subscription(user.id, chan.id)
+    assert cache.get_page(user.tg_id).titles == ["@chan0", "@new"]
+
+    store.delete_channel(chan_id=chan.id)
+    assert cache.get_page(user.tg_id).titles == ["@chan0"]
+
+    cache.invalidate(user.tg_id)
+    assert cache.get_page(user.tg_id).titles == ["@chan0"]
+
+
+def test_lru_eviction():
+    store = MemoryStore()
+    users = [store.create_user(tg_id=i) for i in range(3)]
+    cache = SubscriptionListCache(store, max_users=2)
+    for user in users:
+        cache.get_page(user.tg_id)
+
+    with patch.object(store, "get_user", wraps=store.get_user) as get_user:
+        cache.get_page(users[2].tg_id)
+        get_user.assert_not_called()
+        cache.get_page(users[0].tg_id)
+        get_user.assert_called_once_with(tg_id=users[0].tg_id)
+
+
+def test_warm_from_hot_users():
+    store = MemoryStore()
+    users = [store.create_user(tg_id=i) for i in range(3)]
+    chan = store.create_channel(title="@chan")
+    store.create_subscription(users[0].id, chan.id)
+    cache = SubscriptionListCache(store, max_users=2)
+    for user in users:
+        cache.get_page(user.tg_id)
+    assert cache.hot_users() == [2, 1]
+
+    # После рестарта кэш прогревается через отдельное хранилище, а порядок
+    # LRU сохраняется: самый активный пользователь вытесняется последним.
+    warmed = SubscriptionListCache(MemoryStore(), max_users=2)
+    assert warmed.warm([0, 2, 1, 999], store) == 2
+    assert warmed.hot_users() == [0, 2]
+    assert warmed.get_page(0).titles == ["@chan"]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import io
+import hashlib
+
+from unittest.mock import Mock
+
+from archive import PostArchive
+from mediacache import HASH_KEY, MediaCache
+from render import Renderer, Sender
+
+
+def test_blobs_are_stored_once_and_evicted(tmp_path):
+    files = {"http://a/1.jpg": b"x" * 300, "http://b/1.jpg": b"x" * 300,
+             "http://a/2.jpg": b"y" * 300, "http://a/3.jpg": b"z" * 300}
+    opened = []
+
+    def opener(url):
+        opened.append(url)
+        return io.BytesIO(files[url])
+
+    cache = MediaCache(str(tmp_path), max_bytes=700, opener=opener)
+    first = cache.download("http://a/1.jpg")
+    assert first == hashlib.sha256(b"x" * 300).hexdigest()
+    # Репост той же картинки в другом канале не занимает место повторно.
+    assert cache.download("http://b/1.jpg") == first
+    assert (len(cache), cache.size) == (1, 300)
+
+    second = cache.download("http://a/2.jpg")
+    cache.release(second)
+    cache.set_file_id(first, "file-1")
+    cache.save()
+
+    # Сверх лимита первым удаляется файл без ссылок.
+    third = cache.download("http://a/3.jpg")
+    assert first in cache and third in cache and second not in cache
+    assert cache.stats()["evicted"] == 1
+
+    reopened = MediaCache(str(tmp_path), max_bytes=700, opener=opener)
+    assert reopened.size == 600
+    assert reopened.file_id(first) == "file-1"
+    with reopened.open(third) as f:
+        assert f.read() == b"z" * 300
+    assert not list((tmp_path / "tmp").iterdir())
+
+
+def test_post_media_is_uploaded_once_across_channels(tmp_path):
+    cache = MediaCache(str(tmp_path / "media"),
+                       opener=lambda url: io.BytesIO(b"photo"))
+    archive = PostArchive(str(tmp_path / "archive"), segment_bytes=1,
+                          max_channel_bytes=1,
+                          on_drop=lambda post: cache.release_post_media(post.data))
+    renderer = Renderer()
+    bot = Mock()
+    bot.send_photo.return_value.photo = [Mock(file_id="big")]
+    sender = Sender(bot, media=cache)
+
+    for channel_id, url in ((1, "http://a/p.jpg"), (2, "http://b/p.jpg")):
+        data = cache.add_post_media({
+            "channel": "chan{}".format(channel_id), "text": "photo",
+            "media": {"type": "photo", "url": url},
+        })
+        archive.append(channel_id, 10, data)
+        sender.send(channel_id * 100, renderer.render(channel_id, 10, data))
+
+    # file_id хранится в кэше медиа: новый Sender файл не загружает.
+    Sender(bot, media=cache).send(300, renderer.render(2, 10, data))
+    first, second, third = bot.send_photo.call_args_list
+    assert first[1]["photo"].name == cache.path(data["media"][HASH_KEY])
+    assert first[1]["photo"].closed
+    assert second[1]["photo"] == third[1]["photo"] == "big"
+
+    archive.append(1, 11, {"text": "next"})
+    archive.append(2, 11, {"text": "next"})
+    assert archive.compact() == 2
+    assert cache.stats()["unreferenced"] == 1
+    archive.close()
+
+
+def test_rejected_post_releases_media(tmp_path):
+    downloads = []
+
+    def opener(url):
+        downloads.append(url)
+        return io.BytesIO(url.encode())
+
+    cache = MediaCache(str(tmp_path / "media"), opener=opener)
+    archive = PostArchive(str(tmp_path / "archive"))
+    post = {"media": {"type": "photo", "url": "http://a/p.jpg"}}
+
+    assert cache.archive_post(archive, 1, 10, dict(post))
+    # Повтор не скачивается и не добавляет ссылку.
+    assert not cache.archive_post(archive, 1, 10, dict(post))
+    assert downloads == ["http://a/p.jpg"]
+    assert cache.stats()["unreferenced"] == 0
+
+    # Пост, который архив отклонил уже после скачивания, отпускает медиа.
+    archive.append = Mock(return_value=False)
+    assert not cache.archive_post(archive, 2, 10, {
+        "media": {"type": "photo", "url": "http://b/p.jpg"},
+    })
+    assert cache.stats()["unreferenced"] == 1
+    archive.close()
+
+    cache.start(interval=3600)
+    cache.stop()
+    assert MediaCache(str(tmp_path / "media")).stats()["unreferenced"] == 1
+
+
+def test_evicted_referenced_blob_keeps_file_id(tmp_path):
+    files = {"http://a/1.jpg": b"x" * 300, "http://a/2.jpg": b"y" * 300}
+    cache = MediaCache(str(tmp_path), max_bytes=500,
+                       opener=lambda url: io.BytesIO(files[url]))
+    first = cache.download("http://a/1.jpg")
+    cache.set_file_id(first, "file-1")
+    second = cache.download("http://a/2.jpg")
+
+    # Файл удален с диска, но рассылка по-прежнему отправляет file_id.
+    assert cache.open(first) is None
+    assert cache.file_id(first) == "file-1"
+    assert cache.size == 300
+    assert cache.stats()["file_id_only"] == 1
+    cache.save()
+
+    reopened = MediaCache(str(tmp_path), max_bytes=700,
+                          opener=lambda url: io.BytesIO(files[url]))
+    assert reopened.file_id(first) == "file-1"
+    assert reopened.open(first) is None
+    assert reopened.download("http://a/1.jpg") == first
+    with reopened.open(first) as f:
+        assert f.read() == b"x" * 300
+    assert reopened.size == 600 and second in reopened
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import pytest
+
+from events import EventBus
+from memstore import MemoryStore
+from polling import PollScheduler
+from throttle import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_interval_follows_posting_rate():
+    scheduler = PollScheduler(poll=lambda channel_id: 0, min_interval=10,
+                              max_interval=1000, initial_interval=100,
+                              clock=FakeClock())
+    chan = MemoryStore().create_channel(title="@chan")
+    chan.subs_count = 1
+    scheduler.load([chan])
+
+    scheduler.record(chan.id, 0, now=0)
+    assert scheduler.interval(chan.id) == 200
+    scheduler.record(chan.id, 0, now=200)
+    scheduler.record(chan.id, 0, now=600)
+    scheduler.record(chan.id, 0, now=1400)
+    assert scheduler.interval(chan.id) == 1000
+
+    # Всплеск постов сразу сокращает интервал по оценке частоты постов.
+    scheduler.record(chan.id, 20, now=2400)
+    assert scheduler.interval(chan.id) == pytest.approx(1 / (0.3 * 20 / 1000))
+    # Один пост за интервал лишь уточняет оценку частоты.
+    scheduler.record(chan.id, 1, now=2566)
+    assert 100 < scheduler.interval(chan.id) < 500
+    for now in (2600, 2650, 2700):
+        scheduler.record(chan.id, 20, now=now)
+    assert scheduler.interval(chan.id) == 10
+
+
+def test_run_once_respects_budget_and_subscriptions():
+    clock = FakeClock()
+    bus = EventBus()
+    store = MemoryStore(bus=bus)
+    polled = []
+    scheduler = PollScheduler(poll=lambda channel_id: polled.append(channel_id) or 0,
+                              budget=TokenBucket(rate=1, capacity=2, clock=clock),
+                              initial_interval=100, clock=clock)
+    scheduler.attach(bus)
+
+    users = [store.create_user(tg_id=i) for i in range(2)]
+    channels = [store.create_channel(title="@chan{}".format(i)) for i in range(3)]
+    for chan in channels:
+        store.create_subscription(users[0].id, chan.id)
+    store.create_subscription(users[1].id, channels[0].id)
+    assert len(scheduler) == 3
+
+    assert scheduler.run_once() == 2
+    assert scheduler.deferred == 1
+    clock.now = 1
+    assert scheduler.run_once() == 1
+    assert sorted(polled) == sorted(chan.id for chan in channels)
+    assert scheduler.next_due() == 200
+
+    # Канал без подписчиков больше не опрашивается.
+    store.delete_subscription(users[0].id, channels[1].id)
+    store.delete_user(user_id=users[0].id)
+    assert len(scheduler) == 1
+    clock.now = 1000
+    polled.clear()
+    scheduler.run_once()
+    assert polled == [channels[0].id]
+
+
+def test_load_spreads_first_polls():
+    store = MemoryStore()
+    channels = [store.create_channel(title="@chan{}".format(i)) for i in range(4)]
+    for chan in channels[:3]:
+        chan.subs_count = 5
+    scheduler = PollScheduler(poll=lambda channel_id: 0, initial_interval=90,
+                              clock=FakeClock())
+    scheduler.load(channels)
+    assert len(scheduler) == 3
+    assert scheduler.run_once(now=0) == 1
+    assert scheduler.run_once(now=60) == 2
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import threading
+
+from profiler import ControlServer, Profiler, parse_seconds
+
+
+def busy_handler(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profiler_collects_handler_stacks(tmp_path):
+    profiler = Profiler(str(tmp_path), interval=0.001)
+    stop = threading.Event()
+    handler = profiler.track(busy_handler)
+    assert handler.__name__ == "busy_handler"
+
+    done = []
+    assert profiler.trigger(0.2, done.append)
+    assert not profiler.trigger(0.2)
+    thread = threading.Thread(target=handler, args=(stop,))
+    thread.start()
+    profiler.wait()
+    stop.set()
+    thread.join()
+
+    cpu_path, handlers_path, memory_path = done[0]
+    assert not profiler.active
+    with open(cpu_path) as f:
+        assert "busy_handler" in f.read()
+    with open(handlers_path) as f:
+        assert "== busy_handler" in f.read()
+    assert os.path.getsize(memory_path) > 0
+
+
+def test_control_socket(tmp_path):
+    profiler = Profiler(str(tmp_path / "out"), interval=0.01)
+    server = ControlServer(profiler, str(tmp_path / "control.sock"))
+    server.start()
+    try:
+        def request(text):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(server.path)
+                sock.sendall(text.encode())
+                return sock.recv(4096).decode()
+
+        assert request("hello").startswith("usage")
+        assert request("profile 0.05").count("\n") == 3
+        assert request("profile 1000").startswith("duration")
+    finally:
+        server.stop()
+    assert not os.path.exists(server.path)
+
+
+def test_parse_seconds():
+    assert parse_seconds("30") == (30.0, None)
+    assert parse_seconds("abc")[1]
+    assert parse_seconds("0")[1]
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+from telegram.error import Unauthorized, NetworkError
+
+from memstore import MemoryStore
+from reaper import BlockedUsersReaper, is_blocked_error
+
+
+def test_is_blocked_error():
+    assert is_blocked_error(Unauthorized("Forbidden: bot was blocked by the user"))
+    assert is_blocked_error(Unauthorized("Forbidden: user is deactivated"))
+    assert not is_blocked_error(NetworkError("Bad Gateway"))
+    assert not is_blocked_error(
+        Unauthorized("Forbidden: bot can't initiate conversation with a user")
+    )
+
+
+def test_reaper_deletes_blocked_users_in_chunks():
+    store = MemoryStore()
+    chan = store.create_channel(title="@chan")
+    users = [store.create_user(tg_id=i) for i in range(10)]
+    for user in users:
+        store.create_subscription(user.id, chan.id)
+
+    progress, pauses = [], []
+    reaper = BlockedUsersReaper(store, chunk_size=3, load_budget=0.5,
+                                on_progress=progress.append,
+                                sleep=pauses.append)
+    blocked = Unauthorized("Forbidden: bot was blocked by the user")
+    for user in users[:7]:
+        assert reaper.report_failure(user.tg_id, blocked)
+    assert not reaper.report_failure(users[7].tg_id, NetworkError("timeout"))
+
+    assert reaper.run_once() == 7
+    assert reaper.pending_count() == 0
+    assert [p.chunks for p in progress] == [1, 2, 3]
+    assert progress[-1].deleted == 7 and progress[-1].remaining == 0
+    # Пауза делается только между пачками, а не после последней.
+    assert len(pauses) == 2
+
+    remaining = [sub.user_id for sub in store.get_subscriptions()]
+    assert sorted(remaining) == [user.id for user in users[7:]]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from unittest.mock import Mock
+
+from render import (FULL, PREVIEW, PREVIEW_LENGTH, FileIdCache, Renderer,
+                    Sender, open_post_link, parse_open_post)
+
+
+def test_render_is_cached_per_language_and_variant():
+    renderer = Renderer(max_entries=3)
+    data = {"channel": "chan", "text": "a < b " * 100}
+
+    first = renderer.render(1, 10, data, lang="en")
+    assert renderer.render(1, 10, data, lang="en") is first
+    assert first.method == "send_message"
+    assert first.kwargs["text"].startswith("<b>@chan</b>\n\na &lt; b")
+    button = first.kwargs["reply_markup"].inline_keyboard[0][0]
+    assert button.url == "https://t.me/chan/10"
+    assert button.text == "Open post"
+
+    preview = renderer.render(1, 10, data, lang="ru", variant=PREVIEW)
+    assert preview is not first
+    assert preview.kwargs["reply_markup"].inline_keyboard[0][0].text == \
+        "Открыть пост"
+    assert preview.kwargs["text"].endswith("…")
+    assert len(preview.kwargs["text"]) < PREVIEW_LENGTH * 2
+    assert (renderer.hits, renderer.misses) == (1, 2)
+
+    renderer.render(1, 11, data)
+    renderer.render(1, 12, data)
+    assert len(renderer) == 3
+    assert renderer.render(1, 10, data, lang="en") is not first
+
+    renderer.invalidate(1, 10)
+    assert renderer.render(1, 10, data, lang="en", variant=FULL) is not first
+
+
+def test_open_link_leads_through_bot():
+    renderer = Renderer(open_link=open_post_link("@feed_bot"))
+    rendered = renderer.render(7, 10, {"channel": "chan", "text": "text"})
+    button = rendered.kwargs["reply_markup"].inline_keyboard[0][0]
+    assert button.url == "https://t.me/feed_bot?start=open_7_10"
+    assert parse_open_post("open_7_10") == (7, 10)
+    assert parse_open_post("open_7") is None
+    assert parse_open_post("hello") is None
+
+
+def test_sender_reuses_uploaded_file_id():
+    renderer = Renderer()
+    rendered = renderer.render(1, 10, {
+        "channel": "chan",
+        "text": "photo",
+        "media": {"type": "photo", "url": "http://example.com/a.jpg"},
+    })
+    assert rendered.method == "send_photo"
+    assert rendered.media_key == "http://example.com/a.jpg"
+
+    bot = Mock()
+    bot.send_photo.return_value.photo = [Mock(file_id="small"),
+                                         Mock(file_id="big")]
+    sender = Sender(bot, FileIdCache())
+    sender.send(100, rendered)
+    sender.send(200, rendered)
+
+    first, second = bot.send_photo.call_args_list
+    assert first[1]["photo"] == "http://example.com/a.jpg"
+    assert first[1]["chat_id"] == 100
+    assert second[1]["photo"] == "big"
+    assert second[1]["caption"] == first[1]["caption"]
+    assert rendered.kwargs["photo"] == "http://example.com/a.jpg"
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+from archive import PostArchive
+from search import SearchIndex, tokenize
+
+
+def test_tokenize():
+    assert tokenize("Новые релизы Python и Ёжик!") == ["нов", "релиз", "python",
+                                                       "ежик"]
+    assert tokenize("The cats are here") == ["cat", "here"]
+    assert tokenize("релиз") == tokenize("релиза") == tokenize("релизы")
+
+
+def test_search_restricted_to_channels():
+    index = SearchIndex()
+    index.add_post(1, 10, "Вышел новый релиз Python")
+    index.add_post(2, 5, "Python 4 release date")
+    index.add_post(1, 11, "Погода на выходные")
+    index.add_post(1, 12, "Еще один релиз python, на этот раз 3.13")
+
+    assert index.search("python", [1, 2]) == [(1, 12), (2, 5), (1, 10)]
+    assert index.search("python", [2]) == [(2, 5)]
+    assert index.search("релизы python", [1, 2]) == [(1, 12), (1, 10)]
+    assert index.search("python", [1, 2], limit=1) == [(1, 12)]
+    assert index.search("golang", [1, 2]) == []
+    assert index.search("и", [1, 2]) == []
+
+    # Повторная индексация поста игнорируется.
+    assert not index.add_post(1, 12, "python")
+    assert len(index) == 4
+
+
+def test_build_from_archive(tmp_path):
+    archive = PostArchive(str(tmp_path))
+    archive.append(1, 1, {"text": "hello world"})
+    archive.append(2, 1, {"text": "hello there"})
+
+    index = SearchIndex()
+    assert index.build_from_archive(archive) == 2
+    archive.append(2, 2, {"text": "hello again"})
+    assert index.build_from_archive(archive) == 1
+    assert index.search("hello", [1, 2]) == [(2, 2), (2, 1), (1, 1)]
+    archive.close()
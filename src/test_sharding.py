@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+import tracing
+from tracing import Tracer
+from deliverylog import DeliveryLog
+from deferred import DeliveryPrefs, DeliveryScheduler
+from kwfilter import FilterIndex
+from sharding import (NUM_SLOTS, Delivery, ShardedDelivery, ShardWorker,
+                      SlotJournal, shard_for, shard_for_slot, slot_for,
+                      slots_of)
+
+
+def test_slots_are_split_between_shards():
+    shards = [slots_of(shard, 3) for shard in range(3)]
+    assert sorted(sum(shards, [])) == list(range(NUM_SLOTS))
+    assert max(map(len, shards)) - min(map(len, shards)) <= 1
+
+    for tg_id in range(1000):
+        assert shard_for(tg_id, 3) == shard_for_slot(slot_for(tg_id), 3)
+        assert 0 <= shard_for(tg_id, 3) < 3
+
+
+def test_worker_skips_delivered_after_restart(tmp_path):
+    sent = []
+    worker = ShardWorker(0, 1, str(tmp_path),
+                         send=lambda tg_id, payload, bot: sent.append(
+                             (tg_id, payload)))
+    worker.handle(Delivery(1, 100, {"text": "a"}))
+    worker.handle(Delivery(2, 100, {"text": "b"}))
+    worker.handle(Delivery(1, 100, {"text": "a"}))
+    assert sent == [(100, {"text": "a"}), (100, {"text": "b"})]
+    assert worker.skipped == 1
+
+    # Журнал не свернут в снимок - как после падения процесса.
+    worker = ShardWorker(0, 1, str(tmp_path),
+                         send=lambda tg_id, payload, bot: sent.append(
+                             (tg_id, payload)))
+    worker.handle(Delivery(2, 100, {"text": "b"}))
+    worker.handle(Delivery(3, 100, {"text": "c"}))
+    worker.close()
+    assert sent[-1] == (100, {"text": "c"})
+    assert len(sent) == 3
+
+    journal = SlotJournal(str(tmp_path), slot_for(100))
+    assert journal.watermarks == {100: 3}
+    assert os.path.getsize(journal.log_path) == 0
+
+
+def test_journal_ignores_torn_last_line(tmp_path):
+    journal = SlotJournal(str(tmp_path), 5)
+    journal.record(1, 10)
+    journal.close()
+    with open(journal.log_path, "a") as f:
+        f.write("1 2")
+    assert SlotJournal(str(tmp_path), 5).watermarks == {1: 10}
+
+
+def test_worker_reports_errors_and_moves_on(tmp_path):
+    errors = []
+
+    def send(tg_id, payload, bot):
+        raise Unauthorized("Forbidden: bot was blocked by the user")
+
+    worker = ShardWorker(0, 1, str(tmp_path), send,
+                         on_error=lambda tg_id, e: errors.append(tg_id))
+    worker.handle(Delivery(1, 7, {}))
+    worker.handle(Delivery(1, 7, {}))
+    assert errors == [7]
+
+
+def test_failed_delivery_is_held_and_retried(tmp_path):
+    attempts, sleeps = [], []
+    network_down = [True]
+
+    def send(tg_id, payload, bot):
+        attempts.append((tg_id, payload["n"]))
+        if network_down[0] and tg_id == 7:
+            raise NetworkError("timeout")
+
+    def make_worker():
+        return ShardWorker(0, 1, str(tmp_path), send,
+                           on_error=lambda tg_id, e: None, max_attempts=2,
+                           clock=lambda: 0.0, sleep=sleeps.append)
+
+    worker = make_worker()
+    worker.handle(Delivery(1, 7, {"n": 1}))
+    # Следующее сообщение встает за недоставленным, другим - доставляется.
+    worker.handle(Delivery(2, 7, {"n": 2}))
+    worker.handle(Delivery(2, 8, {"n": 2}))
+    assert attempts == [(7, 1), (7, 1), (8, 2)]
+    assert sleeps == [1.0] and worker.held == 2
+    assert worker.retry_held() == 0
+    worker.close()
+
+    # Отложенные сообщения переживают рестарт и доставляются по порядку.
+    network_down[0] = False
+    worker = make_worker()
+    assert worker.held == 2
+    assert worker.retry_held() == 2
+    assert attempts[-2:] == [(7, 1), (7, 2)]
+    worker.handle(Delivery(2, 7, {"n": 2}))
+    worker.close()
+    assert worker.skipped == 1
+    assert not SlotJournal(str(tmp_path), slot_for(7)).held
+
+
+def test_worker_waits_on_retry_after_and_skips_bad_requests(tmp_path):
+    sleeps, errors = [], []
+    responses = [RetryAfter(5), None, BadRequest("Chat not found")]
+
+    def send(tg_id, payload, bot):
+        error = responses.pop(0)
+        if error is not None:
+            raise error
+
+    worker = ShardWorker(0, 1, str(tmp_path), send, sleep=sleeps.append,
+                         on_error=lambda tg_id, e: errors.append(tg_id))
+    worker.handle(Delivery(1, 7, {}))
+    worker.handle(Delivery(2, 7, {}))
+    worker.handle(Delivery(2, 7, {}))
+    assert sleeps == [5] and errors == [7]
+    assert worker.held == 0 and worker.skipped == 1
+
+
+def test_seq_survives_clock_going_back(tmp_path, monkeypatch):
+    delivery = ShardedDelivery(1, str(tmp_path), _file_sender)
+    first = delivery.next_seq()
+    monkeypatch.setattr(time, "time", lambda: 1.0)
+    assert ShardedDelivery(1, str(tmp_path), _file_sender).next_seq() > first
+
+
+def _file_sender(shard):
+    root = os.environ["SHARDING_TEST_OUT"]
+
+    def send(tg_id, payload, bot):
+        if payload.get("blocked") == tg_id:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+        with open(os.path.join(root, "out"), "a") as f:
+            item = [tg_id, payload["n"]] + ([bot] if bot is not None else [])
+            f.write(json.dumps(item) + "\n")
+
+    return send
+
+
+def _delivered(root):
+    with open(os.path.join(root, "out")) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_sharded_delivery_preserves_order_and_survives_rebalance(tmp_path,
+                                                                  monkeypatch):
+    monkeypatch.setenv("SHARDING_TEST_OUT", str(tmp_path))
+    blocked = []
+    delivery = ShardedDelivery(3, str(tmp_path / "journal"), _file_sender,
+                               on_blocked=blocked.append)
+    users = list(range(1, 51))
+
+    delivery.start()
+    seqs = [delivery.fan_out({"n": n, "blocked": 13}, users) for n in range(5)]
+    delivery.rebalance(2)
+    # Повторная рассылка тех же постов после перебалансировки.
+    for n, seq in enumerate(seqs):
+        delivery.fan_out({"n": n, "blocked": 13}, users, seq=seq)
+    delivery.fan_out({"n": 5}, users)
+    delivery.close()
+
+    delivered = _delivered(str(tmp_path))
+    assert len(delivered) == len(users) * 6 - 5
+    for tg_id in users:
+        got = [n for user, n in delivered if user == tg_id]
+        assert got == ([5] if tg_id == 13 else list(range(6)))
+    assert blocked == [13] * 5
+
+
+def test_traced_deliveries(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARDING_TEST_OUT", str(tmp_path))
+    tracer = Tracer()
+    delivery = ShardedDelivery(2, str(tmp_path / "journal"), _file_sender,
+                               tracer=tracer)
+    delivery.start()
+    payload = {"n": 0}
+    tracing.start_trace(payload, published=time.time() - 1)
+    delivery.fan_out(payload, [1, 2, 3])
+    delivery.fan_out({"n": 1}, [1, 2, 3])
+    delivery.close()
+
+    # Трассы есть только у поста с контекстом - по одной на подписчика.
+    stats = tracer.stats()
+    assert stats[tracing.TOTAL]["count"] == 3
+    assert stats[tracing.TOTAL]["p50"] >= 1
+    for stage in (tracing.GRAB, tracing.QUEUE, tracing.FAN_OUT, tracing.SEND):
+        assert stats[stage]["count"] == 3
+    assert stats[tracing.RENDER]["count"] == 0
+    assert sorted(trace["tg_id"] for trace in tracer.flush()) == [1, 2, 3]
+
+
+def test_worker_logs_delivery_events(tmp_path):
+    def send(tg_id, payload, bot):
+        if tg_id == 7:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+
+    events = DeliveryLog(str(tmp_path / "events"))
+    worker = ShardWorker(0, 1, str(tmp_path), send,
+                         on_error=lambda tg_id, e: None, events=events)
+    worker.handle(Delivery(1, 5, {"channel_id": 42}))
+    worker.handle(Delivery(1, 7, {"channel_id": 42}))
+    worker.handle(Delivery(1, 5, {"channel_id": 42}))
+    worker.close()
+
+    now = time.time()
+    stats = DeliveryLog(str(tmp_path / "events")).channel_stats(now - 3600,
+                                                                now + 3600)
+    assert stats[42]["sent"] == 1 and stats[42]["blocked"] == 1
+
+
+def test_fan_out_skips_filtered_subscribers(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARDING_TEST_OUT", str(tmp_path))
+    filters = FilterIndex()
+    filters.set_filters(42, user_id=2, filters="+python")
+    filters.set_filters(42, user_id=3, filters="-ads")
+    delivery = ShardedDelivery(2, str(tmp_path / "journal"), _file_sender,
+                               filters=filters)
+    delivery.start()
+    subscribers = {10: 1, 20: 2, 30: 3}
+    delivery.fan_out({"n": 0, "channel_id": 42, "text": "Python ads"},
+                     subscribers)
+    delivery.fan_out({"n": 1, "channel_id": 42, "text": "Golang"},
+                     subscribers)
+    delivery.close()
+
+    assert sorted(_delivered(str(tmp_path))) == [[10, 0], [10, 1], [20, 0],
+                                                 [30, 1]]
+    assert delivery.filtered == 2
+
+
+def test_fan_out_defers_delivery_in_quiet_hours(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARDING_TEST_OUT", str(tmp_path))
+    # 23:30 UTC, у пользователя 20 тихие часы с 23:00 до 08:00.
+    now = [86400 * 100 + 23 * 3600 + 30 * 60]
+    scheduler = DeliveryScheduler(lambda tg_id, items: None,
+                                  clock=lambda: now[0])
+    scheduler.set_prefs(20, DeliveryPrefs(quiet_from=23 * 60, quiet_to=8 * 60))
+    delivery = ShardedDelivery(2, str(tmp_path / "journal"), _file_sender,
+                               scheduler=scheduler)
+    scheduler.send_batch = delivery.route_batch
+    delivery.start()
+    delivery.fan_out({"n": 0}, [10, 20])
+    delivery.fan_out({"n": 1}, [10, 20])
+    assert scheduler.pending_items() == 2
+    assert scheduler.flush_due() == 0
+
+    now[0] += 9 * 3600
+    assert scheduler.flush_due() == 1
+    delivery.close()
+
+    assert sorted(_delivered(str(tmp_path))) == [[10, 0], [10, 1], [20, 0],
+                                                 [20, 1]]
+
+
+def test_fan_out_sends_through_subscriber_bot(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARDING_TEST_OUT", str(tmp_path))
+    delivery = ShardedDelivery(2, str(tmp_path / "journal"), _file_sender)
+    delivery.start()
+    delivery.fan_out({"n": 0}, [1, 2], bots={2: "222"})
+    delivery.close()
+    assert sorted(_delivered(str(tmp_path))) == [[1, 0], [2, 0, "222"]]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import json
+import threading
+
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from startup import Readiness, HealthServer, warm_up, parse_address
+
+
+def get(server, path):
+    host, port = server.server_address[:2]
+    try:
+        with urlopen("http://{}:{}{}".format(host, port, path)) as response:
+            return response.status, json.loads(response.read().decode())
+    except HTTPError as e:
+        return e.code, json.loads(e.read().decode())
+
+
+def test_readiness():
+    readiness = Readiness(["imports"])
+    assert not readiness.ready
+    readiness.done("imports")
+    assert readiness.ready
+
+    readiness.add("polling")
+    assert not readiness.ready
+    readiness.fail("polling", "no network")
+    assert not readiness.ready
+    assert readiness.status()["checks"]["polling"]["error"] == "no network"
+    readiness.done("polling")
+    assert readiness.wait(0)
+
+
+def test_warm_up():
+    readiness = Readiness()
+    release = threading.Event()
+    calls = []
+
+    def fail():
+        raise RuntimeError("db is down")
+
+    thread = warm_up(readiness, [
+        ("cache", lambda: release.wait() and calls.append("cache")),
+        ("broken", fail),
+        ("index", lambda: calls.append("index")),
+    ], attempts=1)
+    assert set(readiness.status()["checks"]) == {"cache", "broken", "index"}
+    assert not readiness.ready
+
+    release.set()
+    thread.join()
+    # Упавший шаг не останавливает остальные, но процесс остается неготовым.
+    assert calls == ["cache", "index"]
+    checks = readiness.status()["checks"]
+    assert checks["broken"]["state"] == "failed"
+    assert checks["index"]["state"] == "ok"
+    assert not readiness.ready
+
+
+def test_warm_up_retries_failed_steps():
+    readiness = Readiness()
+    failures = [RuntimeError("db is down")] * 3
+    delays = []
+
+    def flaky():
+        if failures:
+            raise failures.pop()
+
+    warm_up(readiness, [("flaky", flaky), ("index", lambda: None)],
+            retry_delay=1, max_retry_delay=3, sleep=delays.append).join()
+    assert delays == [1, 2, 3]
+    assert readiness.status()["checks"]["flaky"]["state"] == "ok"
+    assert readiness.ready
+
+
+def test_health_server():
+    readiness = Readiness(["polling"])
+    server = HealthServer(readiness)
+    server.start()
+    try:
+        assert get(server, "/livez") == (200, {"alive": True})
+        code, status = get(server, "/healthz")
+        assert code == 503 and not status["ready"]
+        assert status["checks"]["polling"]["state"] == "pending"
+
+        readiness.done("polling")
+        code, status = get(server, "/healthz")
+        assert code == 200 and status["ready"]
+        assert get(server, "/metrics")[0] == 404
+    finally:
+        server.stop()
+
+
+def test_parse_address():
+    assert parse_address("127.0.0.1:8000") == ("127.0.0.1", 8000)
+    assert parse_address(":9000") == ("0.0.0.0", 9000)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import time
+import multiprocessing
+
+import pytest
+
+from unittest.mock import Mock
+
+from throttle import (TokenBucket, LocalBuckets, SharedBuckets, Throttler,
+                      OutboundLimiter, parse_address, serve_buckets)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_update(chat_id):
+    update = Mock()
+    update.effective_chat.id = chat_id
+    update.callback_query = None
+    return update
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() == 0.5
+
+    clock.now = 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+def test_local_buckets_sweep_full_buckets():
+    clock = FakeClock()
+    buckets = LocalBuckets(rate=1, capacity=2, sweep_every=3, clock=clock)
+    buckets.try_acquire("a")
+    buckets.try_acquire("b")
+    clock.now = 10
+    buckets.try_acquire("c")
+    assert len(buckets) == 1
+
+
+def test_throttler_rejects_before_handler():
+    clock = FakeClock()
+    buckets = LocalBuckets(rate=1, capacity=2, clock=clock)
+    throttle = Throttler(buckets, "slow down", warn_interval=5, clock=clock)
+    handler = Mock(return_value="ok")
+    wrapped = throttle(handler)
+
+    update = make_update(1)
+    assert wrapped(None, update, args=["@chan"]) == "ok"
+    assert wrapped(None, update, args=["@chan"]) == "ok"
+    assert wrapped(None, update, args=["@chan"]) is None
+    assert wrapped(None, update, args=["@chan"]) is None
+    assert handler.call_count == 2
+    assert throttle.rejected == 2
+    # Предупреждение отправляется один раз за warn_interval.
+    update.message.reply_text.assert_called_once_with("slow down")
+
+    # Другой чат не затронут.
+    assert wrapped(None, make_update(2)) == "ok"
+
+    clock.now = 1
+    assert wrapped(None, update) == "ok"
+
+
+def test_outbound_limiter():
+    clock = FakeClock()
+
+    def sleep(seconds):
+        clock.now += seconds
+
+    limiter = OutboundLimiter(per_bot_rate=2, global_rate=3, clock=clock,
+                              sleep=sleep)
+    assert [limiter.acquire("a") for _ in range(2)] == [0.0, 0.0]
+    assert limiter.acquire("a") == 0.5
+    # У второго бота свое ведро, но общий лимит уже почти исчерпан.
+    assert limiter.acquire("b") == 0.0
+    assert limiter.acquire("b") > 0
+
+
+def _acquire_shared(address, results):
+    buckets = SharedBuckets(address, b"secret")
+    results.put([buckets.try_acquire("chat") for _ in range(3)])
+
+
+def test_processes_share_buckets(tmp_path):
+    address = str(tmp_path / "throttle.sock")
+    server = multiprocessing.Process(target=serve_buckets,
+                                     args=(address, b"secret", 0.001, 4),
+                                     daemon=True)
+    server.start()
+    try:
+        deadline = time.time() + 10
+        while not (tmp_path / "throttle.sock").exists():
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=_acquire_shared,
+                                           args=(address, results))
+                   for _ in range(2)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        allowed = results.get(timeout=10) + results.get(timeout=10)
+        # Ведро на 4 команды одно на оба процесса.
+        assert allowed.count(True) == 4
+    finally:
+        server.terminate()
+
+
+def test_shared_buckets_require_authkey():
+    with pytest.raises(ValueError):
+        serve_buckets("/tmp/unused.sock", b"", 1, 1)
+    with pytest.raises(ValueError):
+        SharedBuckets(("127.0.0.1", 7001), b"")
+    assert parse_address("7001") == ("127.0.0.1", 7001)
+    assert parse_address("10.0.0.1:7001") == ("10.0.0.1", 7001)
+    assert parse_address("/run/throttle.sock") == "/run/throttle.sock"
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import json
+
+import tracing
+from tracing import LatencyHistogram, Tracer, stage_durations
+
+
+def test_stage_durations():
+    payload = {"text": "post"}
+    tracing.start_trace(payload, published=100.0, now=102.0)
+    tracing.mark(payload, tracing.QUEUE, now=102.5)
+    copy = tracing.fork(payload)
+    tracing.mark(copy, tracing.FAN_OUT, now=103.0)
+    tracing.mark(copy, tracing.SEND, now=104.0)
+
+    # Неотмеченный render входит в send, а отметки копии не меняют пост.
+    assert stage_durations(copy["trace"]) == {
+        tracing.GRAB: 2.0, tracing.QUEUE: 0.5, tracing.FAN_OUT: 0.5,
+        tracing.SEND: 1.0, tracing.TOTAL: 4.0,
+    }
+    assert set(payload["trace"]["marks"]) == {tracing.GRAB, tracing.QUEUE}
+
+    untraced = {"text": "post"}
+    tracing.mark(untraced, tracing.SEND)
+    assert tracing.fork(untraced) is untraced and "trace" not in untraced
+
+
+def test_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) == 0.0
+    for ms in range(1, 101):
+        histogram.add(ms / 1000)
+    assert histogram.count == 100
+    assert 0.05 <= histogram.percentile(50) <= 0.05 * 1.19
+    assert 0.099 <= histogram.percentile(99) <= 0.1
+    assert histogram.percentile(100) == histogram.max == 0.1
+
+
+def test_tracer_samples_slowest(tmp_path):
+    path = str(tmp_path / "traces" / "slowest.jsonl")
+    tracer = Tracer(path, slowest=2)
+    for i, total in enumerate([1.0, 5.0, 3.0, 0.5]):
+        payload = {}
+        tracing.start_trace(payload, published=0.0, now=total / 2)
+        tracing.mark(payload, tracing.SEND, now=total)
+        tracer.record(payload["trace"], tg_id=i)
+
+    assert tracer.stats()[tracing.TOTAL]["count"] == 4
+    assert [t["tg_id"] for t in tracer.flush()] == [1, 2]
+    assert tracer.flush() == []
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [t["durations"][tracing.TOTAL] for t in lines] == [5.0, 3.0]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import pytest
+import threading
+
+from unittest.mock import Mock
+
+from memstore import MemoryStore
+from updates import DedupWindow, UpdateTracker, LAST_UPDATE_ID_KEY
+
+
+def make_update(update_id):
+    update = Mock()
+    update.update_id = update_id
+    return update
+
+
+def test_dedup_window():
+    window = DedupWindow(last=10, size=3)
+    assert window.seen(10)
+    assert not window.seen(11)
+
+    for update_id in (12, 11, 13, 14):
+        window.add(update_id)
+    assert window.last == 14
+    assert len(window) == 3
+    # 12 вытеснено из окна, но все, что не новее него, считается виденным.
+    assert window.seen(12) and window.seen(11)
+    assert window.seen(14)
+    assert not window.seen(15)
+
+
+def test_tracker_skips_duplicates_and_persists_last_update_id():
+    store = MemoryStore()
+    calls = []
+    tracker = UpdateTracker(store)
+    tracker.load()
+    handler = tracker(lambda bot, update: calls.append(update.update_id))
+
+    for update_id in (100, 101, 100, 102, 101):
+        handler(None, make_update(update_id))
+    assert calls == [100, 101, 102]
+    assert tracker.skipped == 2
+    assert store.get_state(LAST_UPDATE_ID_KEY) == "102"
+
+    # После рестарта опрос продолжается со следующего обновления.
+    tracker = UpdateTracker(store)
+    tracker.load()
+    updater = Mock()
+    tracker.resume(updater)
+    assert updater.last_update_id == 103
+    tracker(lambda bot, update: calls.append(update.update_id))(
+        None, make_update(102)
+    )
+    assert calls == [100, 101, 102]
+
+
+def test_tracker_marks_failed_update_as_processed():
+    store = MemoryStore()
+    tracker = UpdateTracker(store)
+    tracker.load()
+
+    @tracker
+    def handler(bot, update):
+        store.create_channel("@first")
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        handler(None, make_update(5))
+    assert store.get_state(LAST_UPDATE_ID_KEY) == "5"
+    # Записи хэндлера до ошибки откатываются вместе с транзакцией.
+    assert not store.channel_exists(title="@first")
+    assert handler(None, make_update(5)) is None
+
+
+def test_tracker_waits_for_load():
+    store = MemoryStore()
+    store.set_state(LAST_UPDATE_ID_KEY, "7")
+    store.get_state = Mock(wraps=store.get_state)
+    calls = []
+    tracker = UpdateTracker(store)
+    assert not store.get_state.called
+
+    handler = tracker(lambda bot, update: calls.append(update.update_id))
+    threads = [threading.Thread(target=handler,
+                                args=(None, make_update(update_id)))
+               for update_id in (7, 8)]
+    for thread in threads:
+        thread.start()
+    assert calls == []
+
+    tracker.load()
+    for thread in threads:
+        thread.join()
+    # Обновление 7 уже обработано до рестарта.
+    assert calls == [8]
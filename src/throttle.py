@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+
+from functools import wraps
+from multiprocessing.managers import BaseManager
+from typing import Callable, Dict, Hashable, Tuple, Union
+
+
+# Допуск на ошибку округления: после ожидания wait_time() ровно нужного
+# времени токенов может не хватать на величину порядка 1e-16.
+EPSILON = 1e-9
+
+
+class TokenBucket:
+    """
+    Классическое "ведро с токенами": пополняется со скоростью rate токенов в
+    секунду до capacity, каждое действие забирает токен.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 capacity: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+
+    def _refill(self, now: float):
+        elapsed = max(now - self._updated, 0.0)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill(self._clock())
+        if self._tokens + EPSILON < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def wait_time(self, tokens: float = 1.0) -> float:
+        """
+        Сколько секунд нужно подождать, чтобы набралось tokens токенов.
+        """
+        self._refill(self._clock())
+        if self._tokens + EPSILON >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill(self._clock())
+        return self._tokens >= self.capacity
+
+
+class LocalBuckets:
+    """
+    Набор ведер по ключам (например, по ID чата) в памяти процесса.
+    Полные ведра периодически удаляются, чтобы память не росла с
+    количеством когда-либо писавших боту пользователей.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 capacity: float,
+                 sweep_every: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.sweep_every = sweep_every
+        self._clock = clock
+        self._buckets = {}  # type: Dict[Hashable, TokenBucket]
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def try_acquire(self, key: Hashable) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    self.rate, self.capacity, self._clock
+                )
+            allowed = bucket.try_acquire()
+
+            self._calls += 1
+            if self._calls >= self.sweep_every:
+                self._calls = 0
+                self._buckets = {
+                    k: b for k, b in self._buckets.items() if not b.is_full()
+                }
+            return allowed
+
+
+class OutboundLimiter:
+    """
+    Общий для всех ботов процесса ограничитель исходящих запросов к Bot API:
+    не больше per_bot_rate запросов в секунду на каждого бота (ключ - токен
+    или ID бота) и, если задано, не больше global_rate на всех вместе.
+    acquire() ждет, пока запрос можно будет отправить.
+    """
+
+    def __init__(self,
+                 per_bot_rate: float = 30.0,
+                 global_rate: float = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.per_bot_rate = per_bot_rate
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}  # type: Dict[Hashable, TokenBucket]
+        self._global = TokenBucket(global_rate, global_rate, clock) \
+            if global_rate else None
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, key: Hashable) -> float:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    self.per_bot_rate, self.per_bot_rate, self._clock
+                )
+            wait = bucket.wait_time()
+            if self._global is not None:
+                wait = max(wait, self._global.wait_time())
+            if wait > 0:
+                return wait
+            bucket.try_acquire()
+            if self._global is not None:
+                self._global.try_acquire()
+            return 0.0
+
+    def acquire(self, key: Hashable) -> float:
+        """
+        :return: сколько секунд пришлось ждать.
+        """
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(key)
+            if wait <= 0:
+                return waited
+            self._sleep(wait)
+            waited += wait
+
+
+class _BucketsServer(BaseManager):
+    pass
+
+
+class _BucketsClient(BaseManager):
+    pass
+
+
+_BucketsClient.register("buckets")
+
+
+# Адрес сервера ведер по умолчанию: только локальные подключения.
+DEFAULT_BUCKETS_HOST = "127.0.0.1"
+
+BucketsAddress = Union[str, Tuple[str, int]]
+
+
+def parse_address(value: str) -> BucketsAddress:
+    """
+    Разбирает адрес сервера ведер: путь к UNIX-сокету ("/run/throttle.sock"),
+    "host:port" или просто порт - тогда сервер слушает только локальные
+    подключения.
+    """
+    if "/" in value:
+        return value
+    host, _, port = value.rpartition(":")
+    return host or DEFAULT_BUCKETS_HOST, int(port)
+
+
+def _check_authkey(authkey: bytes):
+    # Менеджер передает объекты через pickle: без ключа любой, кто может
+    # подключиться к адресу, выполнит на сервере произвольный код.
+    if not authkey:
+        raise ValueError("Shared throttle buckets require a non-empty authkey.")
+
+
+def serve_buckets(address: BucketsAddress,
+                  authkey: bytes,
+                  rate: float,
+                  capacity: float):
+    """
+    Запускает сервер общего состояния ограничителя для нескольких процессов
+    бота на одной машине. Блокирует текущий поток.
+    :param address: путь к UNIX-сокету или (host, port), см. parse_address().
+    """
+    _check_authkey(authkey)
+    buckets = LocalBuckets(rate, capacity)
+    _BucketsServer.register("buckets", callable=lambda: buckets)
+    manager = _BucketsServer(address=address, authkey=authkey)
+    manager.get_server().serve_forever()
+
+
+class SharedBuckets:
+    """
+    Клиент общего набора ведер, запущенного через serve_buckets(). Имеет тот
+    же интерфейс, что и LocalBuckets.
+    """
+
+    def __init__(self, address: BucketsAddress, authkey: bytes):
+        _check_authkey(authkey)
+        manager = _BucketsClient(address=address, authkey=authkey)
+        manager.connect()
+        self._buckets = manager.buckets()
+
+    def try_acquire(self, key: Hashable) -> bool:
+        return self._buckets.try_acquire(key)
+
+
+def _chat_id(update) -> Hashable:
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    return update.message.chat.id
+
+
+class Throttler:
+    """
+    Ограничитель входящих команд: пропускает к хэндлерам FeedBot не больше
+    заданного числа команд от одного чата, остальные отклоняются до любого
+    обращения к хранилищу. Предупреждение отправляется не чаще одного раза
+    в warn_interval секунд на чат.
+    """
+
+    def __init__(self,
+                 buckets,
+                 slow_down_text: str,
+                 warn_interval: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.buckets = buckets
+        self.slow_down_text = slow_down_text
+        self.warn_interval = warn_interval
+        self._clock = clock
+        self._warned = {}  # type: Dict[Hashable, float]
+        self.rejected = 0
+
+    def _should_warn(self, chat_id: Hashable) -> bool:
+        now = self._clock()
+        if now - self._warned.get(chat_id, float("-inf")) < self.warn_interval:
+            return False
+        if len(self._warned) > 10000:
+            self._warned = {
+                k: t for k, t in self._warned.items()
+                if now - t < self.warn_interval
+            }
+        self._warned[chat_id] = now
+        return True
+
+    def _reject(self, update, chat_id: Hashable):
+        self.rejected += 1
+        if not self._should_warn(chat_id):
+            return
+        query = getattr(update, "callback_query", None)
+        if query is not None:
+            query.answer(self.slow_down_text)
+        elif update.message is not None:
+            update.message.reply_text(self.slow_down_text)
+
+    def __call__(self, handler):
+        """
+        Оборачивает хэндлер с сигнатурой (bot, update, ...).
+        """
+        @wraps(handler)
+        def wrapper(bot, update, *args, **kwargs):
+            chat_id = _chat_id(update)
+            if not self.buckets.try_acquire(chat_id):
+                self._reject(update, chat_id)
+                return None
+            return handler(bot, update, *args, **kwargs)
+
+        return wrapper
+
+
+def main():
+    """
+    Сервер общих ведер для процессов бота (см. SharedBuckets):
+
+        THROTTLE_ADDRESS=/run/feedbot/throttle.sock THROTTLE_AUTHKEY=... \\
+            python throttle.py
+
+    Процессы бота подключаются к нему, если у них задан тот же
+    THROTTLE_ADDRESS и THROTTLE_AUTHKEY.
+    """
+    serve_buckets(parse_address(os.getenv("THROTTLE_ADDRESS", "7001")),
+                  os.getenv("THROTTLE_AUTHKEY", "").encode(),
+                  float(os.getenv("THROTTLE_RATE", "1")),
+                  float(os.getenv("THROTTLE_BURST", "5")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+import os
+import json
+import math
+import time
+import heapq
+import uuid
+import threading
+import traceback
+
+from itertools import count
+from typing import Any, Dict, List, Tuple
+
+# Этапы пути поста от публикации в канале до получения подписчиком. Каждый
+# этап отмечается временем своего окончания, а его длительность считается
+# от предыдущей отметки:
+# - grab: от публикации до того, как граббер забрал пост;
+# - queue: ожидание до начала рассылки (fan_out);
+# - fan_out: раскладка по очередям шардов и ожидание в очереди шарда;
+# - render: подготовка сообщения для подписчика (отмечается функцией send
+#   доставки после Renderer.render());
+# - send: вызов Bot API.
+GRAB = "grab"
+QUEUE = "queue"
+FAN_OUT = "fan_out"
+RENDER = "render"
+SEND = "send"
+STAGES = (GRAB, QUEUE, FAN_OUT, RENDER, SEND)
+TOTAL = "total"
+
+# Ключ контекста трассировки в данных поста.
+TRACE_KEY = "trace"
+
+# Границы корзин гистограммы растут в 2^(1/4) раза от 1 мс: погрешность
+# перцентилей не больше 19%, а 100 корзин покрывают задержки до ~8 часов.
+MIN_LATENCY = 0.001
+BUCKETS_PER_DOUBLING = 4
+NUM_BUCKETS = 100
+
+
+def start_trace(payload: Dict[str, Any],
+                published: float = None,
+                now: float = None) -> Dict[str, Any]:
+    """
+    Добавляет к данным поста контекст трассировки и отмечает этап grab.
+    Контекст - обычный словарь, поэтому передается вместе с постом между
+    процессами и сериализуется в JSON.
+    :param published: время публикации поста в канале (unix time).
+    """
+    now = time.time() if now is None else now
+    trace = {
+        "id": uuid.uuid4().hex[:16],
+        "published": now if published is None else published,
+        "marks": {GRAB: now},
+    }
+    payload[TRACE_KEY] = trace
+    return trace
+
+
+def mark(payload: Dict[str, Any], stage: str, now: float = None):
+    """
+    Отмечает окончание этапа. Для постов без контекста ничего не делает.
+    """
+    trace = payload.get(TRACE_KEY)
+    if trace is not None:
+        trace["marks"][stage] = time.time() if now is None else now
+
+
+def fork(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Копия данных поста с собственными отметками этапов - для этапов,
+    которые у каждого подписчика свои (после рассылки).
+    """
+    trace = payload.get(TRACE_KEY)
+    if trace is None:
+        return payload
+    payload = dict(payload)
+    payload[TRACE_KEY] = dict(trace, marks=dict(trace["marks"]))
+    return payload
+
+
+def stage_durations(trace: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Длительности этапов трассы и общая задержка (ключ TOTAL). Время
+    неотмеченного этапа достается следующему отмеченному.
+    """
+    durations = {}
+    last = trace["published"]
+    for stage in STAGES:
+        at = trace["marks"].get(stage)
+        if at is None:
+            continue
+        durations[stage] = max(at - last, 0.0)
+        last = at
+    durations[TOTAL] = max(last - trace["published"], 0.0)
+    return durations
+
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек с логарифмическими корзинами: фиксированный
+    размер в памяти при любом количестве значений.
+    """
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        if seconds <= MIN_LATENCY:
+            return 0
+        index = int(math.log2(seconds / MIN_LATENCY) * BUCKETS_PER_DOUBLING)
+        return min(index + 1, NUM_BUCKETS - 1)
+
+    @staticmethod
+    def _upper_bound(bucket: int) -> float:
+        return MIN_LATENCY * 2 ** (bucket / BUCKETS_PER_DOUBLING)
+
+    def add(self, seconds: float):
+        self.counts[self._bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        Верхняя граница корзины, в которую попадает перцентиль q (от 0 до
+        100), но не больше максимального значения.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(math.ceil(q / 100 * self.count), 1)
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Tracer:
+    """
+    Собирает завершенные трассы доставок: распределения задержек по этапам
+    и в целом, плюс самые медленные трассы, которые flush() дописывает в
+    JSONL-файл sample_path (по одной на строку, с длительностями этапов).
+    Трассы накапливаются в памяти только для slowest самых медленных за
+    период между сбросами.
+    """
+
+    def __init__(self, sample_path: str = None, slowest: int = 20):
+        self.sample_path = sample_path
+        self.slowest = slowest
+
+        self._histograms = {stage: LatencyHistogram()
+                            for stage in STAGES + (TOTAL,)}
+        self._slowest = []  # type: List[Tuple[float, int, Dict[str, Any]]]
+        self._order = count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, trace: Dict[str, Any], tg_id: int = None):
+        """
+        Учитывает трассу доставки поста подписчику tg_id.
+        """
+        durations = stage_durations(trace)
+        total = durations[TOTAL]
+        with self._lock:
+            for stage, seconds in durations.items():
+                self._histograms[stage].add(seconds)
+            slowest = self._slowest
+            if len(slowest) < self.slowest or total > slowest[0][0]:
+                item = (total, next(self._order),
+                        dict(trace, tg_id=tg_id, durations=durations))
+                if len(slowest) < self.slowest:
+                    heapq.heappush(slowest, item)
+                else:
+                    heapq.heapreplace(slowest, item)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Сводка задержек по этапам и в целом (ключ TOTAL) в секундах.
+        """
+        with self._lock:
+            return {stage: histogram.summary()
+                    for stage, histogram in self._histograms.items()}
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """
+        Дописывает накопленные самые медленные трассы в sample_path (от
+        медленных к быстрым) и начинает новый период.
+        :return: записанные трассы.
+        """
+        with self._lock:
+            slowest = [trace for _, _, trace in sorted(self._slowest,
+                                                       reverse=True)]
+            self._slowest = []
+        if slowest and self.sample_path is not None:
+            directory = os.path.dirname(self.sample_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.sample_path, "a") as f:
+                for trace in slowest:
+                    f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+        return slowest
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("Error in Tracer.flush(): {}\n{}".format(
+                    str(e), traceback.format_exc()
+                ))
+
+    def start(self, interval: float = 60.0):
+        """
+        Запускает фоновый сброс самых медленных трасс раз в interval секунд.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, args=(interval,), name="tracer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
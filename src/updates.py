@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import threading
+
+from collections import deque
+
+from functools import wraps
+from typing import Deque, Set
+
+LAST_UPDATE_ID_KEY = "last_update_id"
+
+
+class DedupWindow:
+    """
+    Окно недавно обработанных обновлений для отсева повторов.
+
+    Хранит не больше size последних update_id. Обновления старше окна и не
+    новее last, восстановленного после рестарта, тоже считаются
+    обработанными: update_id от Телеграма только возрастают.
+    """
+
+    def __init__(self, last: int = 0, size: int = 1000):
+        self.last = last
+        self.size = size
+        self._floor = last
+        self._ids = set()  # type: Set[int]
+        self._order = deque()  # type: Deque[int]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def seen(self, update_id: int) -> bool:
+        with self._lock:
+            return update_id <= self._floor or update_id in self._ids
+
+    def add(self, update_id: int):
+        with self._lock:
+            if update_id <= self._floor or update_id in self._ids:
+                return
+            self._ids.add(update_id)
+            self._order.append(update_id)
+            self.last = max(self.last, update_id)
+            if len(self._order) > self.size:
+                oldest = self._order.popleft()
+                self._ids.remove(oldest)
+                self._floor = max(self._floor, oldest)
+
+
+class UpdateTracker:
+    """
+    Делает обработку обновлений идемпотентной между рестартами.
+
+    Обернутый хэндлер выполняется внутри Store.transaction(), а ID
+    обработанного обновления записывается в таблицу bot_state в той же
+    транзакции. Поэтому после рестарта бот продолжает опрос ровно с
+    того места, на котором остановился (см. resume()), а повторно
+    пришедшее обновление отбрасывается до обращения к хранилищу.
+
+    Последний обработанный update_id читается из хранилища в load() - это
+    шаг прогрева, а не конструктор, чтобы создание бота не обращалось к
+    БД. До load() обернутые хэндлеры ждут: без восстановленного окна
+    повтор не отличить от нового обновления.
+    """
+
+    def __init__(self,
+                 store,
+                 key: str = LAST_UPDATE_ID_KEY,
+                 window_size: int = 1000):
+        self.store = store
+        self.key = key
+        self.window = DedupWindow(0, window_size)
+        self.skipped = 0
+        self._loaded = threading.Event()
+
+    def load(self, store=None):
+        """
+        Восстанавливает последний обработанный update_id из хранилища.
+        :param store: хранилище для чтения, если не self.store (например,
+        отдельная сессия прогрева).
+        """
+        value = (store or self.store).get_state(self.key)
+        self.window = DedupWindow(int(value) if value else 0,
+                                  self.window.size)
+        self._loaded.set()
+
+    def resume(self, updater):
+        """
+        Настраивает Updater так, чтобы следующий getUpdates запросил
+        обновления, следующие за последним обработанным. Вызывается после
+        load().
+        """
+        if self.window.last:
+            updater.last_update_id = self.window.last + 1
+
+    def _mark_done(self, update_id: int):
+        self.window.add(update_id)
+        self.store.set_state(self.key, str(self.window.last))
+
+    def __call__(self, handler):
+        """
+        Оборачивает хэндлер с сигнатурой (bot, update, ...).
+        """
+        @wraps(handler)
+        def wrapper(bot, update, *args, **kwargs):
+            self._loaded.wait()
+            update_id = update.update_id
+            if self.window.seen(update_id):
+                self.skipped += 1
+                return None
+            try:
+                # Изменения хэндлера и ID обновления сохраняются одним
+                # коммитом при выходе из блока.
+                with self.store.transaction():
+                    result = handler(bot, update, *args, **kwargs)
+                    self._mark_done(update_id)
+            except Exception:
+                # Обновление все равно считается полученным: Телеграм не
+                # пришлет его снова, а повтор с тем же результатом не нужен.
+                with self.store.transaction():
+                    self._mark_done(update_id)
+                raise
+            return result
+
+        return wrapper